@@ -0,0 +1,3 @@
+import { computeClientHeartbeatHandler } from "../apiHelpers/requestHandlers"; // remove .js for local dev
+
+export default computeClientHeartbeatHandler;
@@ -0,0 +1,3 @@
+import { createJobsHandler } from "../apiHelpers/requestHandlers"; // remove .js for local dev
+
+export default createJobsHandler;
@@ -11,10 +11,14 @@ import {
   AddUserResponse,
   CancelJobResponse,
   CancelMultipartUploadResponse,
+  ComputeClientHeartbeatResponse,
   ComputeClientComputeSlot,
   ComputeUserStatsResponse,
   CreateComputeClientResponse,
+  CreateJobRequest,
   CreateJobResponse,
+  CreateJobsRequestJob,
+  CreateJobsResponse,
   DeleteComputeClientResponse,
   DeleteJobsResponse,
   DeleteServiceAppResponse,
@@ -55,9 +59,11 @@ import {
   isAddUserRequest,
   isCancelJobRequest,
   isCancelMultipartUploadRequest,
+  isComputeClientHeartbeatRequest,
   isComputeUserStatsRequest,
   isCreateComputeClientRequest,
   isCreateJobRequest,
+  isCreateJobsRequest,
   isDeleteComputeClientRequest,
   isDeleteJobsRequest,
   isDeleteServiceAppRequest,
@@ -512,167 +518,199 @@ export const createJobHandler = allowCors(
         });
         return;
       }
-      try {
-        validateJobDefinitionForServiceApp(rr.jobDefinition, app);
-      } catch (err) {
+      const result = await createJobForServiceApp(rr, app);
+      if (result.error !== undefined) {
+        res.status(result.errorStatus).json({ error: result.error });
+        return;
+      }
+      const resp: CreateJobResponse = {
+        type: "createJobResponse",
+        job: result.job,
+      };
+      res.status(200).json(resp);
+    } catch (e) {
+      console.error(e);
+      res.status(500).json({ error: e.message });
+    }
+  },
+);
+
+// createJobs handler
+const maxNumJobsPerCreateJobsRequest = 200;
+export const createJobsHandler = allowCors(
+  async (req: VercelRequest, res: VercelResponse) => {
+    if (req.method !== "POST") {
+      res.status(405).json({ error: "Method not allowed" });
+      return;
+    }
+    const rr = req.body;
+    if (!isCreateJobsRequest(rr)) {
+      res.status(400).json({ error: "Invalid request" });
+      return;
+    }
+    try {
+      if (rr.jobs.length > maxNumJobsPerCreateJobsRequest) {
         res.status(400).json({
-          error: `Job definition is not compatible with app: ${err.message}`,
+          error: `Too many jobs in request: ${rr.jobs.length} > ${maxNumJobsPerCreateJobsRequest}`,
         });
         return;
       }
-
-      const jobDefinitionNormalized = normalizeJobDefinitionForHash(
-        rr.jobDefinition,
-      );
-      const jobDefinitionHash = computeSha1(
-        JSONStringifyDeterministic(jobDefinitionNormalized),
-      );
-
-      if (!rr.skipCache) {
-        const match = {
-          serviceName: rr.serviceName,
-          jobDefinitionHash,
-        };
-        const pipeline = [
-          { $match: match },
-          { $sort: { timestampCreatedSec: -1 } }, // get the most recent matching job
-          { $limit: 1 },
-        ];
-        const jobs = await fetchJobs(pipeline, {
-          includePrivateKey: false,
-          includeSecrets: false,
+      const authorizationToken = req.headers.authorization?.split(" ")[1]; // Extract the token
+      if (!authorizationToken) {
+        res.status(400).json({ error: "User API token must be provided" });
+        return;
+      }
+      let userId = rr.userId;
+      if (!userId) {
+        userId = await getUserIdFromApiToken(authorizationToken);
+        if (!userId) {
+          res.status(401).json({ error: "Unauthorized - no user for token" });
+          return;
+        }
+      } else {
+        if (
+          !(await authenticateUserUsingApiToken(userId, authorizationToken))
+        ) {
+          res.status(401).json({ error: "Unauthorized" });
+          return;
+        }
+      }
+      const service = await fetchService(rr.serviceName);
+      if (!service) {
+        res.status(400).json({ error: `Service not found: ${rr.serviceName}` });
+        return;
+      }
+      if (!userIsAllowedToCreateJobsForService(service, userId)) {
+        res.status(401).json({
+          error: "This user is not allowed to create jobs for this service",
         });
-        if (jobs.length > 0) {
-          const job = jobs[0];
-          if (job.status === "failed" && rr.rerunFailing) {
-            // we're not going to use this one because we are going to rerun the failed job
-            if (rr.deleteFailing) {
-              await deleteJobs({
-                jobIds: [job.jobId],
-              });
-            }
-          } else {
-            let allTagsWereAlreadyPresentOnJob = true;
-            const newTags = [...job.tags];
-            for (const tag of rr.tags) {
-              if (!job.tags.includes(tag)) {
-                newTags.push(tag);
-                allTagsWereAlreadyPresentOnJob = false;
-              }
-            }
-            if (!allTagsWereAlreadyPresentOnJob) {
-              await updateJob(job.jobId, { tags: newTags });
-            }
-            // notify the compute clients as though the status has changed
-            await publishPubsubMessage("dendro-compute-clients", {
-              type: "jobStatusChanged",
-              serviceName: job.serviceName,
-              jobId: job.jobId,
-              status: job.status,
+        return;
+      }
+      let jobOrder: number[];
+      try {
+        jobOrder = getCreateJobsOrder(rr.jobs);
+      } catch (err) {
+        res.status(400).json({ error: err.message });
+        return;
+      }
+      // Validate the whole batch before creating any job, so that an invalid
+      // request does not leave some of its jobs created (the client would
+      // create them again when resubmitting the batch)
+      const apps: { [appName: string]: DendroServiceApp } = {};
+      for (let jobIndex = 0; jobIndex < rr.jobs.length; jobIndex++) {
+        const jj = rr.jobs[jobIndex];
+        const appName = jj.jobDefinition.appName;
+        if (!apps[appName]) {
+          const app = await fetchServiceApp(rr.serviceName, appName);
+          if (!app) {
+            res.status(400).json({
+              error: `Service app not found: ${appName}`,
+            });
+            return;
+          }
+          apps[appName] = app;
+        }
+        try {
+          validateJobDefinitionForServiceApp(
+            jj.jobDefinition,
+            apps[appName],
+          );
+        } catch (err) {
+          res.status(400).json({
+            error: `Error creating job ${jobIndex}: Job definition is not compatible with app: ${err.message}`,
+          });
+          return;
+        }
+        for (const ref of jj.inputFileJobOutputRefs || []) {
+          const otherJobDefinition = rr.jobs[ref.jobIndex].jobDefinition;
+          if (
+            !otherJobDefinition.outputFiles.find(
+              (o) => o.name === ref.outputName,
+            )
+          ) {
+            res.status(400).json({
+              error: `Output ${ref.outputName} not found for job ${ref.jobIndex}`,
+            });
+            return;
+          }
+          if (
+            !jj.jobDefinition.inputFiles.find((f) => f.name === ref.inputName)
+          ) {
+            res.status(400).json({
+              error: `Input ${ref.inputName} not found for job ${jobIndex}`,
             });
-            // double check that the  private key and the secrets are not included
-            if (job.jobPrivateKey) {
-              throw new Error("Unexpected: job private key should be null (1)");
-            }
-            if (job.secrets) {
-              throw new Error("Unexpected: job secrets should be null (1)");
-            }
-            const resp: CreateJobResponse = {
-              type: "createJobResponse",
-              job,
-            };
-            res.status(200).json(resp);
             return;
           }
         }
       }
-
-      const jobId = generateJobId();
-      const jobPrivateKey = generateJobPrivateKey();
-      const consoleOutputUrl = await createOutputFileUrl({
-        serviceName: rr.serviceName,
-        appName: rr.jobDefinition.appName,
-        processorName: rr.jobDefinition.processorName,
-        jobId,
-        outputName: "console_output",
-        outputFileBaseName: "output.txt",
-      });
-      const resourceUtilizationLogUrl = await createOutputFileUrl({
-        serviceName: rr.serviceName,
-        appName: rr.jobDefinition.appName,
-        processorName: rr.jobDefinition.processorName,
-        jobId,
-        outputName: "resource_utilization_log",
-        outputFileBaseName: "log.jsonl",
-      });
-
-      const outputFileResults: DendroJobOutputFileResult[] = [];
-      for (const oo of rr.jobDefinition.outputFiles) {
-        const ofr: DendroJobOutputFileResult = {
-          name: oo.name,
-          fileBaseName: oo.fileBaseName,
-          url: oo.urlDeterminedAtRuntime
-            ? ""
-            : await createOutputFileUrl({
-                serviceName: rr.serviceName,
-                appName: rr.jobDefinition.appName,
-                processorName: rr.jobDefinition.processorName,
-                jobId,
-                outputName: oo.name,
-                outputFileBaseName: oo.fileBaseName,
-              }),
-          size: null,
+      const createdJobs: (DendroJob | undefined)[] = rr.jobs.map(
+        () => undefined,
+      );
+      for (const jobIndex of jobOrder) {
+        const jj = rr.jobs[jobIndex];
+        // resolve the inputs that refer to outputs of other jobs in this batch
+        const jobDefinition: DendroJobDefinition = {
+          ...jj.jobDefinition,
+          inputFiles: jj.jobDefinition.inputFiles.map((f) => ({ ...f })),
         };
-        outputFileResults.push(ofr);
+        const jobDependencies = [...jj.jobDependencies];
+        for (const ref of jj.inputFileJobOutputRefs || []) {
+          const otherJob = createdJobs[ref.jobIndex];
+          if (!otherJob) {
+            throw new Error(
+              `Unexpected: job ${ref.jobIndex} has not been created`,
+            );
+          }
+          const output = otherJob.outputFileResults.find(
+            (o) => o.name === ref.outputName,
+          );
+          const inputFile = jobDefinition.inputFiles.find(
+            (f) => f.name === ref.inputName,
+          );
+          if (!output || !inputFile) {
+            throw new Error(
+              `Unexpected: unable to resolve input ${ref.inputName} of job ${jobIndex}`,
+            );
+          }
+          inputFile.url = output.url;
+          if (!jobDependencies.includes(otherJob.jobId)) {
+            jobDependencies.push(otherJob.jobId);
+          }
+        }
+        const result = await createJobForServiceApp(
+          {
+            type: "createJobRequest",
+            serviceName: rr.serviceName,
+            userId,
+            batchId: jj.batchId,
+            tags: jj.tags,
+            jobDefinition,
+            requiredResources: jj.requiredResources,
+            targetComputeClientIds: jj.targetComputeClientIds,
+            secrets: jj.secrets,
+            jobDependencies,
+            skipCache: rr.skipCache,
+            rerunFailing: rr.rerunFailing,
+            deleteFailing: rr.deleteFailing,
+          },
+          apps[jobDefinition.appName],
+        );
+        if (result.error !== undefined) {
+          // the batch was validated above, so this is not expected
+          throw new Error(`Error creating job ${jobIndex}: ${result.error}`);
+        }
+        createdJobs[jobIndex] = result.job;
       }
-
-      const isRunnable = await checkJobRunnable(rr.jobDependencies);
-
-      const job: DendroJob = {
-        jobId,
-        jobPrivateKey,
-        serviceName: rr.serviceName,
-        userId: rr.userId,
-        batchId: rr.batchId,
-        tags: rr.tags,
-        jobDefinition: rr.jobDefinition,
-        jobDefinitionHash,
-        jobDependencies: rr.jobDependencies,
-        requiredResources: rr.requiredResources,
-        targetComputeClientIds: rr.targetComputeClientIds || null,
-        secrets: rr.secrets,
-        inputFileUrlList: rr.jobDefinition.inputFiles.map((f) => f.url),
-        outputFileUrlList: [],
-        outputFileResults,
-        consoleOutputUrl,
-        resourceUtilizationLogUrl,
-        timestampCreatedSec: Date.now() / 1000,
-        timestampStartingSec: null,
-        timestampStartedSec: null,
-        timestampFinishedSec: null,
-        timestampUpdatedSec: Date.now() / 1000,
-        canceled: false,
-        status: "pending",
-        isRunnable,
-        error: null,
-        computeClientId: null,
-        computeClientName: null,
-        computeClientUserId: null,
-        imageUri: null,
-      };
-      await insertJob(job);
-
-      await publishPubsubMessage("dendro-compute-clients", {
-        type: "newPendingJob",
-        serviceName: job.serviceName,
-        jobId: job.jobId,
-      });
-      // hide the private key and the secrets
-      job.jobPrivateKey = null;
-      job.secrets = null;
-      const resp: CreateJobResponse = {
-        type: "createJobResponse",
-        job,
+      const jobs: DendroJob[] = [];
+      for (const job of createdJobs) {
+        if (!job) {
+          throw new Error("Unexpected: job was not created");
+        }
+        jobs.push(job);
+      }
+      const resp: CreateJobsResponse = {
+        type: "createJobsResponse",
+        jobs,
       };
       res.status(200).json(resp);
     } catch (e) {
@@ -682,6 +720,200 @@ export const createJobHandler = allowCors(
   },
 );
 
+// Order the jobs of a createJobs request so that each job comes after the
+// jobs whose outputs it uses
+const getCreateJobsOrder = (jobs: CreateJobsRequestJob[]) => {
+  const order: number[] = [];
+  const state: ("unvisited" | "visiting" | "done")[] = jobs.map(
+    () => "unvisited",
+  );
+  const visit = (i: number) => {
+    if (state[i] === "done") return;
+    if (state[i] === "visiting") {
+      throw new Error("Circular dependency between jobs in request");
+    }
+    state[i] = "visiting";
+    for (const ref of jobs[i].inputFileJobOutputRefs || []) {
+      if (ref.jobIndex < 0 || ref.jobIndex >= jobs.length) {
+        throw new Error(`Invalid job index in request: ${ref.jobIndex}`);
+      }
+      visit(ref.jobIndex);
+    }
+    state[i] = "done";
+    order.push(i);
+  };
+  for (let i = 0; i < jobs.length; i++) {
+    visit(i);
+  }
+  return order;
+};
+
+type CreateJobResult =
+  | { job: DendroJob; error?: undefined; errorStatus?: undefined }
+  | { job?: undefined; error: string; errorStatus: number };
+
+// Create a job (or return the matching existing job, depending on the cache
+// settings) after the user has been authorized to create jobs for the service
+const createJobForServiceApp = async (
+  rr: CreateJobRequest,
+  app: DendroServiceApp,
+): Promise<CreateJobResult> => {
+  try {
+    validateJobDefinitionForServiceApp(rr.jobDefinition, app);
+  } catch (err) {
+    return {
+      error: `Job definition is not compatible with app: ${err.message}`,
+      errorStatus: 400,
+    };
+  }
+
+  const jobDefinitionNormalized = normalizeJobDefinitionForHash(
+    rr.jobDefinition,
+  );
+  const jobDefinitionHash = computeSha1(
+    JSONStringifyDeterministic(jobDefinitionNormalized),
+  );
+
+  if (!rr.skipCache) {
+    const match = {
+      serviceName: rr.serviceName,
+      jobDefinitionHash,
+    };
+    const pipeline = [
+      { $match: match },
+      { $sort: { timestampCreatedSec: -1 } }, // get the most recent matching job
+      { $limit: 1 },
+    ];
+    const jobs = await fetchJobs(pipeline, {
+      includePrivateKey: false,
+      includeSecrets: false,
+    });
+    if (jobs.length > 0) {
+      const job = jobs[0];
+      if (job.status === "failed" && rr.rerunFailing) {
+        // we're not going to use this one because we are going to rerun the failed job
+        if (rr.deleteFailing) {
+          await deleteJobs({
+            jobIds: [job.jobId],
+          });
+        }
+      } else {
+        let allTagsWereAlreadyPresentOnJob = true;
+        const newTags = [...job.tags];
+        for (const tag of rr.tags) {
+          if (!job.tags.includes(tag)) {
+            newTags.push(tag);
+            allTagsWereAlreadyPresentOnJob = false;
+          }
+        }
+        if (!allTagsWereAlreadyPresentOnJob) {
+          await updateJob(job.jobId, { tags: newTags });
+        }
+        // notify the compute clients as though the status has changed
+        await publishPubsubMessage("dendro-compute-clients", {
+          type: "jobStatusChanged",
+          serviceName: job.serviceName,
+          jobId: job.jobId,
+          status: job.status,
+        });
+        // double check that the  private key and the secrets are not included
+        if (job.jobPrivateKey) {
+          throw new Error("Unexpected: job private key should be null (1)");
+        }
+        if (job.secrets) {
+          throw new Error("Unexpected: job secrets should be null (1)");
+        }
+        return { job };
+      }
+    }
+  }
+
+  const jobId = generateJobId();
+  const jobPrivateKey = generateJobPrivateKey();
+  const consoleOutputUrl = await createOutputFileUrl({
+    serviceName: rr.serviceName,
+    appName: rr.jobDefinition.appName,
+    processorName: rr.jobDefinition.processorName,
+    jobId,
+    outputName: "console_output",
+    outputFileBaseName: "output.txt",
+  });
+  const resourceUtilizationLogUrl = await createOutputFileUrl({
+    serviceName: rr.serviceName,
+    appName: rr.jobDefinition.appName,
+    processorName: rr.jobDefinition.processorName,
+    jobId,
+    outputName: "resource_utilization_log",
+    outputFileBaseName: "log.jsonl",
+  });
+
+  const outputFileResults: DendroJobOutputFileResult[] = [];
+  for (const oo of rr.jobDefinition.outputFiles) {
+    const ofr: DendroJobOutputFileResult = {
+      name: oo.name,
+      fileBaseName: oo.fileBaseName,
+      url: oo.urlDeterminedAtRuntime
+        ? ""
+        : await createOutputFileUrl({
+            serviceName: rr.serviceName,
+            appName: rr.jobDefinition.appName,
+            processorName: rr.jobDefinition.processorName,
+            jobId,
+            outputName: oo.name,
+            outputFileBaseName: oo.fileBaseName,
+          }),
+      size: null,
+    };
+    outputFileResults.push(ofr);
+  }
+
+  const isRunnable = await checkJobRunnable(rr.jobDependencies);
+
+  const job: DendroJob = {
+    jobId,
+    jobPrivateKey,
+    serviceName: rr.serviceName,
+    userId: rr.userId,
+    batchId: rr.batchId,
+    tags: rr.tags,
+    jobDefinition: rr.jobDefinition,
+    jobDefinitionHash,
+    jobDependencies: rr.jobDependencies,
+    requiredResources: rr.requiredResources,
+    targetComputeClientIds: rr.targetComputeClientIds || null,
+    secrets: rr.secrets,
+    inputFileUrlList: rr.jobDefinition.inputFiles.map((f) => f.url),
+    outputFileUrlList: [],
+    outputFileResults,
+    consoleOutputUrl,
+    resourceUtilizationLogUrl,
+    timestampCreatedSec: Date.now() / 1000,
+    timestampStartingSec: null,
+    timestampStartedSec: null,
+    timestampFinishedSec: null,
+    timestampUpdatedSec: Date.now() / 1000,
+    canceled: false,
+    status: "pending",
+    isRunnable,
+    error: null,
+    computeClientId: null,
+    computeClientName: null,
+    computeClientUserId: null,
+    imageUri: null,
+  };
+  await insertJob(job);
+
+  await publishPubsubMessage("dendro-compute-clients", {
+    type: "newPendingJob",
+    serviceName: job.serviceName,
+    jobId: job.jobId,
+  });
+  // hide the private key and the secrets
+  job.jobPrivateKey = null;
+  job.secrets = null;
+  return { job };
+};
+
 // findJobByDefinition handler
 export const findJobByDefinitionHandler = allowCors(
   async (req: VercelRequest, res: VercelResponse) => {
@@ -1059,6 +1291,69 @@ export const getRunnableJobsForComputeClientHandler = allowCors(
   },
 );
 
+// computeClientHeartbeat handler
+export const computeClientHeartbeatHandler = allowCors(
+  async (req: VercelRequest, res: VercelResponse) => {
+    const rr = req.body;
+    if (!isComputeClientHeartbeatRequest(rr)) {
+      res.status(400).json({ error: "Invalid request" });
+      return;
+    }
+    try {
+      const computeClient: DendroComputeClient | null =
+        await fetchComputeClient(rr.computeClientId);
+      if (!computeClient) {
+        res.status(404).json({ error: "Compute client not found" });
+        return;
+      }
+      const computeClientPrivateKey = req.headers.authorization?.split(" ")[1]; // Extract the token
+      if (computeClient.computeClientPrivateKey !== computeClientPrivateKey) {
+        res.status(401).json({
+          error:
+            "Unauthorized: incorrect or missing compute client private key",
+        });
+        return;
+      }
+      await updateComputeClient(rr.computeClientId, {
+        timestampLastActiveSec: Date.now() / 1000,
+      });
+      // The jobs that are running on this compute client according to the
+      // database (same as runningJobs in getRunnableJobsForComputeClient)
+      const pipeline = [
+        {
+          $match: {
+            status: { $in: ["running", "starting"] },
+            computeClientId: rr.computeClientId,
+          },
+        },
+      ];
+      const runningJobs = await fetchJobs(pipeline, {
+        includePrivateKey: false,
+        includeSecrets: false,
+      });
+      const runningJobsById: { [jobId: string]: DendroJob } = {};
+      for (const job of runningJobs) {
+        runningJobsById[job.jobId] = job;
+      }
+      // A job process should stop if the job was canceled, or if the job is
+      // no longer running on this compute client (e.g., it was deleted or
+      // its status was set by someone else)
+      const canceledJobIds = rr.runningJobIds.filter((jobId) => {
+        const job = runningJobsById[jobId];
+        return !job || job.canceled;
+      });
+      const resp: ComputeClientHeartbeatResponse = {
+        type: "computeClientHeartbeatResponse",
+        canceledJobIds,
+      };
+      res.status(200).json(resp);
+    } catch (e) {
+      console.error(e);
+      res.status(500).json({ error: e.message });
+    }
+  },
+);
+
 // getRunnableJob handler
 export const getRunnableJobHandler = allowCors(
   async (req: VercelRequest, res: VercelResponse) => {
@@ -1285,6 +1580,14 @@ export const cancelJobHandler = allowCors(
         return;
       }
       await updateJob(rr.jobId, { canceled: true });
+      // the compute client running the job forwards this to the job process
+      await publishPubsubMessage("dendro-compute-clients", {
+        type: "jobStatusChanged",
+        serviceName: job.serviceName,
+        jobId: job.jobId,
+        status: job.status,
+        canceled: true,
+      });
       const resp: CancelJobResponse = {
         type: "cancelJobResponse",
       };
@@ -1437,6 +1740,7 @@ export const setJobStatusHandler = allowCors(
           error: rr.error,
           timestampFinishedSec: Date.now() / 1000,
           timestampUpdatedSec: Date.now() / 1000,
+          ...(rr.resourceUsage ? { resourceUsage: rr.resourceUsage } : {}),
         });
         if (rr.status === "completed") {
           // maybe some other jobs have become runnable
@@ -1610,12 +1914,23 @@ export const getSignedUploadUrlHandler = allowCors(
         res.status(200).json(resp);
       } else {
         const numParts = Math.ceil(rr.size / (1024 * 1024 * 1000));
-        const { parts, uploadId } = await initiateMultipartUpload({
-          url,
-          size: rr.size,
-          userId: job.userId,
-          numParts,
-        });
+        // When resuming, the parts that were already uploaded to the existing
+        // multipart upload are kept, so we only need new signed urls
+        const { parts, uploadId } = rr.uploadId
+          ? {
+              parts: await getMultipartUploadPartUrls({
+                url,
+                uploadId: rr.uploadId,
+                numParts,
+              }),
+              uploadId: rr.uploadId,
+            }
+          : await initiateMultipartUpload({
+              url,
+              size: rr.size,
+              userId: job.userId,
+              numParts,
+            });
         const resp: GetSignedUploadUrlResponse = {
           type: "getSignedUploadUrlResponse",
           parts,
@@ -2944,6 +3259,21 @@ const initiateMultipartUpload = async (o: {
   if (!success) {
     throw Error("Failed to initiate multipart upload. No success");
   }
+  const parts = await getMultipartUploadPartUrls({ url, uploadId, numParts });
+  return { uploadId, parts };
+};
+
+const getMultipartUploadPartUrls = async (o: {
+  url: string;
+  uploadId: string;
+  numParts: number;
+}) => {
+  const { url, uploadId, numParts } = o;
+  const prefix = `https://tempory.net/f/dendro/`;
+  if (!url.startsWith(prefix)) {
+    throw Error("Invalid url. Does not have proper prefix");
+  }
+  const filePath = url.slice(prefix.length);
   const temporaryApiUrl2 = "https://hub.tempory.net/api/uploadFileParts";
   const partNumbers: number[] = [];
   for (let i = 1; i <= numParts; i++) {
@@ -2977,7 +3307,7 @@ const initiateMultipartUpload = async (o: {
       signedUrl: uploadUrls[i],
     });
   }
-  return { uploadId, parts };
+  return parts;
 };
 
 const finalizeMultipartUpload = async (o: {
@@ -27,6 +27,7 @@ class CebraNwbEmbedding5(ProcessorBase):
         import numpy as np
         import cebra
         import torch
+        from ragged_spike_trains import RaggedSpikeTrains
 
         units_path = context.units_path
         batch_size = context.batch_size
@@ -45,41 +46,35 @@ class CebraNwbEmbedding5(ProcessorBase):
         else:
             f = lindi.LindiH5pyFile.from_hdf5_file(url)
 
-        # Load the spike data
-        spike_times: np.ndarray = f[f'{units_path}/spike_times'][()]  # type: ignore
-        spike_times_index: np.ndarray = f[f'{units_path}/spike_times_index'][()]  # type: ignore
-        spike_trains = []
-        offset = 0
-        for i in range(len(spike_times_index)):
-            st = spike_times[offset:int(spike_times_index[i])]
-            # exclude the NaN from the spike times
-            st = st[~np.isnan(st)]
-            spike_trains.append(st)
-            offset = int(spike_times_index[i])
-        num_units = len(spike_trains)
+        # Load the spike data (excluding the NaN from the spike times)
+        spike_trains = RaggedSpikeTrains.from_units_table(f, units_path)
+        num_units = spike_trains.num_units
 
         start_time_sec = float(0)  # we assume we are starting at time 0
         # end time is the max over all the spike trains
-        all_spike_times = np.concatenate(spike_trains)
-        end_time_sec = float(np.max(all_spike_times))
+        end_time_sec = spike_trains.max_time()
 
         print(f'Start time: {start_time_sec}')
         print(f'End time: {end_time_sec}')
 
-        firing_rates_hz = [len(st) / (end_time_sec - start_time_sec) for st in spike_trains]
+        num_spikes_per_unit = spike_trains.counts()
+        firing_rates_hz = spike_trains.rates(start_time_sec=start_time_sec, end_time_sec=end_time_sec)
 
         print(f'Number of units: {num_units}')
-        print(f'Total number of spikes: {sum([len(st) for st in spike_trains])}')
+        print(f'Total number of spikes: {spike_trains.num_spikes}')
         for i in range(num_units):
-            print(f'Unit {i}: {len(spike_trains[i])} spikes, {firing_rates_hz[i]:.2f} Hz')
+            print(f'Unit {i}: {num_spikes_per_unit[i]} spikes, {firing_rates_hz[i]:.2f} Hz')
 
         num_bins = int((end_time_sec - start_time_sec) / bin_size_sec)
         print(f'Number of bins: {num_bins}')
 
         # bin the spikes
-        spike_counts = np.zeros((num_bins, num_units))
-        for i in range(num_units):
-            spike_counts[:, i], _ = np.histogram(spike_trains[i], bins=num_bins, range=(start_time_sec, end_time_sec))
+        spike_counts = spike_trains.bin_counts(
+            start_time_sec=start_time_sec,
+            end_time_sec=end_time_sec,
+            num_bins=num_bins,
+            dtype=np.float64
+        )
 
         t = np.arange(num_bins) * bin_size_sec
 
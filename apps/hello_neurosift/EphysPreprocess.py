@@ -1,4 +1,3 @@
-import time
 from dendro.sdk import ProcessorBase, InputFile, OutputFile
 from pydantic import BaseModel, Field
 
@@ -132,71 +131,6 @@ class EphysPreprocess(ProcessorBase):
         context.output.upload('output.nwb.lindi.tar')
 
 
-def compute_estimated_channel_firing_rates(recording):
-    import numpy as np
-    import spikeinterface as si
-    timestamp_last_print = time.time()
-    R: si.BaseRecording = recording
-    chunk_duration_sec = 5
-    chunk_duration_frames = int(chunk_duration_sec * R.get_sampling_frequency())
-    num_chunks = int(R.get_num_frames() / chunk_duration_frames)
-    X = np.zeros((num_chunks, R.get_num_channels()))
-    for ss in range(num_chunks):
-        elapsed_since_last_print = time.time() - timestamp_last_print
-        if elapsed_since_last_print > 10:
-            print(f'Computing estimated channel firing rates: {ss} of {num_chunks} time chunks')
-            timestamp_last_print = time.time()
-        traces = R.get_traces(start_frame=int(ss * chunk_duration_frames), end_frame=int((ss + 1) * chunk_duration_frames))
-        for m in range(R.get_num_channels()):
-            X[ss, m] = estimate_num_spikes(traces[:, m]) / chunk_duration_sec
-    return np.mean(X, axis=0)
-
-
-def compute_channel_power_spectra(recording):
-    import numpy as np
-    import spikeinterface as si
-    timestamp_last_print = time.time()
-    R: si.BaseRecording = recording
-    chunk_duration_sec = 5
-    chunk_duration_frames = int(chunk_duration_sec * R.get_sampling_frequency())
-    num_chunks = int(R.get_num_frames() / chunk_duration_frames)
-    freqs = np.fft.fftfreq(chunk_duration_frames, 1 / R.get_sampling_frequency())
-    freqs = freqs[:int(chunk_duration_frames / 2)]
-    X = np.zeros((num_chunks, R.get_num_channels(), len(freqs)))
-    for ss in range(num_chunks):
-        elapsed_since_last_print = time.time() - timestamp_last_print
-        if elapsed_since_last_print > 10:
-            print(f'Computing channel power spectra: {ss} of {num_chunks} time chunks')
-            timestamp_last_print = time.time()
-        traces = R.get_traces(start_frame=int(ss * chunk_duration_frames), end_frame=int((ss + 1) * chunk_duration_frames))
-        for m in range(R.get_num_channels()):
-            X[ss, m, :] = np.abs(np.fft.fft(traces[:, m]))[:int(chunk_duration_frames / 2)] ** 2
-    X_mean = np.mean(X, axis=0)
-    # subsample to 1000 points
-    X_mean = X_mean[:, ::int(len(freqs) / 1000)]
-    freqs = freqs[::int(len(freqs) / 1000)]
-    return freqs, X_mean
-
-
-def estimate_num_spikes(trace):
-    import numpy as np
-    X: np.ndarray = trace
-    # normalize
-    X = X - np.mean(X)
-    X = X / np.std(X)
-    detect_threshold = 5
-    candidate_times = np.where(X < -detect_threshold)[0]  # assume spikes are negative
-    detect_interval = 20
-    # don't double count times that are within detect_interval of each other
-    times = []
-    last_detect_time = -1000
-    for t in candidate_times:
-        if t - last_detect_time > detect_interval:
-            times.append(t)
-            last_detect_time = t
-    return len(times)
-
-
 # def _process_lindi_file(fname: str):
 #     import numpy as np
 #     from lindi.LindiH5pyFile.LindiReferenceFileSystemStore import LindiReferenceFileSystemStore
@@ -1,3 +1,4 @@
+from typing import List, Union
 import numpy as np
 from dendro.sdk import ProcessorBase, InputFile, OutputFile
 from pydantic import BaseModel, Field
@@ -23,6 +24,7 @@ class MultiscaleSpikeDensity(ProcessorBase):
         context: MultiscaleSpikeDensityContext
     ):
         import lindi
+        from helpers.ragged_spike_trains import RaggedSpikeTrains
 
         units_path = context.units_path
         bin_size_msec = context.bin_size_msec
@@ -37,44 +39,30 @@ class MultiscaleSpikeDensity(ProcessorBase):
         else:
             f = lindi.LindiH5pyFile.from_hdf5_file(url)
 
-        # Load the spike data
-        spike_times: np.ndarray = f[f'{units_path}/spike_times'][()]  # type: ignore
-        spike_times_index: np.ndarray = f[f'{units_path}/spike_times_index'][()]  # type: ignore
-        spike_trains = []
-        offset = 0
-        for i in range(len(spike_times_index)):
-            st = spike_times[offset:int(spike_times_index[i])]
-            # exclude the NaN from the spike times
-            st = st[~np.isnan(st)]
-            spike_trains.append(st)
-            offset = int(spike_times_index[i])
-        num_units = len(spike_trains)
+        # Load the spike data (excluding the NaN from the spike times)
+        spike_trains = RaggedSpikeTrains.from_units_table(f, units_path)
+        num_units = spike_trains.num_units
 
         f.close()
 
         start_time_sec = float(0)  # we assume we are starting at time 0
         # end time is the max over all the spike trains
-        all_spike_times = np.concatenate(spike_trains)
-        end_time_sec = float(np.max(all_spike_times))
+        end_time_sec = spike_trains.max_time()
 
         print(f'Start time: {start_time_sec}')
         print(f'End time: {end_time_sec}')
 
-        firing_rates_hz = [len(st) / (end_time_sec - start_time_sec) for st in spike_trains]
+        num_spikes_per_unit = spike_trains.counts()
+        firing_rates_hz = spike_trains.rates(start_time_sec=start_time_sec, end_time_sec=end_time_sec)
 
         print(f'Number of units: {num_units}')
-        print(f'Total number of spikes: {sum([len(st) for st in spike_trains])}')
+        print(f'Total number of spikes: {spike_trains.num_spikes}')
         for i in range(num_units):
-            print(f'Unit {i}: {len(spike_trains[i])} spikes, {firing_rates_hz[i]:.2f} Hz')
+            print(f'Unit {i}: {num_spikes_per_unit[i]} spikes, {firing_rates_hz[i]:.2f} Hz')
 
         num_bins = int((end_time_sec - start_time_sec) / bin_size_sec)
         print(f'Number of bins: {num_bins}')
 
-        # bin the spikes
-        spike_counts = np.zeros((num_bins, num_units), dtype=np.int32)
-        for i in range(num_units):
-            spike_counts[:, i], _ = np.histogram(spike_trains[i], bins=num_bins, range=(start_time_sec, end_time_sec))
-
         output_fname = 'output.lindi.tar'
         g = lindi.LindiH5pyFile.from_lindi_file(output_fname, mode='w')
 
@@ -82,27 +70,91 @@ class MultiscaleSpikeDensity(ProcessorBase):
 
         ds = g.create_dataset(
             'spike_counts',
-            data=spike_counts,
+            shape=(num_bins, num_units),
+            dtype=np.int32,
             chunks=(np.minimum(num_bins_per_chunk, num_bins), num_units)
         )
         ds.attrs['bin_size_sec'] = bin_size_sec
         ds.attrs['start_time_sec'] = start_time_sec
+        levels = [_PyramidLevel(ds, num_rows_per_chunk=num_bins_per_chunk, downsampling_factor=1)]
         ds_factor = 1
+        num_ds_bins = num_bins
         while num_bins // ds_factor > 10000:
             rel_ds_factor = 3
-            num_ds_bins = spike_counts.shape[0] // rel_ds_factor
-            X = spike_counts[:num_ds_bins * rel_ds_factor, :].reshape(num_ds_bins, rel_ds_factor, num_units)
-            spike_counts_ds = np.sum(X, axis=1).reshape(num_ds_bins, num_units)
+            num_ds_bins = num_ds_bins // rel_ds_factor
             ds_factor = ds_factor * rel_ds_factor
             ds0 = g.create_dataset(
                 f'spike_counts_ds_{ds_factor}',
-                data=spike_counts_ds.astype(np.int32),
+                shape=(num_ds_bins, num_units),
+                dtype=np.int32,
                 chunks=(np.minimum(num_bins_per_chunk, num_ds_bins), num_units)
             )
             ds0.attrs['bin_size_sec'] = bin_size_sec * ds_factor
             ds0.attrs['start_time_sec'] = start_time_sec
-            spike_counts = spike_counts_ds
+            levels.append(_PyramidLevel(ds0, num_rows_per_chunk=num_bins_per_chunk, downsampling_factor=rel_ds_factor))
+
+        # bin the spikes chunk by chunk in time, writing each chunk to all the
+        # levels of the pyramid, so that the dense spike counts of the whole
+        # session are never in memory
+        for _, spike_counts in spike_trains.iter_bin_counts(
+            start_time_sec=start_time_sec,
+            end_time_sec=end_time_sec,
+            num_bins=num_bins,
+            num_bins_per_chunk=num_bins_per_chunk,
+            dtype=np.int32
+        ):
+            for level in levels:
+                spike_counts = level.append(spike_counts)
+        for level in levels:
+            level.finalize()
 
         g.close()  # important
 
         context.output.upload(output_fname)
+
+
+class _PyramidLevel:
+    """Writes the rows of one level of the spike counts pyramid as they come
+
+    The rows of the level below are summed in groups of downsampling_factor
+    (the rows left over wait for the next chunk) and written to the dataset
+    in whole chunks.
+    """
+    def __init__(self, ds, *, num_rows_per_chunk: int, downsampling_factor: int):
+        self._ds = ds
+        self._num_rows_per_chunk = num_rows_per_chunk
+        self._downsampling_factor = downsampling_factor
+        self._leftover: Union[np.ndarray, None] = None
+        self._buffer: List[np.ndarray] = []
+        self._num_buffered_rows = 0
+        self._num_written_rows = 0
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        """Append the rows of the level below and return the rows of this level"""
+        if self._leftover is not None:
+            rows = np.concatenate([self._leftover, rows], axis=0)
+        f = self._downsampling_factor
+        n = rows.shape[0] // f
+        self._leftover = rows[n * f:] if n * f < rows.shape[0] else None
+        if f > 1:
+            rows = rows[:n * f].reshape(n, f, rows.shape[1]).sum(axis=1).astype(np.int32)
+        self._buffer.append(rows)
+        self._num_buffered_rows += n
+        if self._num_buffered_rows >= self._num_rows_per_chunk:
+            self._write(num_rows=self._num_buffered_rows // self._num_rows_per_chunk * self._num_rows_per_chunk)
+        return rows
+
+    def finalize(self):
+        self._write(num_rows=self._num_buffered_rows)
+        if self._num_written_rows != self._ds.shape[0]:
+            raise Exception(f'Unexpected number of rows written to {self._ds.name}: {self._num_written_rows} != {self._ds.shape[0]}')
+
+    def _write(self, *, num_rows: int):
+        if num_rows == 0:
+            return
+        buffered = np.concatenate(self._buffer, axis=0) if len(self._buffer) > 1 else self._buffer[0]
+        i = self._num_written_rows
+        self._ds[i:i + num_rows, :] = buffered[:num_rows]
+        self._num_written_rows += num_rows
+        self._buffer = [buffered[num_rows:]]
+        self._num_buffered_rows -= num_rows
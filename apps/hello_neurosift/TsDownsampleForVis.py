@@ -1,3 +1,5 @@
+from typing import List, Union
+import threading
 import numpy as np
 from pydantic import BaseModel, Field
 from dendro.sdk import ProcessorBase, InputFile, OutputFile
@@ -38,27 +40,59 @@ class TsDownsampleForVis(ProcessorBase):
 
         output_fname = 'output.lindi.tar'
         f.write_lindi_file(output_fname)
-        f.close()
 
-        f = lindi.LindiH5pyFile.from_lindi_file(output_fname, local_cache=local_cache, mode='r+')
-        handle_multiscale_downsampling(f)
+        # The pyramids are built from the input file (read only, so it can be
+        # read from several threads) and written to the output file
+        g = lindi.LindiH5pyFile.from_lindi_file(output_fname, local_cache=local_cache, mode='r+')
+        handle_multiscale_downsampling(f, g)
+        g.close()
         f.close()
 
         context.output.upload(output_fname)
 
 
-def handle_multiscale_downsampling(f, group_path='/'):
+# For each timeseries, the source data is read once, chunk by chunk (the next
+# chunk is prefetched in a background thread while the current one is
+# reduced), and each chunk goes through the cascade of levels (x9, x27,
+# x81, ...), each level reducing the min/max rows of the level below. So
+# there is one pass over the (usually remote) source, whatever the number of
+# levels, and the memory is bounded by a few chunks per level. Independent
+# timeseries are processed in parallel threads.
+
+# size of the chunks read from the source and of the chunks of the output
+chunk_size_mb = 8
+# number of timeseries processed at the same time
+max_parallel_timeseries = 4
+
+
+def handle_multiscale_downsampling(f_in, f_out, group_path='/'):
+    from concurrent.futures import ThreadPoolExecutor
+    data_paths = _find_timeseries_data_paths(f_in, group_path)
+    # the writes to the output file are serialized
+    write_lock = threading.Lock()
+    with ThreadPoolExecutor(max_workers=max_parallel_timeseries) as executor:
+        futures = [
+            executor.submit(handle_multiscale_downsampling_dataset, f_in, f_out, path, write_lock=write_lock)
+            for path in data_paths
+        ]
+        for future in futures:
+            future.result()
+
+
+def _find_timeseries_data_paths(f, group_path: str) -> List[str]:
     import lindi
     grp = f[group_path]
     if 'data' in grp:
         if 'timestamps' in grp or 'start_time' in grp:
             print(f'Timeseries {group_path}')
-            handle_multiscale_downsampling_dataset(f, _join(group_path, 'data'))
-            return
-    for key in f[group_path].keys():
+            return [_join(group_path, 'data')]
+    ret = []
+    for key in grp.keys():
         path2 = _join(group_path, key)
-        if isinstance(f[group_path + key], lindi.LindiH5pyGroup):
-            handle_multiscale_downsampling(f, path2)
+        if isinstance(f[path2], lindi.LindiH5pyGroup):
+            ret.extend(_find_timeseries_data_paths(f, path2))
+    return ret
+
 
 def _join(a: str, b: str):
     if a.endswith('/'):
@@ -67,14 +101,11 @@ def _join(a: str, b: str):
         return a + '/' + b
 
 
-def handle_multiscale_downsampling_dataset(f, path: str):
+def handle_multiscale_downsampling_dataset(f_in, f_out, path: str, *, write_lock: threading.Lock):
     import lindi
-    import numpy as np
-    f2: lindi.LindiH5pyFile = f
-    ds = f2[path]
+    ds = f_in[path]
     assert isinstance(ds, lindi.LindiH5pyDataset)
 
-    chunk_size_mb = 8
     chunk_size_bytes = chunk_size_mb * 1000 * 1000
     shape = ds.shape
     dtype = np.dtype(ds.dtype)
@@ -93,78 +124,115 @@ def handle_multiscale_downsampling_dataset(f, path: str):
     chunk_num_timepoints = int(chunk_size_bytes / bytes_per_element / N2)
     if chunk_num_timepoints < 1:
         return
-    input_path = path
+
+    # The levels: x9 from the data, then x3 from the previous level, as long
+    # as the input of the level has at least one chunk
+    levels: List[_MinMaxLevel] = []
     input_ds_factor = 1
     output_ds_factor = 9
-    while True:
-        ds_num_timepoints = N1 // input_ds_factor
-        if ds_num_timepoints < chunk_num_timepoints:
-            break
+    while N1 // input_ds_factor >= chunk_num_timepoints:
         output_path = path + f'_ds_{output_ds_factor}'
         print(f'Creating dataset: {output_path}')
-        handle_multiscale_downsampling_dataset_2d(
-            f=f,
-            input_path=input_path,
-            input_ds_factor=input_ds_factor,
-            output_path=output_path,
-            output_ds_factor=output_ds_factor,
-            chunk_num_timepoints=chunk_num_timepoints
-        )
-        input_path = output_path
+        output_shape = (N1 // output_ds_factor, N2, 2)  # 2 is for the min and max
+        with write_lock:
+            output_dataset = f_out.create_dataset(output_path, dtype=dtype, shape=output_shape, chunks=(chunk_num_timepoints, N2))
+        levels.append(_MinMaxLevel(
+            output_dataset,
+            relative_ds_factor=output_ds_factor // input_ds_factor,
+            input_has_min_max=input_ds_factor > 1,
+            chunk_num_timepoints=chunk_num_timepoints,
+            write_lock=write_lock
+        ))
         input_ds_factor = output_ds_factor
         output_ds_factor = output_ds_factor * 3
+    if len(levels) == 0:
+        return
 
-
-def handle_multiscale_downsampling_dataset_2d(
-    f,
-    input_path: str,
-    input_ds_factor: int,
-    output_path: str,
-    output_ds_factor: int,
-    chunk_num_timepoints: int
-):
-    import lindi
-    f2: lindi.LindiH5pyFile = f
-    input_dataset = f2[input_path]
-    assert isinstance(input_dataset, lindi.LindiH5pyDataset)
-
-    dtype = input_dataset.dtype
-    num_channels = input_dataset.shape[1] if len(input_dataset.shape) > 1 else 1
-    num_input_timepoints = input_dataset.shape[0] if len(input_dataset.shape) > 0 else 1
-    relative_ds_factor = output_ds_factor // input_ds_factor
-    if input_ds_factor * relative_ds_factor != output_ds_factor:
-        raise Exception(f'Unexpected: input_ds_factor * relative_ds_factor != output_ds_factor :: {input_ds_factor} * {relative_ds_factor} != {output_ds_factor}')
-    num_output_timepoints = num_input_timepoints // relative_ds_factor  # note that we round down, but that's okay for visualization (I think)
-
-    output_shape = (num_output_timepoints, num_channels, 2)  # 2 is for the min and max
-
-    chunk_shape = (chunk_num_timepoints, num_channels)
-    output_dataset = f2.create_dataset(output_path, dtype=dtype, shape=output_shape, chunks=chunk_shape)
-
-    # we need to round up for the number of chunks
-    num_chunks = (num_output_timepoints + chunk_num_timepoints - 1) // chunk_num_timepoints
-
-    input_has_min_max = len(input_dataset.shape) == 3 and input_dataset.shape[2] == 2
-
-    for ii in range(num_chunks):
-        print(f'Processing chunk {ii + 1} of {num_chunks}')
-        output_start = ii * chunk_num_timepoints
-        output_end = min((ii + 1) * chunk_num_timepoints, num_output_timepoints)
-        input_start = output_start * relative_ds_factor
-        input_end = output_end * relative_ds_factor
-        input_data = np.array(input_dataset[input_start:input_end])
-        if input_has_min_max:
-            input_data_min = np.min(input_data[:, :, 0].reshape(output_end - output_start, num_channels), axis=1)
-            input_data_max = np.max(input_data[:, :, 1].reshape(output_end - output_start, num_channels), axis=1)
-            output_data = np.zeros((output_end - output_start, num_channels, 2), dtype=dtype)
-            output_data[:, :, 0] = input_data_min
-            output_data[:, :, 1] = input_data_max
-            output_dataset[output_start:output_end] = output_data
+    # a multiple of 9 so that the source chunks reduce without leftover
+    read_num_timepoints = max(9, chunk_num_timepoints // 9 * 9)
+    # only the timepoints that contribute to the first level
+    num_timepoints_to_read = N1 // 9 * 9
+    num_chunks = (num_timepoints_to_read + read_num_timepoints - 1) // read_num_timepoints
+    for ii, data in enumerate(_iter_chunks_with_prefetch(ds, num_timepoints_to_read, read_num_timepoints)):
+        print(f'{path}: processing chunk {ii + 1} of {num_chunks}')
+        rows = data.reshape(data.shape[0], N2)
+        for level in levels:
+            rows = level.append(rows)
+    for level in levels:
+        level.finalize()
+
+
+def _iter_chunks_with_prefetch(ds, num_timepoints: int, chunk_num_timepoints: int):
+    """The chunks ds[i:i + chunk_num_timepoints], reading the next one in the background"""
+    from concurrent.futures import ThreadPoolExecutor
+    starts = list(range(0, num_timepoints, chunk_num_timepoints))
+
+    def read_chunk(start: int):
+        return np.array(ds[start:min(start + chunk_num_timepoints, num_timepoints)])
+
+    if len(starts) == 0:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(read_chunk, starts[0])
+        for ii in range(len(starts)):
+            data = future.result()
+            if ii + 1 < len(starts):
+                future = executor.submit(read_chunk, starts[ii + 1])
+            yield data
+
+
+class _MinMaxLevel:
+    """One level of the min/max pyramid of a timeseries
+
+    The rows of the level below (or of the data) are reduced in groups of
+    relative_ds_factor as they come (the rows left over wait for the next
+    chunk), and written to the dataset in whole chunks.
+    """
+    def __init__(self, ds, *, relative_ds_factor: int, input_has_min_max: bool, chunk_num_timepoints: int, write_lock: threading.Lock):
+        self._ds = ds
+        self._relative_ds_factor = relative_ds_factor
+        self._input_has_min_max = input_has_min_max
+        self._chunk_num_timepoints = chunk_num_timepoints
+        self._write_lock = write_lock
+        self._leftover: Union[np.ndarray, None] = None
+        self._buffer: List[np.ndarray] = []
+        self._num_buffered_rows = 0
+        self._num_written_rows = 0
+
+    def append(self, rows: np.ndarray) -> np.ndarray:
+        """Append rows of the level below and return the rows of this level (n x num_channels x 2)"""
+        if self._leftover is not None:
+            rows = np.concatenate([self._leftover, rows], axis=0)
+        r = self._relative_ds_factor
+        n = rows.shape[0] // r
+        self._leftover = rows[n * r:] if n * r < rows.shape[0] else None
+        num_channels = rows.shape[1]
+        if self._input_has_min_max:
+            input_min = rows[:n * r, :, 0].reshape(n, r, num_channels)
+            input_max = rows[:n * r, :, 1].reshape(n, r, num_channels)
         else:
-            input_data_reshaped = input_data.reshape(output_start - output_end, relative_ds_factor, num_channels)
-            output_data_min = np.min(input_data_reshaped, axis=1).reshape(output_end - output_start, num_channels)
-            output_data_max = np.max(input_data_reshaped, axis=1).reshape(output_end - output_start, num_channels)
-            output_data = np.zeros((output_end - output_start, num_channels, 2), dtype=dtype)
-            output_data[:, :, 0] = output_data_min
-            output_data[:, :, 1] = output_data_max
-            output_dataset[output_start:output_end] = output_data
+            input_min = input_max = rows[:n * r].reshape(n, r, num_channels)
+        output_rows = np.empty((n, num_channels, 2), dtype=rows.dtype)
+        np.min(input_min, axis=1, out=output_rows[:, :, 0])
+        np.max(input_max, axis=1, out=output_rows[:, :, 1])
+        self._buffer.append(output_rows)
+        self._num_buffered_rows += n
+        if self._num_buffered_rows >= self._chunk_num_timepoints:
+            self._write(num_rows=self._num_buffered_rows // self._chunk_num_timepoints * self._chunk_num_timepoints)
+        return output_rows
+
+    def finalize(self):
+        self._write(num_rows=self._num_buffered_rows)
+        if self._num_written_rows != self._ds.shape[0]:
+            raise Exception(f'Unexpected number of rows written to {self._ds.name}: {self._num_written_rows} != {self._ds.shape[0]}')
+
+    def _write(self, *, num_rows: int):
+        if num_rows == 0:
+            return
+        buffered = np.concatenate(self._buffer, axis=0) if len(self._buffer) > 1 else self._buffer[0]
+        i = self._num_written_rows
+        with self._write_lock:
+            self._ds[i:i + num_rows] = buffered[:num_rows]
+        self._num_written_rows += num_rows
+        self._buffer = [buffered[num_rows:]]
+        self._num_buffered_rows -= num_rows
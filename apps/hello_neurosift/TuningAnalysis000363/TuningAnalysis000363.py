@@ -42,6 +42,7 @@ class TuningAnalysis000363(ProcessorBase):
         from qfc.codecs import QFCCodec
         from .behavior_signal_processing import BehaviorFun, FilterFun, Utils
         from .phase_tuning import compute_phase_tuning
+        from helpers.ragged_spike_trains import RaggedSpikeTrains
         from scipy.ndimage import label, find_objects
 
         QFCCodec.register_codec()
@@ -72,20 +73,11 @@ class TuningAnalysis000363(ProcessorBase):
         else:
             input_f = lindi.LindiH5pyFile.from_hdf5_file(url)
 
-        # # Load the spike data
-        spike_times: np.ndarray = input_f[f"{units_path}/spike_times"][()]  # type: ignore
-        spike_times_index: np.ndarray = input_f[f"{units_path}/spike_times_index"][()]  # type: ignore
-        # spike_trains = []
-        # offset = 0
-        # for i in range(len(spike_times_index)):
-        #     st = spike_times[offset:int(spike_times_index[i])]
-        #     # exclude the NaN from the spike times
-        #     st = st[~np.isnan(st)]
-        #     spike_trains.append(st)
-        #     offset = int(spike_times_index[i])
-        num_units = len(spike_times_index)
+        # Load the spike data
+        spike_trains = RaggedSpikeTrains.from_units_table(input_f, units_path)
+        num_units = spike_trains.num_units
         print(f"Number of units: {num_units}")
-        print(f"Total number of spikes: {len(spike_times)}")
+        print(f"Total number of spikes: {spike_trains.num_spikes}")
 
         print("Creating output LINDI file")
         url = input.get_url()
@@ -192,7 +184,7 @@ class TuningAnalysis000363(ProcessorBase):
 
             print("Computing phase tuning")
             _, phase_stats = compute_phase_tuning(
-                phase, behavior_timestamps, spike_times, spike_times_index, epoch_slices
+                phase, behavior_timestamps, spike_trains, epoch_slices
             )
             phase_mean = [x[0] for x in phase_stats]
             phase_var = [x[1] for x in phase_stats]
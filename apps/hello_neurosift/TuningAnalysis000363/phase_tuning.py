@@ -1,5 +1,6 @@
 import numpy as np
 from scipy.stats import circmean, circstd
+from helpers.ragged_spike_trains import RaggedSpikeTrains
 
 
 def rayleigh_test(phases):
@@ -21,7 +22,7 @@ def rayleigh_test(phases):
 
     return p_value
 
-def compute_phase_tuning(b_phase, b_timestamps, spike_times, spike_times_index, epochs):
+def compute_phase_tuning(b_phase, b_timestamps, spike_trains: RaggedSpikeTrains, epochs):
     """
     Compute the tuning of each unit to the phase of body-part movement (e.g., jaw tracking signal)
     across all valid epochs (aggregated epochs).
@@ -31,10 +32,8 @@ def compute_phase_tuning(b_phase, b_timestamps, spike_times, spike_times_index,
         The phase of the behavior signal.
     - b_timestamps: np.ndarray
         The timestamps of the behavioral data, needed for spike time alignment.
-    - spike_times: np.ndarray
+    - spike_trains: RaggedSpikeTrains
         The spike times for all units.
-    - spike_times_index: np.ndarray
-        Index pointing to the spikes for each unit.
     - epochs: list of slice objects
         Slices corresponding to the valid epochs from which to aggregate data.
         This is typically computed from a combined mask of behavior of interest (e.g., movement epochs) and ephys (e.g., correct trials). e.g.:
@@ -51,48 +50,32 @@ def compute_phase_tuning(b_phase, b_timestamps, spike_times, spike_times_index,
     # Initialize result structures
     phase_stats = []
     phase_tuning = []
-    num_units = len(spike_times_index)
+    num_units = spike_trains.num_units
     num_bins = 32  # Number of phase bins (equivalent to pi/16 radians)
 
-    # Loop through each unit
-    for unit_num in range(num_units):
-        # Extract spike times for the unit
-        spike_times_index_with_zero_prepended = np.concatenate(([0], spike_times_index))
-        unit_spike_times = spike_times[spike_times_index_with_zero_prepended[unit_num]:spike_times_index_with_zero_prepended[unit_num + 1]]
-
-        # Initialize lists to aggregate spike times and corresponding phases
-        unit_tuning = []
-        aggregated_spike_phases = []
+    # Find the spikes (of all the units at once) that occur during the epochs
+    spike_inds = _get_spike_indices_in_epochs(spike_trains.values, b_timestamps, epochs)
+    spike_units = spike_trains.unit_indices()[spike_inds]
 
-        # Process all epochs and aggregate spike phases
-        for epoch in epochs:
-            # Extract the start and stop times of the epoch
-            epoch_start_time = b_timestamps[epoch.start]
-            epoch_stop_time = b_timestamps[epoch.stop - 1]  # last index in slice
+    # Convert spike times to corresponding indices in the behavioral data
+    # and get the behavioral phase values at the spike times
+    all_spike_phases = b_phase[np.searchsorted(b_timestamps, spike_trains.values[spike_inds])]
 
-            # Find spikes that occur during the epoch
-            spikes_in_epoch = (unit_spike_times >= epoch_start_time) & (unit_spike_times <= epoch_stop_time)
-            if np.sum(spikes_in_epoch) == 0:
-                continue
+    # Group the phases by unit
+    order = np.argsort(spike_units, kind='stable')
+    all_spike_phases = all_spike_phases[order]
+    unit_offsets = np.concatenate([[0], np.cumsum(np.bincount(spike_units, minlength=num_units))])
 
-            # Get the spike times that occurred within this epoch
-            spike_times_in_epoch = unit_spike_times[spikes_in_epoch]
-
-            # Convert spike times to corresponding indices in the behavioral data
-            spike_indices = np.searchsorted(b_timestamps, spike_times_in_epoch)
-
-            # Get the behavioral phase values at the spike times and aggregate
-            spike_phases = b_phase[spike_indices]
-            aggregated_spike_phases.extend(spike_phases)
+    # Loop through each unit
+    for unit_num in range(num_units):
+        unit_tuning = []
+        aggregated_spike_phases = all_spike_phases[unit_offsets[unit_num]:unit_offsets[unit_num + 1]]
 
         if len(aggregated_spike_phases) == 0:
             phase_stats.append((np.nan, np.nan, np.nan))
             phase_tuning.append([])
             continue  # Skip if no spikes in all epochs
 
-        # Convert to a numpy array for further analysis
-        aggregated_spike_phases = np.array(aggregated_spike_phases)
-
         # Compute histogram of phases for spiking events
         edges = np.linspace(-np.pi, np.pi, num_bins + 1)
         # centers = (edges[:-1] + edges[1:]) / 2
@@ -119,3 +102,27 @@ def compute_phase_tuning(b_phase, b_timestamps, spike_times, spike_times_index,
         phase_tuning.append(unit_tuning)
 
     return phase_tuning, phase_stats
+
+
+def _get_spike_indices_in_epochs(spike_times, b_timestamps, epochs):
+    """
+    Indices of the spikes within the epochs (start and stop times inclusive),
+    epoch by epoch. A spike in several epochs is repeated.
+    """
+    if len(epochs) == 0:
+        return np.zeros((0,), dtype=np.int64)
+    epoch_start_times = np.array([b_timestamps[epoch.start] for epoch in epochs])
+    epoch_stop_times = np.array([b_timestamps[epoch.stop - 1] for epoch in epochs])  # last index in slice
+    if np.all(epoch_start_times <= epoch_stop_times) and np.all(epoch_start_times[1:] > epoch_stop_times[:-1]):
+        # Sorted and disjoint epochs (as from find_objects): the epoch of each
+        # spike is found with a single searchsorted
+        epoch_inds = np.searchsorted(epoch_start_times, spike_times, side='right') - 1
+        in_epoch = epoch_inds >= 0
+        in_epoch[in_epoch] = spike_times[in_epoch] <= epoch_stop_times[epoch_inds[in_epoch]]
+        spike_inds = np.nonzero(in_epoch)[0]
+        # epoch by epoch
+        return spike_inds[np.argsort(epoch_inds[spike_inds], kind='stable')]
+    return np.concatenate([
+        np.nonzero((spike_times >= epoch_start_time) & (spike_times <= epoch_stop_time))[0]
+        for epoch_start_time, epoch_stop_time in zip(epoch_start_times, epoch_stop_times)
+    ])
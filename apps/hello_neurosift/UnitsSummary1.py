@@ -25,7 +25,8 @@ class UnitsSummary1(ProcessorBase):
     ):
         import lindi
         import numpy as np
-        from helpers.compute_correlogram_data import compute_correlogram_data
+        from helpers.compute_correlogram_data import compute_autocorrelograms
+        from helpers.ragged_spike_trains import RaggedSpikeTrains
 
         units_path = context.units_path
         correlogram_window_size_msec = context.correlogram_window_size_msec
@@ -40,55 +41,28 @@ class UnitsSummary1(ProcessorBase):
         else:
             f = lindi.LindiH5pyFile.from_hdf5_file(url)
 
-        # Load the spike data
-        spike_times: np.ndarray = f[f'{units_path}/spike_times'][()]  # type: ignore
-        spike_times_index: np.ndarray = f[f'{units_path}/spike_times_index'][()]  # type: ignore
-        spike_trains = []
-        offset = 0
-        for i in range(len(spike_times_index)):
-            st = spike_times[offset:int(spike_times_index[i])]
-            # exclude the NaN from the spike times
-            st = st[~np.isnan(st)]
-            spike_trains.append(st)
-            offset = int(spike_times_index[i])
-        num_units = len(spike_trains)
+        # Load the spike data (excluding the NaN from the spike times)
+        spike_trains = RaggedSpikeTrains.from_units_table(f, units_path)
+        num_units = spike_trains.num_units
         unit_ids = f[f'{units_path}/id'][()]  # type: ignore
 
-        # Compute autocorrelograms for all the units
-        print('Computing autocorrelograms')
-        auto_correlograms = []
-        p = 0
+        # Compute autocorrelograms for all the units (in parallel across
+        # processes for large units tables)
+        print(f'Computing autocorrelograms for {num_units} units ({spike_trains.num_spikes} spikes)')
         timer = time.time()
-        for i in range(num_units):
-            spike_train = spike_times[p:spike_times_index[i]]
-            elapsed = time.time() - timer
-            if elapsed > 2:
-                print(f'Computing autocorrelogram for unit {i + 1} of {num_units} ({len(spike_train)} spikes)')
-                timer = time.time()
-            r = compute_correlogram_data(
-                spike_train_1=spike_train,
-                spike_train_2=None,
-                window_size_msec=correlogram_window_size_msec,
-                bin_size_msec=correlogram_bin_size_msec
-            )
-            bin_edges_sec = r['bin_edges_sec']
-            bin_counts = r['bin_counts']
-            auto_correlograms.append({
-                'bin_edges_sec': bin_edges_sec,
-                'bin_counts': bin_counts
-            })
-            p = spike_times_index[i]
-        num_bins = len(auto_correlograms[0]['bin_counts'])
-        autocorrelograms_array = np.zeros(
-            (num_units, num_bins),
-            dtype=np.uint32
+        r = compute_autocorrelograms(
+            spike_trains.to_list(),
+            window_size_msec=correlogram_window_size_msec,
+            bin_size_msec=correlogram_bin_size_msec
         )
-        for i, ac in enumerate(auto_correlograms):
-            autocorrelograms_array[i, :] = ac['bin_counts']
+        print(f'Computed autocorrelograms in {time.time() - timer:.1f} seconds')
+        bin_edges_sec = r['bin_edges_sec']
+        autocorrelograms_array = r['bin_counts'].astype(np.uint32)
+        num_bins = autocorrelograms_array.shape[1]
 
         with lindi.LindiH5pyFile.from_lindi_file('units_summary.lindi.tar', mode='w') as f:
             x = f.create_dataset('autocorrelograms', data=autocorrelograms_array)
-            x.attrs['bin_edges_sec'] = auto_correlograms[0]['bin_edges_sec']
+            x.attrs['bin_edges_sec'] = bin_edges_sec
             f.attrs['correlogram_window_size_msec'] = correlogram_window_size_msec
             f.attrs['correlogram_bin_size_msec'] = correlogram_bin_size_msec
             f.attrs['correlogram_num_bins'] = num_bins
@@ -0,0 +1,164 @@
+from typing import Union
+import os
+import time
+import numpy as np
+
+
+# Estimated firing rates and power spectra of all the channels of a recording,
+# computed in a single pass over the recording:
+# * the chunks of traces are fetched (and filtered, for a preprocessed
+#   recording) in a pool of threads, ahead of the processing
+# * the spike detection is done for all the channels at once, including the
+#   refractory deduplication of the threshold crossings (see
+#   _count_deduplicated_crossings)
+# * the spectra are computed with one rfft along the time axis for a block of
+#   channels, and only the subsampled frequencies are accumulated
+# The results are the same as those of the previous per-channel loops
+# (up to the rounding of rfft vs fft).
+
+chunk_duration_sec = 5
+# threshold crossings within this number of frames of the previous detected
+# spike are not counted
+detect_threshold = 5
+detect_interval = 20
+# number of power spectrum frequencies in the output (approximately)
+num_output_freqs = 1000
+# bound on the size of the rfft output for a block of channels
+_max_fft_bytes = 256 * 1000 * 1000
+
+
+def compute_channel_summary(recording, *, num_workers: Union[int, None] = None):
+    """Estimated channel firing rates and channel power spectra
+
+    Returns a dict with estimated_channel_firing_rates (num_channels),
+    ps_freq (num_freqs) and ps (num_channels x num_freqs), averaged over the
+    chunks of chunk_duration_sec of the recording.
+    """
+    R = recording
+    sampling_frequency = R.get_sampling_frequency()
+    num_channels = R.get_num_channels()
+    chunk_duration_frames = int(chunk_duration_sec * sampling_frequency)
+    num_chunks = int(R.get_num_frames() / chunk_duration_frames)
+    freqs = np.fft.fftfreq(chunk_duration_frames, 1 / sampling_frequency)
+    freqs = freqs[:int(chunk_duration_frames / 2)]
+    # subsample to num_output_freqs points
+    freq_step = max(1, int(len(freqs) / num_output_freqs))
+    freq_inds = np.arange(0, len(freqs), freq_step)
+
+    firing_rates_sum = np.zeros((num_channels,))
+    ps_sum = np.zeros((num_channels, len(freq_inds)))
+    timestamp_last_print = time.time()
+    for ss, traces in enumerate(_iter_traces_chunks(R, num_chunks=num_chunks, chunk_duration_frames=chunk_duration_frames, num_workers=num_workers)):
+        elapsed_since_last_print = time.time() - timestamp_last_print
+        if elapsed_since_last_print > 10:
+            print(f'Computing channel summary: {ss} of {num_chunks} time chunks')
+            timestamp_last_print = time.time()
+        firing_rates_sum += estimate_channel_num_spikes(traces) / chunk_duration_sec
+        ps_sum += _compute_power_spectra(traces, freq_inds=freq_inds)
+    if num_chunks == 0:
+        # the recording is shorter than one chunk
+        firing_rates_sum[:] = np.nan
+        ps_sum[:] = np.nan
+        num_chunks = 1
+    return {
+        'estimated_channel_firing_rates': firing_rates_sum / num_chunks,
+        'ps_freq': freqs[freq_inds],
+        'ps': ps_sum / num_chunks
+    }
+
+
+def estimate_channel_num_spikes(traces: np.ndarray) -> np.ndarray:
+    """Number of detected spikes on each channel of traces (num_frames x num_channels)
+
+    Each channel is normalized, the spikes are the crossings below
+    -detect_threshold (spikes are assumed negative), and the crossings within
+    detect_interval frames of the previous counted spike are not counted.
+    """
+    # channels as contiguous rows, so the mean and std of each channel are
+    # computed as for a single trace
+    X = np.ascontiguousarray(traces.T)
+    X = X - np.mean(X, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X = X / np.std(X, axis=1, keepdims=True)
+    channels, times = np.nonzero(X < -detect_threshold)
+    return _count_deduplicated_crossings(channels, times, num_channels=X.shape[0], num_frames=X.shape[1])
+
+
+def estimate_num_spikes(trace: np.ndarray) -> int:
+    return int(estimate_channel_num_spikes(trace.reshape(-1, 1))[0])
+
+
+def _count_deduplicated_crossings(channels: np.ndarray, times: np.ndarray, *, num_channels: int, num_frames: int) -> np.ndarray:
+    """Number of crossings of each channel that are counted
+
+    On each channel, the first crossing is counted, then the first crossing
+    more than detect_interval frames after the last counted one, and so on.
+    For each crossing, the next one that would be counted after it is found
+    with searchsorted, and the number of crossings counted from each
+    crossing (the length of the chain of next ones) is computed for all the
+    crossings at once by pointer jumping (log of the chain length steps).
+    """
+    counts = np.zeros((num_channels,), dtype=np.int64)
+    n = len(times)
+    if n == 0:
+        return counts
+    # one sorted key per crossing (by channel, then time)
+    keys = channels.astype(np.int64) * num_frames + times
+    next_inds = np.searchsorted(keys, keys + detect_interval, side='right')
+    # index n is the end of the chains, including at the end of a channel
+    valid = next_inds < n
+    same_channel = np.zeros((n,), dtype=bool)
+    same_channel[valid] = channels[next_inds[valid]] == channels[valid]
+    next_inds[~same_channel] = n
+    next_inds = np.append(next_inds, n)
+    chain_lengths = np.append(np.ones((n,), dtype=np.int64), 0)
+    while np.any(next_inds[:n] < n):
+        chain_lengths[:n] += chain_lengths[next_inds[:n]]
+        next_inds[:n] = next_inds[next_inds[:n]]
+    # the chain of each channel starts at its first crossing
+    first_inds = np.searchsorted(channels, np.arange(num_channels), side='left')
+    has_crossings = np.bincount(channels, minlength=num_channels) > 0
+    counts[has_crossings] = chain_lengths[first_inds[has_crossings]]
+    return counts
+
+
+def _compute_power_spectra(traces: np.ndarray, *, freq_inds: np.ndarray) -> np.ndarray:
+    """|fft|^2 of each channel at freq_inds (num_channels x len(freq_inds))"""
+    num_frames, num_channels = traces.shape
+    ret = np.zeros((num_channels, len(freq_inds)))
+    block_size = max(1, _max_fft_bytes // (16 * (num_frames // 2 + 1)))
+    for c1 in range(0, num_channels, block_size):
+        c2 = min(c1 + block_size, num_channels)
+        F = np.fft.rfft(traces[:, c1:c2], axis=0)
+        ret[c1:c2, :] = (np.abs(F[freq_inds, :]) ** 2).T
+    return ret
+
+
+def _iter_traces_chunks(recording, *, num_chunks: int, chunk_duration_frames: int, num_workers: Union[int, None]):
+    """The chunks of traces in order, fetched ahead in a pool of threads"""
+    from concurrent.futures import ThreadPoolExecutor
+    if num_workers is None:
+        num_workers = min(4, _get_num_available_cpus())
+
+    def get_chunk(ss: int):
+        return recording.get_traces(start_frame=int(ss * chunk_duration_frames), end_frame=int((ss + 1) * chunk_duration_frames))
+
+    if num_workers <= 1:
+        for ss in range(num_chunks):
+            yield get_chunk(ss)
+        return
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # at most num_workers chunks are fetched ahead (memory)
+        futures = {}
+        for ss in range(num_chunks):
+            for ss2 in range(ss, min(ss + num_workers + 1, num_chunks)):
+                if ss2 not in futures:
+                    futures[ss2] = executor.submit(get_chunk, ss2)
+            yield futures.pop(ss).result()
+
+
+def _get_num_available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
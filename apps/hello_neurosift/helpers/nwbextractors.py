@@ -10,6 +10,8 @@ from spikeinterface import get_global_tmp_folder
 from spikeinterface.core import BaseRecording, BaseRecordingSegment, BaseSorting, BaseSortingSegment
 from spikeinterface.core.core_tools import define_function_from_class
 
+from .ragged_spike_trains import RaggedSpikeTrains
+
 
 def read_file_from_backend(
     *,
@@ -1367,10 +1369,18 @@ class NwbSortingSegment(BaseSortingSegment):
         BaseSortingSegment.__init__(self)
         self.spike_times_data = spike_times_data
         self.spike_times_index_data = spike_times_index_data
-        self.spike_times_data = spike_times_data
-        self.spike_times_index_data = spike_times_index_data
         self._sampling_frequency = sampling_frequency
         self._t_start = t_start
+        # the spike trains of all the units, read at the first request rather
+        # than one slice of the (possibly remote) datasets per unit
+        self._spike_trains: Optional[RaggedSpikeTrains] = None
+
+    def _get_spike_trains(self) -> RaggedSpikeTrains:
+        if self._spike_trains is None:
+            self._spike_trains = RaggedSpikeTrains.from_nwb_index(
+                self.spike_times_data[:], self.spike_times_index_data[:]
+            )
+        return self._spike_trains
 
     def get_unit_spike_train(
         self,
@@ -1380,12 +1390,7 @@ class NwbSortingSegment(BaseSortingSegment):
     ) -> np.ndarray:
         # Extract the spike times for the unit
         unit_index = self.parent_extractor.id_to_index(unit_id)
-        if unit_index == 0:
-            start_index = 0
-        else:
-            start_index = self.spike_times_index_data[unit_index - 1]
-        end_index = self.spike_times_index_data[unit_index]
-        spike_times = self.spike_times_data[start_index:end_index]
+        spike_times = self._get_spike_trains()[unit_index]
 
         # Transform spike times to frames and subset
         frames = np.round((spike_times - self._t_start) * self._sampling_frequency)
@@ -0,0 +1,216 @@
+from typing import List, Union
+import numpy as np
+
+
+# The spike trains of all the units of a units table in one flat array of
+# spike times plus an array of offsets (CSR layout), as they are stored in NWB
+# (spike_times / spike_times_index). The spikes of unit i are
+# values[offsets[i]:offsets[i + 1]], so the per-unit arrays are views rather
+# than copies, and the operations over all the units (NaN filtering, binning,
+# counts, time windows) are vectorized over the flat array instead of looping
+# over the units in Python.
+#
+# Binning over long sessions is done chunk by chunk in time (iter_bin_counts),
+# so the memory is bounded by a chunk plus the spikes rather than by the
+# dense (num_bins x num_units) counts.
+#
+# Note: this module is duplicated in the apps that use it (each app has its own
+# docker image), so keep the copies in sync.
+
+# number of (bin, unit) entries per chunk when binning
+_max_entries_per_chunk = 5_000_000
+
+
+class RaggedSpikeTrains:
+    def __init__(self, values: np.ndarray, offsets: np.ndarray):
+        """Spike trains of num_units units
+
+        values: spike times (sec) of all the units, concatenated
+        offsets: (num_units + 1) start of the spikes of each unit in values
+        """
+        values = np.asarray(values)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if offsets.ndim != 1 or len(offsets) == 0 or offsets[0] != 0 or offsets[-1] != len(values):
+            raise Exception('Invalid offsets for ragged spike trains')
+        if np.any(offsets[1:] < offsets[:-1]):
+            raise Exception('Offsets of ragged spike trains must be non-decreasing')
+        self.values = values
+        self.offsets = offsets
+
+    @staticmethod
+    def from_nwb_index(spike_times: np.ndarray, spike_times_index: np.ndarray, *, drop_nan: bool = True):
+        """From the spike_times and spike_times_index columns of an NWB units table
+
+        spike_times_index holds the end of the spikes of each unit
+        """
+        spike_times_index = np.asarray(spike_times_index, dtype=np.int64)
+        offsets = np.concatenate([np.zeros((1,), dtype=np.int64), spike_times_index])
+        # the index may end before the end of the data
+        values = np.asarray(spike_times)[:int(offsets[-1])]
+        ret = RaggedSpikeTrains(values, offsets)
+        if drop_nan:
+            ret = ret.drop_nan()
+        return ret
+
+    @staticmethod
+    def from_units_table(f, units_path: str, *, drop_nan: bool = True):
+        """Load the spike trains of a units table of an open NWB file (h5py-like)"""
+        spike_times = f[f'{units_path}/spike_times'][()]
+        spike_times_index = f[f'{units_path}/spike_times_index'][()]
+        return RaggedSpikeTrains.from_nwb_index(spike_times, spike_times_index, drop_nan=drop_nan)
+
+    @staticmethod
+    def from_list(spike_trains: List[np.ndarray]):
+        counts = [len(st) for st in spike_trains]
+        offsets = np.concatenate([np.zeros((1,), dtype=np.int64), np.cumsum(counts, dtype=np.int64)])
+        values = np.concatenate(spike_trains) if len(spike_trains) > 0 else np.zeros((0,))
+        return RaggedSpikeTrains(values, offsets)
+
+    @property
+    def num_units(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def num_spikes(self) -> int:
+        return len(self.values)
+
+    def __len__(self):
+        return self.num_units
+
+    def __getitem__(self, unit_index: int) -> np.ndarray:
+        """Spike times of a unit (a view into values)"""
+        if unit_index < 0:
+            unit_index += self.num_units
+        if unit_index < 0 or unit_index >= self.num_units:
+            raise IndexError(f'Unit index out of range: {unit_index}')
+        return self.values[self.offsets[unit_index]:self.offsets[unit_index + 1]]
+
+    def __iter__(self):
+        for i in range(self.num_units):
+            yield self[i]
+
+    def to_list(self) -> List[np.ndarray]:
+        return list(self)
+
+    def counts(self) -> np.ndarray:
+        """Number of spikes of each unit"""
+        return np.diff(self.offsets)
+
+    def rates(self, *, start_time_sec: float, end_time_sec: float) -> np.ndarray:
+        """Firing rate (Hz) of each unit over the time range"""
+        return self.counts() / (end_time_sec - start_time_sec)
+
+    def unit_indices(self) -> np.ndarray:
+        """Unit index of each spike in values"""
+        return np.repeat(np.arange(self.num_units, dtype=np.int64), self.counts())
+
+    def max_time(self) -> float:
+        if self.num_spikes == 0:
+            raise Exception('No spikes')
+        return float(np.max(self.values))
+
+    def select(self, mask: np.ndarray):
+        """Keep the spikes where mask (over values) is True"""
+        num_kept_before = np.concatenate([np.zeros((1,), dtype=np.int64), np.cumsum(mask, dtype=np.int64)])
+        return RaggedSpikeTrains(self.values[mask], num_kept_before[self.offsets])
+
+    def drop_nan(self):
+        mask = ~np.isnan(self.values)
+        if np.all(mask):
+            return self
+        return self.select(mask)
+
+    def time_slice(self, start_time_sec: Union[float, None] = None, end_time_sec: Union[float, None] = None):
+        """The spikes with start_time_sec <= t < end_time_sec"""
+        mask = np.ones(self.values.shape, dtype=bool)
+        if start_time_sec is not None:
+            mask &= self.values >= start_time_sec
+        if end_time_sec is not None:
+            mask &= self.values < end_time_sec
+        return self.select(mask)
+
+    def bin_counts(
+        self,
+        *,
+        start_time_sec: float,
+        end_time_sec: float,
+        num_bins: int,
+        dtype=np.int32
+    ) -> np.ndarray:
+        """Spike counts (num_bins x num_units) in equal bins over the time range
+
+        Same counts as np.histogram(spike_train, bins=num_bins,
+        range=(start_time_sec, end_time_sec)) for each unit (the last bin
+        includes end_time_sec).
+        """
+        ret = np.zeros((num_bins, self.num_units), dtype=dtype)
+        num_bins_per_chunk = max(1, _max_entries_per_chunk // max(1, self.num_units))
+        for first_bin, counts in self.iter_bin_counts(
+            start_time_sec=start_time_sec,
+            end_time_sec=end_time_sec,
+            num_bins=num_bins,
+            num_bins_per_chunk=num_bins_per_chunk,
+            dtype=dtype
+        ):
+            ret[first_bin:first_bin + len(counts)] = counts
+        return ret
+
+    def iter_bin_counts(
+        self,
+        *,
+        start_time_sec: float,
+        end_time_sec: float,
+        num_bins: int,
+        num_bins_per_chunk: int,
+        dtype=np.int32
+    ):
+        """The spike counts of bin_counts, chunk by chunk in time
+
+        Yields (first_bin, counts) where counts is (n x num_units) for the
+        consecutive chunks of num_bins_per_chunk bins (the last one may be
+        shorter), so that the dense counts never need to be in memory at once.
+        """
+        num_units = self.num_units
+        bin_inds = histogram_bin_indices(self.values, num_bins=num_bins, start=start_time_sec, end=end_time_sec)
+        valid = bin_inds >= 0
+        # one key per spike, sorted so that the spikes of a chunk of bins are
+        # a contiguous range, binned with a single bincount per chunk
+        keys = np.sort(bin_inds[valid] * num_units + self.unit_indices()[valid])
+        del bin_inds, valid
+        for first_bin in range(0, num_bins, num_bins_per_chunk):
+            n = min(num_bins_per_chunk, num_bins - first_bin)
+            i1, i2 = np.searchsorted(keys, [first_bin * num_units, (first_bin + n) * num_units])
+            counts = np.bincount(keys[i1:i2] - first_bin * num_units, minlength=n * num_units)
+            yield first_bin, counts.reshape(n, num_units).astype(dtype, copy=False)
+
+
+def histogram_bin_indices(x: np.ndarray, *, num_bins: int, start: float, end: float) -> np.ndarray:
+    """Index of the bin of each value as in np.histogram(x, bins=num_bins, range=(start, end))
+
+    -1 for the values outside of the range (and NaN)
+    """
+    x = np.asarray(x)
+    first_edge, last_edge = float(start), float(end)
+    if first_edge > last_edge:
+        raise Exception('max must be larger than min in range parameter.')
+    if first_edge == last_edge:
+        first_edge = first_edge - 0.5
+        last_edge = last_edge + 0.5
+    # same dtype and edges as in np.histogram
+    bin_type = np.result_type(first_edge, last_edge, x)
+    if np.issubdtype(bin_type, np.integer):
+        bin_type = np.result_type(bin_type, float)
+    bin_edges = np.linspace(first_edge, last_edge, num_bins + 1, endpoint=True, dtype=bin_type)
+    keep = (x >= first_edge) & (x <= last_edge)
+    ret = np.full(x.shape, -1, dtype=np.int64)
+    if num_bins == 0:
+        return ret
+    tmp = x[keep].astype(bin_edges.dtype, copy=False)
+    inds = ((tmp - first_edge) / (last_edge - first_edge) * num_bins).astype(np.int64)
+    inds[inds == num_bins] -= 1
+    # the rounding may be off by one, corrected with the edges
+    inds[tmp < bin_edges[inds]] -= 1
+    increment = (tmp >= bin_edges[inds + 1]) & (inds != num_bins - 1)
+    inds[increment] += 1
+    ret[keep] = inds
+    return ret
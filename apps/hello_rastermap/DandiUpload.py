@@ -121,30 +121,36 @@ def _upload_blob(*, dandiset_id: str, dandiset_version: str, local_filename: str
         return blob_id
     assert upload_id is not None, "Unexpected error: upload_id is None"
     assert parts is not None, "Unexpected error: parts is None"
-    processed_parts = []
+    from dendro.sdk import upload_file_parts, UploadFilePart, clear_upload_progress
+    upload_parts = []
     for part in parts:
-        print(f'Uploading part {part["part_number"]} / {len(parts)} for {local_filename}')
         part_number = part["part_number"]
         etag_part = etagger.get_part(part["part_number"])
         part_size = part["size"]
         if etag_part.size != part_size:
             raise ValueError(f"Part {part_number} is not the expected size: {etag_part.size} != {part_size}")
-        part_upload_url = part["upload_url"]
-        with open(local_filename, "rb") as f:
-            f.seek(etag_part.offset)
-            part_data = f.read(etag_part.size)
-        response = requests.put(part_upload_url, data=part_data)
-        response.raise_for_status()
-        processed_parts.append({
-            "part_number": part_number,
-            "size": part_size,
-            "etag": response.headers["ETag"].strip('"')  # note that this is the server's ETag not the dandi-etag
-        })
+        upload_parts.append(UploadFilePart(
+            part_number=part_number,
+            offset=etag_part.offset,
+            size=part_size,
+            url=part["upload_url"]
+        ))
+    print(f'Uploading {len(parts)} parts for {local_filename}')
+    etags = upload_file_parts(local_filename, upload_parts, upload_id=upload_id)
+    processed_parts = [
+        {
+            "part_number": p.part_number,
+            "size": p.size,
+            "etag": etags[p.part_number].strip('"')  # note that this is the server's ETag not the dandi-etag
+        }
+        for p in upload_parts
+    ]
     print(f'Completing multipart upload for {local_filename}')
     complete_url, response_body = _complete_multipart_upload(upload_id=upload_id, processed_parts=processed_parts, dandi_api_key=dandi_api_key)
     # To actually perform the upload, we need to send a request to the complete_url
     response = requests.post(complete_url, data=response_body)
     response.raise_for_status()
+    clear_upload_progress(local_filename)
 
     # Finally we validate to verify the upload and mint the new asset blob
     print(f'Validating multipart upload for {local_filename}')
@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import numpy as np
+
+# the helpers of the hello_neurosift app (not the helpers in this directory)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'apps', 'hello_neurosift'))
+from helpers.compute_correlogram_data import compute_correlogram_data, compute_autocorrelograms, compute_crosscorrelograms  # noqa: E402
+
+
+# Compares the correlogram engine of apps/hello_neurosift/helpers with the
+# implementation that it replaced (reference_compute_correlogram_data below)
+# on synthetic Poisson spike trains, checking that the counts are identical.
+#
+# Usage:
+#   python benchmark_correlograms.py             # small and medium trains
+#   python benchmark_correlograms.py --large     # also 10^6 spikes per unit
+
+
+def reference_compute_correlogram_data(
+    *,
+    spike_train_1: np.ndarray,
+    spike_train_2=None,
+    window_size_msec: float = 100,
+    bin_size_msec: float = 1
+):
+    # the previous implementation, verbatim
+    times1 = spike_train_1
+    num_bins = int(window_size_msec / bin_size_msec)
+    if num_bins % 2 == 0:
+        num_bins = num_bins - 1  # odd number of bins
+    num_bins_half = int((num_bins + 1) / 2)
+    bin_edges_msec = np.array(
+        (np.arange(num_bins + 1) - num_bins / 2) * bin_size_msec, dtype=np.float32
+    )
+    bin_counts = np.zeros((num_bins,), dtype=np.int32)
+    if spike_train_2 is None:
+        # autocorrelogram
+        offset = 1
+        while True:
+            if offset >= len(times1):
+                break
+            deltas_msec = (times1[offset:] - times1[:-offset]) * 1000
+            deltas_msec = deltas_msec[deltas_msec <= bin_edges_msec[-1]]
+            if len(deltas_msec) == 0:
+                break
+            for i in range(num_bins_half):
+                start_msec = bin_edges_msec[num_bins_half - 1 + i]
+                end_msec = bin_edges_msec[num_bins_half + i]
+                ct = len(
+                    deltas_msec[(start_msec <= deltas_msec) & (deltas_msec < end_msec)]
+                )
+                bin_counts[num_bins_half - 1 + i] += ct
+                bin_counts[num_bins_half - 1 - i] += ct
+            offset = offset + 1
+    else:
+        # cross-correlogram
+        times2 = spike_train_2
+        all_times = np.concatenate((times1, times2))
+        all_labels = np.concatenate(
+            (1 * np.ones(times1.shape), 2 * np.ones(times2.shape))
+        )
+        sort_inds = np.argsort(all_times)
+        all_times = all_times[sort_inds]
+        all_labels = all_labels[sort_inds]
+        offset = 1
+        while True:
+            if offset >= len(all_times):
+                break
+            deltas_msec = (all_times[offset:] - all_times[:-offset]) * 1000
+
+            deltas12_msec = deltas_msec[
+                (all_labels[offset:] == 2) & (all_labels[:-offset] == 1)
+            ]
+            deltas21_msec = deltas_msec[
+                (all_labels[offset:] == 1) & (all_labels[:-offset] == 2)
+            ]
+            deltas11_msec = deltas_msec[
+                (all_labels[offset:] == 1) & (all_labels[:-offset] == 1)
+            ]
+            deltas22_msec = deltas_msec[
+                (all_labels[offset:] == 2) & (all_labels[:-offset] == 2)
+            ]
+
+            deltas12_msec = deltas12_msec[deltas12_msec <= bin_edges_msec[-1]]
+            deltas21_msec = deltas21_msec[deltas21_msec <= bin_edges_msec[-1]]
+            deltas11_msec = deltas11_msec[deltas11_msec <= bin_edges_msec[-1]]
+            deltas22_msec = deltas22_msec[deltas22_msec <= bin_edges_msec[-1]]
+
+            if len(deltas12_msec) + len(deltas21_msec) + len(deltas11_msec) + len(deltas22_msec) == 0:
+                break
+
+            for i in range(num_bins_half):
+                start_msec = bin_edges_msec[num_bins_half - 1 + i]
+                end_msec = bin_edges_msec[num_bins_half + i]
+                ct12 = len(
+                    deltas12_msec[
+                        (start_msec <= deltas12_msec) & (deltas12_msec < end_msec)
+                    ]
+                )
+                ct21 = len(
+                    deltas21_msec[
+                        (start_msec <= deltas21_msec) & (deltas21_msec < end_msec)
+                    ]
+                )
+                bin_counts[num_bins_half - 1 + i] += ct12
+                bin_counts[num_bins_half - 1 - i] += ct21
+            offset = offset + 1
+    return {
+        "bin_edges_sec": (bin_edges_msec / 1000).astype(np.float32),
+        "bin_counts": bin_counts.astype(np.int32),
+    }
+
+
+def poisson_spike_train(*, rate_hz: float, duration_sec: float, rng: np.random.Generator, sampling_frequency: float = 30000):
+    num_spikes = rng.poisson(rate_hz * duration_sec)
+    # spike times on a sampling grid, as in real data, so that there are
+    # exact ties and pairs right on the bin edges
+    frames = np.sort(rng.integers(0, int(duration_sec * sampling_frequency), size=num_spikes))
+    return frames / sampling_frequency
+
+
+def bursty_spike_train(*, burst_rate_hz: float, spikes_per_burst: int, isi_msec: float, duration_sec: float, rng: np.random.Generator, sampling_frequency: float = 30000):
+    # bursts of spikes in quick succession, which make the reference
+    # implementation loop over many offsets
+    burst_starts = poisson_spike_train(rate_hz=burst_rate_hz, duration_sec=duration_sec, rng=rng, sampling_frequency=sampling_frequency)
+    offsets = np.arange(spikes_per_burst) * isi_msec / 1000
+    times = (burst_starts[:, None] + offsets[None, :]).ravel()
+    return np.sort(np.round(times * sampling_frequency) / sampling_frequency)
+
+
+def check_identical(a: dict, b: dict, label: str):
+    assert a['bin_edges_sec'].dtype == b['bin_edges_sec'].dtype, label
+    assert a['bin_counts'].dtype == b['bin_counts'].dtype, label
+    assert np.array_equal(a['bin_edges_sec'], b['bin_edges_sec']), label
+    if not np.array_equal(a['bin_counts'], b['bin_counts']):
+        raise Exception(f'Mismatch for {label}: {np.nonzero(a["bin_counts"] != b["bin_counts"])[0]}')
+
+
+def benchmark_single(*, rate_hz: float, duration_sec: float, window_size_msec: float, bin_size_msec: float, rng: np.random.Generator, bursty: bool = False):
+    if bursty:
+        st1 = bursty_spike_train(burst_rate_hz=rate_hz / 20, spikes_per_burst=20, isi_msec=3, duration_sec=duration_sec, rng=rng)
+        st2 = bursty_spike_train(burst_rate_hz=rate_hz / 20, spikes_per_burst=20, isi_msec=3, duration_sec=duration_sec, rng=rng)
+    else:
+        st1 = poisson_spike_train(rate_hz=rate_hz, duration_sec=duration_sec, rng=rng)
+        st2 = poisson_spike_train(rate_hz=rate_hz, duration_sec=duration_sec, rng=rng)
+    for label, spike_train_2 in [('auto', None), ('cross', st2)]:
+        kwargs = dict(spike_train_1=st1, spike_train_2=spike_train_2, window_size_msec=window_size_msec, bin_size_msec=bin_size_msec)
+        timer = time.time()
+        r_ref = reference_compute_correlogram_data(**kwargs)
+        elapsed_ref = time.time() - timer
+        timer = time.time()
+        r_new = compute_correlogram_data(**kwargs)
+        elapsed_new = time.time() - timer
+        check_identical(r_ref, r_new, f'{label} {len(st1)} spikes')
+        print(f'{label:5s} {len(st1):>8d} {"bursty" if bursty else "Poisson"} spikes, window {window_size_msec:g} ms, bin {bin_size_msec:g} ms: '
+              f'reference {elapsed_ref:.3f} s, new {elapsed_new:.4f} s ({elapsed_ref / max(elapsed_new, 1e-9):.0f}x)')
+
+
+def benchmark_batch(*, num_units: int, rate_hz: float, duration_sec: float, rng: np.random.Generator):
+    spike_trains = [poisson_spike_train(rate_hz=rate_hz, duration_sec=duration_sec, rng=rng) for _ in range(num_units)]
+    num_spikes = sum(len(st) for st in spike_trains)
+    for num_workers in [1, None]:
+        timer = time.time()
+        compute_autocorrelograms(spike_trains, num_workers=num_workers)
+        elapsed = time.time() - timer
+        print(f'autocorrelograms of {num_units} units ({num_spikes} spikes), workers={num_workers or "all"}: {elapsed:.2f} s')
+    pairs = [(i, j) for i in range(min(num_units, 8)) for j in range(min(num_units, 8)) if i != j]
+    timer = time.time()
+    compute_crosscorrelograms(spike_trains, pairs=pairs)
+    elapsed = time.time() - timer
+    print(f'{len(pairs)} cross-correlograms: {elapsed:.2f} s')
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    for rate_hz, duration_sec in [(5, 600), (20, 600), (50, 1200)]:
+        benchmark_single(rate_hz=rate_hz, duration_sec=duration_sec, window_size_msec=100, bin_size_msec=1, rng=rng)
+    benchmark_single(rate_hz=20, duration_sec=600, window_size_msec=50, bin_size_msec=0.5, rng=rng)
+    benchmark_single(rate_hz=20, duration_sec=1200, window_size_msec=500, bin_size_msec=1, rng=rng)
+    benchmark_single(rate_hz=20, duration_sec=1200, window_size_msec=100, bin_size_msec=1, rng=rng, bursty=True)
+    benchmark_batch(num_units=32, rate_hz=20, duration_sec=1200, rng=rng)
+    if '--large' in sys.argv[1:]:
+        # 10^6 spikes per unit
+        benchmark_single(rate_hz=100, duration_sec=10000, window_size_msec=100, bin_size_msec=1, rng=rng)
+        benchmark_single(rate_hz=100, duration_sec=10000, window_size_msec=500, bin_size_msec=1, rng=rng, bursty=True)
+        benchmark_batch(num_units=8, rate_hz=100, duration_sec=10000, rng=rng)
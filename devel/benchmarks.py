@@ -36,6 +36,19 @@ def benchmark_download_1gb():
         elapsed_sec = tt.elapsed()
         rate = num_bytes / elapsed_sec
         print(f'Rate: {rate / 1_000_000:.2f} MB/s')
+    # Downloading the entire file using the dendro download engine,
+    # which uses parallel range requests
+    from dendro.sdk._download_file import download_file
+    for num_connections in [1, 4, 8, 16]:
+        if os.path.exists('download_1gb.dat'):
+            os.remove('download_1gb.dat')
+        with TimeIt(label=f'Download file with dendro ({num_connections} connections)') as tt:
+            download_file(url1, 'download_1gb.dat', num_connections=num_connections)
+            elapsed_sec = tt.elapsed()
+            num_bytes = os.path.getsize('download_1gb.dat')
+            rate = num_bytes / elapsed_sec
+            print(f'Rate: {rate / 1_000_000:.2f} MB/s')
+    os.remove('download_1gb.dat')
 
 
 def benchmark_load_ephys_from_nwb():
@@ -0,0 +1,83 @@
+import os
+from pydantic import BaseModel, Field
+
+from dendro.sdk import App, ProcessorBase, InputFile, OutputFile
+
+
+# Processors for the benchmarks in devel/mock_api/benchmark_daemon.py. They
+# run directly on the host rather than in a container, so the executable is
+# the path of this file on the host.
+
+app = App(
+    app_name='bench',
+    description='Processors for benchmarking the compute client'
+)
+
+_executable = os.path.abspath(__file__)
+
+
+class NoopProcessorContext(BaseModel):
+    pass
+
+class NoopProcessor(ProcessorBase):
+    name = 'noop'
+    description = 'Does nothing (for measuring the overhead of running a job)'
+    label = 'noop'
+    image = 'none'
+    executable = _executable
+    attributes = {}
+
+    @staticmethod
+    def run(
+        context: NoopProcessorContext
+    ):
+        pass
+
+class CopyFileProcessorContext(BaseModel):
+    input: InputFile = Field(description='The input file')
+    output: OutputFile = Field(description='A copy of the input file')
+
+class CopyFileProcessor(ProcessorBase):
+    name = 'copy_file'
+    description = 'Downloads the input and uploads it as the output'
+    label = 'copy_file'
+    image = 'none'
+    executable = _executable
+    attributes = {}
+
+    @staticmethod
+    def run(
+        context: CopyFileProcessorContext
+    ):
+        context.input.download('input.dat')
+        context.output.upload('input.dat')
+
+class WriteOutputProcessorContext(BaseModel):
+    output: OutputFile = Field(description='The output file')
+    size_mb: float = Field(description='The size of the output file in MB', default=1)
+
+class WriteOutputProcessor(ProcessorBase):
+    name = 'write_output'
+    description = 'Uploads an output file of random data'
+    label = 'write_output'
+    image = 'none'
+    executable = _executable
+    attributes = {}
+
+    @staticmethod
+    def run(
+        context: WriteOutputProcessorContext
+    ):
+        num_bytes = int(context.size_mb * 1e6)
+        with open('output.dat', 'wb') as f:
+            chunk_size = 10_000_000
+            for i in range(0, num_bytes, chunk_size):
+                f.write(os.urandom(min(chunk_size, num_bytes - i)))
+        context.output.upload('output.dat')
+
+app.add_processor(NoopProcessor)
+app.add_processor(CopyFileProcessor)
+app.add_processor(WriteOutputProcessor)
+
+if __name__ == '__main__':
+    app.run()
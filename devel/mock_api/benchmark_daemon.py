@@ -0,0 +1,405 @@
+import os
+import sys
+import json
+import time
+import types
+import queue
+import shutil
+import subprocess
+import argparse
+import tempfile
+import threading
+import statistics
+import importlib.util
+from mock_dendro_api import MockDendroApi
+
+
+# End-to-end benchmarks of the compute client (ComputeClientDaemon) against
+# the mock dendro API in mock_dendro_api.py, without network access:
+#
+#   throughput      jobs/sec and pickup latency for a burst of noop jobs
+#   latency         pickup latency and total time of noop jobs submitted one
+#                   at a time to an idle compute client
+#   status_updates  round trip time of setJobStatus and the API requests made
+#                   per job
+#   transfer        upload and download throughput of the SDK, and of a job
+#                   that copies its input to its output
+#
+# Usage (from this directory):
+#   python benchmark_daemon.py                      # all the benchmarks
+#   python benchmark_daemon.py throughput --num-jobs 50
+#   python benchmark_daemon.py --output results.json
+#
+# The jobs run the processors of bench_app/main.py directly on the host in
+# place of a container (see _install_host_job_runner), or in the trusted app
+# zygote with --trusted (which needs the dendro command, e.g.,
+# pip install -e python). They use the dendro
+# package of this working tree. The results are printed and can be written to
+# a JSON file to compare between changes.
+
+thisdir = os.path.dirname(os.path.abspath(__file__))
+bench_app_executable = os.path.join(thisdir, 'bench_app', 'main.py')
+dendro_src_dir = os.path.abspath(os.path.join(thisdir, '..', '..', 'python', 'src'))
+
+
+def benchmark_throughput(ctx: 'BenchmarkContext', *, num_jobs: int):
+    timer = time.time()
+    jobs = [ctx.add_job('noop') for _ in range(num_jobs)]
+    jobs = ctx.wait_for_jobs([j['jobId'] for j in jobs])
+    elapsed = time.time() - timer
+    _check_completed(jobs)
+    pickup = [j['timestampStartingSec'] - j['timestampCreatedSec'] for j in jobs]
+    ret = {
+        'numJobs': num_jobs,
+        'elapsedSec': elapsed,
+        'jobsPerSec': num_jobs / elapsed,
+        'pickupLatencySec': _describe(pickup)
+    }
+    print(f'{num_jobs} jobs in {elapsed:.2f} seconds ({num_jobs / elapsed:.2f} jobs/sec)')
+    print(f'Pickup latency: {_format_description(pickup)}')
+    return ret
+
+
+def benchmark_latency(ctx: 'BenchmarkContext', *, num_jobs: int):
+    pickup = []
+    total = []
+    for _ in range(num_jobs):
+        job = ctx.add_job('noop')
+        job = ctx.wait_for_jobs([job['jobId']])[0]
+        _check_completed([job])
+        pickup.append(job['timestampStartingSec'] - job['timestampCreatedSec'])
+        total.append(job['timestampFinishedSec'] - job['timestampCreatedSec'])
+    print(f'Pickup latency: {_format_description(pickup)}')
+    print(f'Created to completed: {_format_description(total)}')
+    return {
+        'numJobs': num_jobs,
+        'pickupLatencySec': _describe(pickup),
+        'totalSec': _describe(total)
+    }
+
+
+def benchmark_status_updates(ctx: 'BenchmarkContext', *, num_jobs: int):
+    from dendro.common.api_requests import set_job_status
+    # round trip of a single status update from a job
+    job = ctx.api.add_job(service_name=ctx.service_name, app_name='bench', processor_name='noop')
+    # so that the compute client doesn't pick it up
+    ctx.api.cancel_job(job['jobId'])
+    round_trips = []
+    for _ in range(100):
+        timer = time.time()
+        set_job_status(
+            job_id=job['jobId'],
+            job_private_key=job['jobPrivateKey'],
+            compute_client_id=ctx.compute_client_id,
+            status='running',
+            error=None
+        )
+        round_trips.append(time.time() - timer)
+    print(f'setJobStatus round trip: {_format_description(round_trips)}')
+    # all the API requests made for a job, by endpoint
+    ctx.api.reset_request_stats()
+    jobs = [ctx.add_job('noop') for _ in range(num_jobs)]
+    jobs = ctx.wait_for_jobs([j['jobId'] for j in jobs])
+    _check_completed(jobs)
+    # the final uploads happen right before the status is set to completed
+    time.sleep(1)
+    stats = ctx.api.get_request_stats()
+    per_job = {
+        name: {'countPerJob': s['count'] / num_jobs, 'serverSecPerJob': s['totalSec'] / num_jobs}
+        for name, s in sorted(stats.items())
+    }
+    print('Requests per job:')
+    for name, s in per_job.items():
+        print(f'  {name}: {s["countPerJob"]:.1f} ({s["serverSecPerJob"] * 1000:.1f} ms server time)')
+    return {
+        'setJobStatusRoundTripSec': _describe(round_trips),
+        'requestsPerJob': per_job
+    }
+
+
+def benchmark_transfer(ctx: 'BenchmarkContext', *, size_mb: float):
+    from dendro.sdk._upload_file import upload_file_to_dendro
+    from dendro.sdk._download_file import download_file
+    num_bytes = int(size_mb * 1e6)
+    tmpdir = tempfile.mkdtemp(prefix='dendro_bench_transfer_')
+    try:
+        fname = f'{tmpdir}/data.dat'
+        with open(fname, 'wb') as f:
+            chunk_size = 10_000_000
+            for i in range(0, num_bytes, chunk_size):
+                f.write(os.urandom(min(chunk_size, num_bytes - i)))
+
+        # upload and download with the SDK, outside of a job
+        job = ctx.api.add_job(
+            service_name=ctx.service_name,
+            app_name='bench',
+            processor_name='write_output',
+            output_files=[{'name': 'output', 'fileBaseName': 'output.dat'}]
+        )
+        ctx.api.cancel_job(job['jobId'])
+        timer = time.time()
+        url = upload_file_to_dendro(
+            fname,
+            job_id=job['jobId'],
+            job_private_key=job['jobPrivateKey'],
+            upload_type='output',
+            output_name='output',
+            other_name=None
+        )
+        upload_sec = time.time() - timer
+        timer = time.time()
+        download_file(url, f'{tmpdir}/downloaded.dat')
+        download_sec = time.time() - timer
+        if os.path.getsize(f'{tmpdir}/downloaded.dat') != num_bytes:
+            raise Exception('Unexpected size of downloaded file')
+        print(f'SDK upload: {size_mb / upload_sec:.1f} MB/s')
+        print(f'SDK download: {size_mb / download_sec:.1f} MB/s')
+
+        # a job that downloads its input and uploads it as its output
+        with open(fname, 'rb') as f:
+            input_url = ctx.api.add_blob('inputs/data.dat', f.read())
+        job = ctx.add_job(
+            'copy_file',
+            input_files=[{'name': 'input', 'fileBaseName': 'data.dat', 'url': input_url}],
+            output_files=[{'name': 'output', 'fileBaseName': 'data.dat'}]
+        )
+        job = ctx.wait_for_jobs([job['jobId']])[0]
+        _check_completed([job])
+        job_sec = job['timestampFinishedSec'] - job['timestampStartedSec']
+        output_url = job['outputFileResults'][0]['url']
+        if len(ctx.api.read_blob(output_url)) != num_bytes:
+            raise Exception('Unexpected size of output of copy_file job')
+        print(f'copy_file job: {job_sec:.2f} seconds running ({2 * size_mb / job_sec:.1f} MB/s in + out)')
+        return {
+            'sizeMb': size_mb,
+            'sdkUploadMbPerSec': size_mb / upload_sec,
+            'sdkDownloadMbPerSec': size_mb / download_sec,
+            'copyFileJobSec': job_sec,
+            'copyFileJobMbPerSec': 2 * size_mb / job_sec
+        }
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+class BenchmarkContext:
+    """The mock API and a compute client daemon running in a background thread"""
+    def __init__(self, *, multipart_part_size_mb: float, trusted: bool) -> None:
+        self.service_name = 'bench'
+        self.api = MockDendroApi(multipart_part_size=int(multipart_part_size_mb * 1024 * 1024))
+        self._trusted = trusted
+        self._workdir = tempfile.mkdtemp(prefix='dendro_bench_compute_client_')
+        self._daemon_thread: threading.Thread
+        self.compute_client_id = ''
+
+    def start(self):
+        self.api.start()
+        # The environment must be set before dendro is imported
+        # (api_requests reads DENDRO_API_URL on import), and it is inherited
+        # by the jobs
+        os.environ['DENDRO_API_URL'] = self.api.url
+        os.environ['COMPUTE_CLIENT_PREFETCH_IMAGES'] = '0'
+        os.environ.setdefault('COMPUTE_CLIENT_USE_CGROUPS', '0')
+        os.environ['PYTHONPATH'] = dendro_src_dir + os.pathsep + os.environ.get('PYTHONPATH', '')
+        if self._trusted:
+            os.environ['COMPUTE_CLIENT_TRUSTED_APPS'] = f'bench={bench_app_executable}'
+        sys.path.insert(0, dendro_src_dir)
+        _install_mock_pubsub_client(self.api)
+        _install_host_job_runner()
+
+        spec = importlib.util.spec_from_file_location('bench_app', bench_app_executable)
+        assert spec is not None and spec.loader is not None
+        bench_app = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(bench_app)
+        self.api.add_service_app(service_name=self.service_name, app_spec=bench_app.app.get_spec())
+        self.compute_client_id, compute_client_private_key = self.api.add_compute_client(service_names=[self.service_name])
+
+        from dendro.compute_client.ComputeClientDaemon import ComputeClientDaemon
+        # the job directories are created in the working directory
+        os.chdir(self._workdir)
+        daemon = ComputeClientDaemon(
+            dir=self._workdir,
+            compute_client_id=self.compute_client_id,
+            compute_client_private_key=compute_client_private_key,
+            compute_client_name='bench',
+            exit_when_idle=False,
+            single_job=False
+        )
+        self._daemon_thread = threading.Thread(target=lambda: daemon.start(cleanup_old_jobs=False), daemon=True)
+        self._daemon_thread.start()
+
+    def stop(self):
+        # the daemon thread is a daemon thread, so it ends with the process
+        self.api.stop()
+        os.chdir(thisdir)
+        shutil.rmtree(self._workdir, ignore_errors=True)
+
+    def add_job(self, processor_name: str, **kwargs) -> dict:
+        return self.api.add_job(service_name=self.service_name, app_name='bench', processor_name=processor_name, **kwargs)
+
+    def wait_for_jobs(self, job_ids: list, *, timeout_sec: float = 60 * 10) -> list:
+        timer = time.time()
+        while True:
+            jobs = [self.api.get_job(job_id) for job_id in job_ids]
+            if all(j['status'] in ['completed', 'failed'] for j in jobs):
+                return jobs
+            if time.time() - timer > timeout_sec:
+                raise Exception(f'Timed out waiting for {len(job_ids)} jobs')
+            time.sleep(0.02)
+
+
+def _install_mock_pubsub_client(api: MockDendroApi):
+    # The daemon imports PubsubClient when it starts. This stands in for the
+    # pubnub client: the mock API puts its messages in the event queue of the
+    # daemon directly.
+    class PubsubClient:
+        def __init__(self, *, pubnub_subscribe_key: str, pubnub_channel: str, pubnub_user: str, compute_client_id: str, message_queue=None):
+            self._message_queue = message_queue if message_queue is not None else queue.Queue()
+            api.register_message_queue(self._message_queue)
+
+    module = types.ModuleType('dendro.compute_client.PubsubClient')
+    module.PubsubClient = PubsubClient  # type: ignore
+    sys.modules['dendro.compute_client.PubsubClient'] = module
+
+
+def _install_host_job_runner():
+    # Stands in for the container: the job runs on the host with the host
+    # paths (like the jobs of trusted apps, but without the zygote) and with
+    # the environment of this process. This replaces _run_container_job of
+    # the compute client, which has no such mode, because the jobs would not
+    # be isolated from the compute client.
+    from dendro.compute_client import _start_job
+    from dendro.compute_client._start_job import JobException, get_job_control_fifo_path
+
+    def run_job_on_host(*,
+        job_id: str,
+        processor_executable: str,
+        processor_image: str,
+        image_ref,
+        env_vars: dict,
+        job_dir: str,
+        file_cache_dir,
+        num_cpus,
+        memory_gb,
+        use_gpu: bool,
+        detach: bool
+    ):
+        tmpdir = job_dir + '/tmp'
+        os.makedirs(tmpdir + '/working', exist_ok=True)
+        env_vars['DENDRO_JOB_CLEANUP_DIR'] = tmpdir
+        env_vars['DENDRO_JOB_WORKING_DIR'] = tmpdir + '/working'
+        env_vars['KACHERY_CLOUD_DIR'] = tmpdir + '/.kachery-cloud'
+        env_vars['TMPDIR'] = tmpdir
+        if file_cache_dir is not None:
+            env_vars['DENDRO_FILE_CACHE_DIR'] = file_cache_dir
+            env_vars['DENDRO_FILE_CACHE_FILL_SOCKET'] = file_cache_dir + '/fill.sock'
+        if 'DENDRO_JOB_CONTROL_FIFO' in env_vars:
+            env_vars['DENDRO_JOB_CONTROL_FIFO'] = get_job_control_fifo_path(job_id)
+        # same as the run.sh of _run_container_job, with the host paths
+        with open(f'{tmpdir}/run.sh', 'w') as f:
+            f.write(f'''#!/bin/bash
+{sys.executable} {processor_executable} > {tmpdir}/_dendro_parent_process_output.txt 2>&1
+if [ $? -eq 0 ]; then
+    echo "Parent process completed successfully" >> {tmpdir}/_dendro_parent_process_succeeded.txt
+else
+    echo "Parent process failed" >> {tmpdir}/_dendro_parent_process_failed.txt
+fi
+''')
+        proc = subprocess.Popen(
+            ['/bin/bash', f'{tmpdir}/run.sh'],
+            cwd=tmpdir + '/working',
+            env={**os.environ, **env_vars},
+            start_new_session=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+        if not detach:
+            proc.wait()
+            proc = None
+        # like _run_container_job, wait a bit to catch a failure right away
+        timer = time.time()
+        while (time.time() - timer) < 2:
+            if os.path.exists(f'{tmpdir}/_dendro_parent_process_failed.txt'):
+                with open(f'{tmpdir}/_dendro_parent_process_output.txt', 'r') as f:
+                    raise JobException(f'Parent process error: {f.read()}')
+            elif os.path.exists(f'{tmpdir}/_dendro_parent_process_succeeded.txt'):
+                break
+            time.sleep(0.1)
+        return proc
+
+    class HostImageManager:
+        # no images to pull
+        def get_image(self, image: str) -> str:
+            return image
+
+        def get_image_if_ready(self, image: str, *, on_ready) -> str:
+            return image
+
+    host_image_manager = HostImageManager()
+    _start_job._run_container_job = run_job_on_host  # type: ignore
+    _start_job.get_image_manager = lambda: host_image_manager  # type: ignore
+
+
+def _check_completed(jobs: list):
+    failed = [j for j in jobs if j['status'] != 'completed']
+    if len(failed) > 0:
+        raise Exception(f'{len(failed)} jobs failed, e.g., {failed[0]["jobId"]}: {failed[0].get("error")}')
+
+
+def _describe(x: list) -> dict:
+    x = sorted(x)
+    return {
+        'mean': statistics.mean(x),
+        'p50': x[len(x) // 2],
+        'p95': x[min(len(x) - 1, int(len(x) * 0.95))],
+        'max': x[-1]
+    }
+
+
+def _format_description(x: list) -> str:
+    d = _describe(x)
+    return f'mean {d["mean"] * 1000:.0f} ms, p50 {d["p50"] * 1000:.0f} ms, p95 {d["p95"] * 1000:.0f} ms, max {d["max"] * 1000:.0f} ms'
+
+
+benchmark_names = ['throughput', 'latency', 'status_updates', 'transfer']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks of the compute client against a mock dendro API')
+    parser.add_argument('benchmarks', nargs='*', help=f'The benchmarks to run: {", ".join(benchmark_names)} (default: all)')
+    parser.add_argument('--num-jobs', type=int, default=20, help='Number of jobs for the throughput, latency and status_updates benchmarks')
+    parser.add_argument('--size-mb', type=float, default=200, help='Size of the file for the transfer benchmark')
+    parser.add_argument('--multipart-part-size-mb', type=float, default=50, help='Files larger than this are uploaded in parts')
+    parser.add_argument('--trusted', action='store_true', help='Run the jobs in the trusted app zygote rather than directly on the host')
+    parser.add_argument('--output', type=str, default=None, help='Write the results to this JSON file')
+    args = parser.parse_args()
+    names = args.benchmarks or benchmark_names
+    for name in names:
+        if name not in benchmark_names:
+            parser.error(f'Unknown benchmark: {name}')
+    # relative to the current directory (the benchmarks change it)
+    output_fname = os.path.abspath(args.output) if args.output is not None else None
+
+    ctx = BenchmarkContext(multipart_part_size_mb=args.multipart_part_size_mb, trusted=args.trusted)
+    ctx.start()
+    results = {}
+    try:
+        for name in names:
+            print(f'=== {name}')
+            if name == 'throughput':
+                results[name] = benchmark_throughput(ctx, num_jobs=args.num_jobs)
+            elif name == 'latency':
+                results[name] = benchmark_latency(ctx, num_jobs=min(args.num_jobs, 10))
+            elif name == 'status_updates':
+                results[name] = benchmark_status_updates(ctx, num_jobs=args.num_jobs)
+            elif name == 'transfer':
+                results[name] = benchmark_transfer(ctx, size_mb=args.size_mb)
+    finally:
+        ctx.stop()
+    if output_fname is not None:
+        with open(output_fname, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Wrote {output_fname}')
+
+
+if __name__ == '__main__':
+    main()
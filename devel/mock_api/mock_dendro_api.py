@@ -0,0 +1,612 @@
+from typing import Dict, List, Union
+import os
+import re
+import json
+import time
+import queue
+import base64
+import shutil
+import hashlib
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# An in-process stand-in for the dendro API (the /api/* endpoints used by
+# dendro/common/api_requests.py) and for the bucket behind the signed URLs,
+# so that the compute client and the jobs can be run and benchmarked offline.
+#
+#     api = MockDendroApi()
+#     api.start()
+#     os.environ['DENDRO_API_URL'] = api.url  # before starting the compute client
+#     api.add_service_app(service_name='bench', app_spec=app.get_spec())
+#     compute_client_id, compute_client_private_key = api.add_compute_client(service_names=['bench'])
+#     job = api.add_job(service_name='bench', app_name='bench', processor_name='noop')
+#
+# The state is kept in memory. Blobs are stored in a temporary directory and
+# served at <url>/blobs/<key> with support for range requests. Uploads are PUT
+# requests to the signed URLs, either in a single request or in parts (files
+# larger than multipart_part_size, like the real API but with a part size
+# that can be lowered to exercise multipart uploads).
+#
+# There is no pubnub here. Instead, register_message_queue registers a queue
+# that gets the pubsub messages that the real API would publish
+# (newPendingJob and jobStatusChanged).
+#
+# The number of requests and the time spent handling them are recorded per
+# endpoint (see get_request_stats).
+
+_default_part_size = 1024 * 1024 * 1000
+_buffer_size = 1024 * 1024
+
+
+class MockDendroApi:
+    def __init__(self, *, host: str = '127.0.0.1', port: int = 0, blob_dir: Union[str, None] = None, multipart_part_size: int = _default_part_size) -> None:
+        self._host = host
+        self._port = port
+        self._own_blob_dir = blob_dir is None
+        self._blob_dir = blob_dir if blob_dir is not None else tempfile.mkdtemp(prefix='mock_dendro_blobs_')
+        self._multipart_part_size = multipart_part_size
+        self._lock = threading.Lock()
+        self._service_apps: Dict[str, dict] = {}  # by <service_name>/<app_name>
+        self._compute_clients: Dict[str, dict] = {}
+        self._jobs: Dict[str, dict] = {}
+        self._multipart_uploads: Dict[str, dict] = {}
+        self._message_queues: List[queue.Queue] = []
+        self._request_stats: Dict[str, dict] = {}
+        self._status_history: List[dict] = []
+        self._server: Union[ThreadingHTTPServer, None] = None
+        self._thread: Union[threading.Thread, None] = None
+        self._id_counter = 0
+
+    @property
+    def url(self) -> str:
+        assert self._server is not None, 'Server not started'
+        return f'http://{self._host}:{self._server.server_address[1]}'
+
+    def start(self):
+        api = self
+
+        class Handler(_RequestHandler):
+            mock_api = api
+        self._server = ThreadingHTTPServer((self._host, self._port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._own_blob_dir:
+            shutil.rmtree(self._blob_dir, ignore_errors=True)
+
+    # setting up the state
+
+    def add_service_app(self, *, service_name: str, app_spec: dict):
+        with self._lock:
+            self._service_apps[f'{service_name}/{app_spec["name"]}'] = {
+                'serviceName': service_name,
+                'appName': app_spec['name'],
+                'appSpecificationUri': '',
+                'appSpecificationCommit': '',
+                'appSpecification': app_spec
+            }
+
+    def add_compute_client(self, *, service_names: List[str]):
+        """Returns the compute client ID and private key"""
+        compute_client_id = self._new_id('cc')
+        compute_client_private_key = self._new_id('cckey')
+        with self._lock:
+            self._compute_clients[compute_client_id] = {
+                'computeClientId': compute_client_id,
+                'privateKey': compute_client_private_key,
+                'serviceNames': service_names
+            }
+        return compute_client_id, compute_client_private_key
+
+    def add_blob(self, key: str, data: bytes) -> str:
+        """Store a file in the blob store and return its URL (e.g., for an input of a job)"""
+        path = self._blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return f'{self.url}/blobs/{key}'
+
+    def add_job(
+        self, *,
+        service_name: str,
+        app_name: str,
+        processor_name: str,
+        input_files: List[dict] = [],
+        output_files: List[dict] = [],
+        parameters: List[dict] = [],
+        num_cpus: int = 1,
+        memory_gb: float = 1,
+        time_sec: float = 60 * 10
+    ) -> dict:
+        """Add a pending job and notify the compute clients. Returns the job
+
+        input_files are dicts with name, fileBaseName and url, output_files
+        dicts with name and fileBaseName, and parameters dicts with name and
+        value (as in DendroJobDefinition).
+        """
+        job_id = self._new_id('job')
+        job = {
+            'jobId': job_id,
+            'jobPrivateKey': self._new_id('jobkey'),
+            'serviceName': service_name,
+            'userId': 'mock-user',
+            'batchId': 'mock-batch',
+            'tags': [],
+            'jobDefinition': {
+                'appName': app_name,
+                'processorName': processor_name,
+                'inputFiles': input_files,
+                'outputFiles': output_files,
+                'parameters': parameters
+            },
+            'jobDefinitionHash': job_id,
+            'jobDependencies': [],
+            'requiredResources': {
+                'numCpus': num_cpus,
+                'numGpus': 0,
+                'memoryGb': memory_gb,
+                'timeSec': time_sec
+            },
+            'inputFileUrlList': [f['url'] for f in input_files],
+            'outputFileUrlList': [],
+            'outputFileResults': [],
+            'consoleOutputUrl': f'{self.url}/blobs/jobs/{job_id}/console_output.txt',
+            'resourceUtilizationLogUrl': f'{self.url}/blobs/jobs/{job_id}/resource_utilization_log.jsonl',
+            'timestampCreatedSec': time.time(),
+            'timestampUpdatedSec': time.time(),
+            'canceled': False,
+            'status': 'pending',
+            'isRunnable': True
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+        self._publish({'type': 'newPendingJob', 'serviceName': service_name, 'jobId': job_id})
+        return dict(job)
+
+    def cancel_job(self, job_id: str):
+        with self._lock:
+            job = self._jobs[job_id]
+            job['canceled'] = True
+            job['timestampUpdatedSec'] = time.time()
+        self._publish({'type': 'jobStatusChanged', 'jobId': job_id, 'status': job['status'], 'canceled': True})
+
+    def register_message_queue(self, message_queue: queue.Queue):
+        """Get the pubsub messages (see the stand-in PubsubClient in benchmark_daemon.py)"""
+        with self._lock:
+            self._message_queues.append(message_queue)
+
+    # inspecting the state
+
+    def get_job(self, job_id: str) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._jobs[job_id]))
+
+    def get_jobs(self) -> List[dict]:
+        with self._lock:
+            return json.loads(json.dumps(list(self._jobs.values())))
+
+    def get_status_history(self) -> List[dict]:
+        """The status updates of all the jobs, as {jobId, status, timestamp}"""
+        with self._lock:
+            return list(self._status_history)
+
+    def get_request_stats(self) -> Dict[str, dict]:
+        """Number of requests and total handling time (sec) per endpoint"""
+        with self._lock:
+            return {k: dict(v) for k, v in self._request_stats.items()}
+
+    def reset_request_stats(self):
+        with self._lock:
+            self._request_stats = {}
+
+    def read_blob(self, url: str) -> bytes:
+        assert url.startswith(f'{self.url}/blobs/'), f'Not a blob of this server: {url}'
+        with open(self._blob_path(url[len(f'{self.url}/blobs/'):]), 'rb') as f:
+            return f.read()
+
+    # API requests
+
+    def handle_api_request(self, url_path: str, req: dict, authorization: str) -> dict:
+        name = url_path[len('/api/'):]
+        handler = getattr(self, f'_handle_{name}', None)
+        if handler is None:
+            raise _HttpError(404, f'Unknown endpoint: {url_path}')
+        # The header is "Bearer <key>" or "Bearer: <key>" depending on the
+        # request (see api_requests.py)
+        token = authorization.split(' ')[-1] if authorization else ''
+        return handler(req, token)
+
+    def _handle_getServiceApp(self, req: dict, token: str) -> dict:
+        with self._lock:
+            app = self._service_apps.get(f'{req["serviceName"]}/{req["appName"]}')
+        if app is None:
+            raise _HttpError(404, 'Service app not found')
+        return {'type': 'getServiceAppResponse', 'serviceApp': app}
+
+    def _handle_getServiceApps(self, req: dict, token: str) -> dict:
+        with self._lock:
+            apps = [a for a in self._service_apps.values() if a['serviceName'] == req['serviceName']]
+        return {'type': 'getServiceAppsResponse', 'serviceApps': apps}
+
+    def _handle_getPubsubSubscription(self, req: dict, token: str) -> dict:
+        self._check_compute_client(req['computeClientId'], token)
+        return {
+            'type': 'getPubsubSubscriptionResponse',
+            'subscription': {
+                'pubnubSubscribeKey': 'mock',
+                'pubnubChannel': 'mock',
+                'pubnubUser': req['computeClientId']
+            }
+        }
+
+    def _handle_getRunnableJobsForComputeClient(self, req: dict, token: str) -> dict:
+        compute_client = self._check_compute_client(req['computeClientId'], token)
+        with self._lock:
+            jobs = list(self._jobs.values())
+            if not req.get('jobId') or req.get('singleJob'):
+                running_jobs = [
+                    j for j in jobs
+                    if j['status'] in ['starting', 'running'] and j.get('computeClientId') == compute_client['computeClientId']
+                ]
+            else:
+                running_jobs = []
+            runnable_jobs = [
+                j for j in jobs
+                if j['status'] == 'pending' and j['isRunnable'] and not j['canceled'] and
+                j['serviceName'] in compute_client['serviceNames'] and
+                (not req.get('jobId') or j['jobId'] == req['jobId'])
+            ]
+            # the real API handles the most recent jobs first
+            runnable_jobs.sort(key=lambda j: -j['timestampCreatedSec'])
+            if req.get('singleJob'):
+                runnable_jobs = runnable_jobs[:1]
+            return json.loads(json.dumps({
+                'type': 'getRunnableJobsForComputeClientResponse',
+                'runnableJobs': runnable_jobs,
+                'runningJobs': running_jobs
+            }))
+
+    def _handle_computeClientHeartbeat(self, req: dict, token: str) -> dict:
+        self._check_compute_client(req['computeClientId'], token)
+        with self._lock:
+            canceled_job_ids = [
+                job_id for job_id in req['runningJobIds']
+                if job_id not in self._jobs or self._jobs[job_id]['canceled']
+            ]
+        return {'type': 'computeClientHeartbeatResponse', 'canceledJobIds': canceled_job_ids}
+
+    def _handle_getJob(self, req: dict, token: str) -> dict:
+        with self._lock:
+            job = self._jobs.get(req['jobId'])
+            if job is None:
+                return {'type': 'getJobResponse'}
+            job = dict(job)
+        if not req.get('includePrivateKey'):
+            job['jobPrivateKey'] = None
+        return {'type': 'getJobResponse', 'job': job}
+
+    def _handle_setJobStatus(self, req: dict, token: str) -> dict:
+        job = self._check_job(req['jobId'], token)
+        status = req['status']
+        now = time.time()
+        with self._lock:
+            if status == 'starting':
+                if job['status'] != 'pending':
+                    raise _HttpError(400, f'Cannot set status to starting. Job status is {job["status"]}')
+                job['computeClientId'] = req['computeClientId']
+                job['timestampStartingSec'] = now
+            elif status == 'running':
+                job['timestampStartedSec'] = now
+            elif status in ['completed', 'failed']:
+                job['timestampFinishedSec'] = now
+                if req.get('error'):
+                    job['error'] = req['error']
+                if req.get('resourceUsage'):
+                    job['resourceUsage'] = req['resourceUsage']
+            job['status'] = status
+            job['timestampUpdatedSec'] = now
+            self._status_history.append({'jobId': job['jobId'], 'status': status, 'timestamp': now})
+        self._publish({'type': 'jobStatusChanged', 'jobId': job['jobId'], 'status': status})
+        return {'type': 'setJobStatusResponse'}
+
+    def _handle_getSignedUploadUrl(self, req: dict, token: str) -> dict:
+        job = self._check_job(req['jobId'], token)
+        job_id = job['jobId']
+        upload_type = req['uploadType']
+        if upload_type == 'output':
+            output = next((o for o in job['jobDefinition']['outputFiles'] if o['name'] == req.get('outputName')), None)
+            if output is None:
+                raise _HttpError(400, f'Output not found: {req.get("outputName")}')
+            key = f'jobs/{job_id}/outputs/{output["name"]}/{output["fileBaseName"]}'
+            with self._lock:
+                job['outputFileResults'] = [r for r in job['outputFileResults'] if r['name'] != output['name']] + [{
+                    'name': output['name'],
+                    'fileBaseName': output['fileBaseName'],
+                    'url': f'{self.url}/blobs/{key}',
+                    'size': req['size']
+                }]
+                job['outputFileUrlList'] = [r['url'] for r in job['outputFileResults']]
+        elif upload_type == 'consoleOutput':
+            key = f'jobs/{job_id}/console_output.txt'
+        elif upload_type == 'resourceUtilizationLog':
+            key = f'jobs/{job_id}/resource_utilization_log.jsonl'
+        elif upload_type == 'other':
+            key = f'jobs/{job_id}/other/{req["otherName"]}'
+        else:
+            raise _HttpError(400, 'Invalid uploadType')
+        download_url = f'{self.url}/blobs/{key}'
+        size = req['size']
+        if size < self._multipart_part_size:
+            return {
+                'type': 'getSignedUploadUrlResponse',
+                'signedUrl': f'{download_url}?signature=mock',
+                'downloadUrl': download_url
+            }
+        num_parts = (size + self._multipart_part_size - 1) // self._multipart_part_size
+        upload_id = req.get('uploadId')
+        new_upload_id = self._new_id('upload')
+        with self._lock:
+            if upload_id is None or upload_id not in self._multipart_uploads:
+                upload_id = new_upload_id
+                self._multipart_uploads[upload_id] = {'key': key, 'parts': {}}
+        parts = [
+            {'partNumber': i + 1, 'signedUrl': f'{download_url}?uploadId={upload_id}&partNumber={i + 1}'}
+            for i in range(num_parts)
+        ]
+        return {
+            'type': 'getSignedUploadUrlResponse',
+            'parts': parts,
+            'uploadId': upload_id,
+            'downloadUrl': download_url
+        }
+
+    def _handle_finalizeMultipartUpload(self, req: dict, token: str) -> dict:
+        self._check_job(req['jobId'], token)
+        with self._lock:
+            upload = self._multipart_uploads.pop(req['uploadId'], None)
+        if upload is None:
+            raise _HttpError(404, 'Multipart upload not found')
+        path = self._blob_path(upload['key'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            for p in sorted(req['parts'], key=lambda p: p['PartNumber']):
+                part = upload['parts'].get(p['PartNumber'])
+                if part is None or part['etag'] != p['ETag']:
+                    raise _HttpError(400, f'Invalid part {p["PartNumber"]}')
+                with open(part['path'], 'rb') as f2:
+                    shutil.copyfileobj(f2, f, _buffer_size)
+                os.remove(part['path'])
+        if os.path.getsize(path + '.tmp') != req['size']:
+            raise _HttpError(400, f'Unexpected size of multipart upload: {os.path.getsize(path + ".tmp")} != {req["size"]}')
+        os.replace(path + '.tmp', path)
+        return {'type': 'finalizeMultipartUploadResponse'}
+
+    def _handle_cancelMultipartUpload(self, req: dict, token: str) -> dict:
+        self._check_job(req['jobId'], token)
+        with self._lock:
+            upload = self._multipart_uploads.pop(req['uploadId'], None)
+        if upload is not None:
+            for part in upload['parts'].values():
+                if os.path.exists(part['path']):
+                    os.remove(part['path'])
+        return {'type': 'cancelMultipartUploadResponse'}
+
+    def _handle_setOutputFileUrl(self, req: dict, token: str) -> dict:
+        job = self._check_job(req['jobId'], token)
+        output = next((o for o in job['jobDefinition']['outputFiles'] if o['name'] == req['outputName']), None)
+        if output is None:
+            raise _HttpError(400, f'Output not found: {req["outputName"]}')
+        with self._lock:
+            job['outputFileResults'] = [r for r in job['outputFileResults'] if r['name'] != output['name']] + [{
+                'name': output['name'],
+                'fileBaseName': output['fileBaseName'],
+                'url': req['url'],
+                'size': None
+            }]
+        return {'type': 'setOutputFileUrlResponse'}
+
+    def _check_compute_client(self, compute_client_id: str, token: str) -> dict:
+        with self._lock:
+            compute_client = self._compute_clients.get(compute_client_id)
+        if compute_client is None:
+            raise _HttpError(404, 'Compute client not found')
+        if compute_client['privateKey'] != token:
+            raise _HttpError(401, 'Invalid compute client private key')
+        return compute_client
+
+    def _check_job(self, job_id: str, token: str) -> dict:
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            raise _HttpError(404, 'Job not found')
+        if job['jobPrivateKey'] != token:
+            raise _HttpError(401, 'Invalid job private key')
+        return job
+
+    # blobs
+
+    def _blob_path(self, key: str) -> str:
+        key = urllib.parse.unquote(key)
+        if '..' in key.split('/'):
+            raise _HttpError(400, f'Invalid key: {key}')
+        return os.path.join(self._blob_dir, key)
+
+    def handle_blob_put(self, key: str, query: dict, rfile, content_length: int, content_md5: Union[str, None] = None) -> str:
+        """Store the body of a PUT request (a file or a part of a multipart upload). Returns the ETag
+
+        If content_md5 (the Content-MD5 header) is given, the body is checked
+        against it, as S3 does.
+        """
+        if 'uploadId' in query:
+            with self._lock:
+                upload = self._multipart_uploads.get(query['uploadId'])
+            if upload is None:
+                raise _HttpError(404, 'Multipart upload not found')
+            part_number = int(query['partNumber'])
+            path = os.path.join(self._blob_dir, '_parts', f'{query["uploadId"]}.{part_number}')
+        else:
+            upload = None
+            part_number = 0
+            path = self._blob_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        md5 = hashlib.md5()
+        with open(path + '.tmp', 'wb') as f:
+            remaining = content_length
+            while remaining > 0:
+                data = rfile.read(min(_buffer_size, remaining))
+                if not data:
+                    raise _HttpError(400, 'Unexpected end of request body')
+                md5.update(data)
+                f.write(data)
+                remaining -= len(data)
+        if content_md5 is not None and base64.b64decode(content_md5) != md5.digest():
+            os.remove(path + '.tmp')
+            raise _HttpError(400, 'BadDigest: The Content-MD5 you specified did not match what we received.')
+        os.replace(path + '.tmp', path)
+        etag = f'"{md5.hexdigest()}"'
+        if upload is not None:
+            with self._lock:
+                upload['parts'][part_number] = {'path': path, 'etag': etag}
+        return etag
+
+    def get_blob_file(self, key: str) -> Union[str, None]:
+        path = self._blob_path(key)
+        return path if os.path.isfile(path) else None
+
+    # internal
+
+    def _new_id(self, prefix: str) -> str:
+        with self._lock:
+            self._id_counter += 1
+            return f'{prefix}-{self._id_counter}-{os.urandom(4).hex()}'
+
+    def _publish(self, msg: dict):
+        with self._lock:
+            message_queues = list(self._message_queues)
+        for q in message_queues:
+            q.put(dict(msg))
+
+    def record_request(self, name: str, elapsed_sec: float):
+        with self._lock:
+            s = self._request_stats.setdefault(name, {'count': 0, 'totalSec': 0.0})
+            s['count'] += 1
+            s['totalSec'] += elapsed_sec
+
+
+class _HttpError(Exception):
+    def __init__(self, status_code: int, message: str) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    mock_api: MockDendroApi
+    # keep-alive, so that the http sessions of the clients reuse connections
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately, which would otherwise
+    # add the delayed ACK timeout (~40 ms) to each request
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        timer = time.time()
+        url_path = urllib.parse.urlparse(self.path).path
+        try:
+            content_length = int(self.headers.get('Content-Length', '0'))
+            req = json.loads(self.rfile.read(content_length)) if content_length > 0 else {}
+            if not url_path.startswith('/api/'):
+                raise _HttpError(404, f'Not found: {url_path}')
+            resp = self.mock_api.handle_api_request(url_path, req, self.headers.get('Authorization', ''))
+            self._send_json(200, resp)
+        except _HttpError as e:
+            self._send_json(e.status_code, {'error': str(e)})
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+        self.mock_api.record_request(url_path, time.time() - timer)
+
+    def do_PUT(self):
+        timer = time.time()
+        parsed = urllib.parse.urlparse(self.path)
+        try:
+            if not parsed.path.startswith('/blobs/'):
+                raise _HttpError(404, f'Not found: {parsed.path}')
+            query = dict(urllib.parse.parse_qsl(parsed.query))
+            content_length = int(self.headers.get('Content-Length', '0'))
+            etag = self.mock_api.handle_blob_put(parsed.path[len('/blobs/'):], query, self.rfile, content_length, content_md5=self.headers.get('Content-MD5', None))
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        except _HttpError as e:
+            # the body may not have been read
+            self.close_connection = True
+            self._send_json(e.status_code, {'error': str(e)})
+        self.mock_api.record_request('PUT /blobs', time.time() - timer)
+
+    def do_HEAD(self):
+        self._serve_blob(head=True)
+
+    def do_GET(self):
+        timer = time.time()
+        self._serve_blob(head=False)
+        self.mock_api.record_request('GET /blobs', time.time() - timer)
+
+    def _serve_blob(self, *, head: bool):
+        parsed = urllib.parse.urlparse(self.path)
+        path = self.mock_api.get_blob_file(parsed.path[len('/blobs/'):]) if parsed.path.startswith('/blobs/') else None
+        if path is None:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        size = os.path.getsize(path)
+        st = os.stat(path)
+        etag = f'"{st.st_size:x}-{int(st.st_mtime * 1000):x}"'
+        start, end = 0, size - 1
+        status = 200
+        m = re.match(r'^bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if head:
+            return
+        with open(path, 'rb') as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(_buffer_size, remaining))
+                if not data:
+                    break
+                self.wfile.write(data)
+                remaining -= len(data)
+
+    def _send_json(self, status_code: int, x: dict):
+        body = json.dumps(x).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
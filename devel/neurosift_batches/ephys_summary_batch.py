@@ -1,17 +1,17 @@
-from typing import Union
+from typing import Union, List
+from concurrent.futures import ThreadPoolExecutor
 import dandi.dandiarchive as da
 import urllib.request
 import urllib.error
 import h5py
 import lindi
-from dendro.client import submit_job, DendroJobDefinition, DendroJobRequiredResources, DendroJobParameter, DendroJobInputFile, DendroJobOutputFile
+from dendro.client import submit_jobs, DendroJobDefinition, DendroJobRequiredResources, DendroJobParameter, DendroJobInputFile, DendroJobOutputFile
 
 def ephys_summary_batch(dandiset_id: str):
     parsed_url = da.parse_dandi_url(f"https://dandiarchive.org/dandiset/{dandiset_id}")
     num_consecutive_not_nwb = 0
     num_consecutive_not_found = 0
-    num_assets_processed = 0
-    statuses = []
+    lindi_json_urls = []
     with parsed_url.navigate() as (client, dandiset, assets):
         assert dandiset
         for asset_obj in dandiset.get_assets('path'):
@@ -38,13 +38,33 @@ def ephys_summary_batch(dandiset_id: str):
                 break
             tags = _get_tags_for_asset_path(asset_path)
             if 'ecephys' in tags:
-                print(f"Processing {asset_path}")
-                s = process_asset(lindi_json_url)
-                statuses.extend(s)
-                num_assets_processed += 1
-                if num_assets_processed >= 30:
-                    print(f'Stopping because {num_assets_processed} assets processed.')
+                print(f"Found {asset_path}")
+                lindi_json_urls.append(lindi_json_url)
+                if len(lindi_json_urls) >= 30:
+                    print(f'Stopping because {len(lindi_json_urls)} assets found.')
                     break
+    # Opening the LINDI files is dominated by network latency, so we do it
+    # concurrently, and then submit all the jobs at once
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        job_defs_per_asset = list(executor.map(process_asset, lindi_json_urls))
+    job_defs = [job_def for x in job_defs_per_asset for job_def in x]
+    print(f'Submitting {len(job_defs)} jobs')
+    required_resources = DendroJobRequiredResources(
+        numCpus=2,
+        numGpus=0,
+        memoryGb=4,
+        timeSec=60 * 30
+    )
+    jobs = submit_jobs(
+        service_name='hello_world_service',
+        job_definitions=job_defs,
+        required_resources=required_resources,
+        tags=['neurosift', 'EphysSummary'],
+        rerun_failing=True
+    )
+    for job in jobs:
+        print(job.job_url, job.status)
+    statuses = [job.status for job in jobs]
     num_pending = len([s for s in statuses if s == 'pending'])
     num_failed = len([s for s in statuses if s == 'failed'])
     num_completed = len([s for s in statuses if s == 'completed'])
@@ -57,8 +77,8 @@ def ephys_summary_batch(dandiset_id: str):
     print(f'num_other: {num_other}')
 
 
-def process_asset(lindi_json_url: str):
-    statuses = []
+def process_asset(lindi_json_url: str) -> List[DendroJobDefinition]:
+    job_defs = []
     hf = lindi.LindiH5pyFile.from_lindi_file(lindi_json_url)
     a = hf['/acquisition']
     assert isinstance(a, h5py.Group)
@@ -69,18 +89,15 @@ def process_asset(lindi_json_url: str):
                 rate = _get_sampling_rate_for_electrical_series(g)
                 if rate is not None and rate >= 15000:
                     print(f'Processing ElectricalSeries {k} ({rate} Hz)')
-                    status = process_electrical_series(lindi_json_url, 'acquisition/' + k)
-                    statuses.append(status)
-    return statuses
+                    job_defs.append(get_job_definition_for_electrical_series(lindi_json_url, 'acquisition/' + k))
+    return job_defs
 
 
-def process_electrical_series(lindi_json_url: str, electrical_series_path: str):
-    service_name = 'hello_world_service'
+def get_job_definition_for_electrical_series(lindi_json_url: str, electrical_series_path: str) -> DendroJobDefinition:
     app_name = 'hello_neurosift'
     processor_name = 'ephys_summary_1'
     segment_start_time_sec = 0
     segment_duration_sec = 60
-    tags = ['neurosift', 'EphysSummary']
     job_def = DendroJobDefinition(
         appName=app_name,
         processorName=processor_name,
@@ -112,21 +129,7 @@ def process_electrical_series(lindi_json_url: str, electrical_series_path: str):
             )
         ]
     )
-    required_resources = DendroJobRequiredResources(
-        numCpus=2,
-        numGpus=0,
-        memoryGb=4,
-        timeSec=60 * 30
-    )
-    job = submit_job(
-        service_name=service_name,
-        job_definition=job_def,
-        required_resources=required_resources,
-        tags=tags,
-        rerun_failing=True
-    )
-    print(job.job_url, job.status)
-    return job.status
+    return job_def
 
 
 def _get_sampling_rate_for_electrical_series(g: h5py.Group) -> Union[float, None]:
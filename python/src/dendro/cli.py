@@ -10,6 +10,7 @@ from .compute_client.start_compute_client import (
 )
 from .compute_client.run_pending_job import run_pending_job as run_pending_job_function
 from .sdk._make_spec_file import make_app_spec_file_function
+from .sdk._app_zygote import run_app_zygote
 
 
 # ------------------------------------------------------------
@@ -77,33 +78,13 @@ def make_app_spec_file(app_dir: str, spec_output_file: str):
 
 
 # ------------------------------------------------------------
-# Internal job monitoring process
+# Internal: app zygote (see compute_client/TrustedAppPool.py)
 # ------------------------------------------------------------
-@click.command(help="Internal job monitoring process")
-@click.argument(
-    "monitor_type",
-    type=click.Choice(["resource_utilization", "console_output", "job_status"]),
-)
-@click.option("--parent-pid", required=True, help="Parent PID")
-def internal_job_monitor(monitor_type: str, parent_pid: str):
-    if monitor_type == "resource_utilization":
-        from .internal_job_monitoring.resource_utilization_monitor import (
-            resource_utilization_monitor,
-        )
-
-        resource_utilization_monitor(parent_pid=parent_pid)
-    elif monitor_type == "console_output":
-        from .internal_job_monitoring.console_output_monitor import (
-            console_output_monitor,
-        )
-
-        console_output_monitor(parent_pid=parent_pid)
-    elif monitor_type == "job_status":
-        from .internal_job_monitoring.job_status_monitor import job_status_monitor
-
-        job_status_monitor(parent_pid=parent_pid)
-    else:
-        raise Exception(f"Unrecognized monitor_type: {monitor_type}")
+@click.command(help="Internal: preload a trusted app and fork a process for each job", hidden=True)
+@click.option("--app-executable", required=True, help="Path to the main.py of the app")
+@click.option("--socket", "socket_path", required=True, help="Path of the unix socket to listen on")
+def internal_app_zygote(app_executable: str, socket_path: str):
+    run_app_zygote(app_executable=app_executable, socket_path=socket_path)
 
 
 # ------------------------------------------------------------
@@ -118,4 +99,4 @@ main.add_command(register_compute_client)
 main.add_command(start_compute_client)
 main.add_command(run_pending_job)
 main.add_command(make_app_spec_file)
-main.add_command(internal_job_monitor)
+main.add_command(internal_app_zygote)
@@ -1,3 +1,4 @@
 from .submit_job import submit_job  # noqa: F401
+from .submit_jobs import submit_jobs  # noqa: F401
 from ..common.dendro_types import DendroJobDefinition, DendroJobRequiredResources, DendroJobInputFile, DendroJobOutputFile, DendroJobParameter  # noqa: F401
 from ..common.DendroJob import DendroJob  # noqa: F401
@@ -1,8 +1,8 @@
 import os
-from typing import List, Union
+from typing import List, Union, Set, Dict, Tuple
 from ..common.api_requests import create_job
 from ..common.dendro_types import DendroJobDefinition, DendroJobRequiredResources, DendroJobOutputFile
-from ..common.DendroJob import SpecialJobOutput
+from ..common.DendroJob import SpecialJobOutput, DendroJob
 
 
 def submit_job(
@@ -52,24 +52,9 @@ def submit_job(
     user_api_key = os.environ.get('DENDRO_API_KEY', None)
     if user_api_key is None:
         raise Exception('DENDRO_API_KEY environment variable must be set')
-    job_dependencies = []
 
     # resolve the inputs that are job output file results
-    for input_file in job_definition.inputFiles:
-        if isinstance(input_file.url, SpecialJobOutput):
-            special_job_output = input_file.url
-        elif isinstance(input_file.url, DendroJobOutputFile):
-            if not hasattr(input_file.url, '_special_job_output'):
-                raise Exception(f'URL not set for input file {input_file.name}. If this is a job output file, you must submit the associated job first.')
-            special_job_output = getattr(input_file.url, '_special_job_output')
-        else:
-            special_job_output = None
-        if special_job_output:
-            assert special_job_output.url
-            input_file.url = special_job_output.url
-            dependency_job_id = special_job_output.jobId
-            if dependency_job_id not in job_dependencies:
-                job_dependencies.append(dependency_job_id)
+    job_dependencies = _resolve_job_output_inputs(job_definition)
 
     if target_compute_client_ids is None:
         target_compute_client_ids = ['*']
@@ -89,6 +74,52 @@ def submit_job(
         delete_failing=delete_failing
     )
 
+    _set_special_job_outputs(job_definition, job)
+
+    return job
+
+
+def _resolve_job_output_inputs(job_definition: DendroJobDefinition, *, exclude_input_names: Union[Set[str], None] = None) -> List[str]:
+    """Replace the inputs that are outputs of previously submitted jobs by their URLs
+
+    Returns the IDs of the jobs that this job depends on.
+    """
+    resolved_urls, job_dependencies = _get_job_output_inputs(job_definition, exclude_input_names=exclude_input_names)
+    for input_file in job_definition.inputFiles:
+        if input_file.name in resolved_urls:
+            input_file.url = resolved_urls[input_file.name]
+    return job_dependencies
+
+
+def _get_job_output_inputs(job_definition: DendroJobDefinition, *, exclude_input_names: Union[Set[str], None] = None) -> Tuple[Dict[str, str], List[str]]:
+    """The URLs of the inputs that are outputs of previously submitted jobs
+
+    Returns the URLs by input name and the IDs of the jobs that this job
+    depends on, without modifying the job definition.
+    """
+    resolved_urls: Dict[str, str] = {}
+    job_dependencies = []
+    for input_file in job_definition.inputFiles:
+        if exclude_input_names is not None and input_file.name in exclude_input_names:
+            continue
+        if isinstance(input_file.url, SpecialJobOutput):
+            special_job_output = input_file.url
+        elif isinstance(input_file.url, DendroJobOutputFile):
+            if not hasattr(input_file.url, '_special_job_output'):
+                raise Exception(f'URL not set for input file {input_file.name}. If this is a job output file, you must submit the associated job first.')
+            special_job_output = getattr(input_file.url, '_special_job_output')
+        else:
+            special_job_output = None
+        if special_job_output:
+            assert special_job_output.url
+            resolved_urls[input_file.name] = special_job_output.url
+            dependency_job_id = special_job_output.jobId
+            if dependency_job_id not in job_dependencies:
+                job_dependencies.append(dependency_job_id)
+    return resolved_urls, job_dependencies
+
+
+def _set_special_job_outputs(job_definition: DendroJobDefinition, job: DendroJob):
     # Set attributes on the output files of the job
     for output_file in job_definition.outputFiles:
         special_job_output = job.get_output(output_file.name)
@@ -105,5 +136,3 @@ def submit_job(
             # setattr(m1, '_c', 3)
             # print(m1.model_dump())
             setattr(output_file, '_special_job_output', special_job_output)
-
-    return job
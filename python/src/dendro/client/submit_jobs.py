@@ -0,0 +1,290 @@
+import os
+from typing import List, Union, Dict, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from ..common.api_requests import create_job, create_jobs
+from ..common.http_session import HttpRequestError
+from ..common.dendro_types import DendroJobDefinition, DendroJobRequiredResources, DendroJobOutputFile
+from ..common.DendroJob import DendroJob
+from ..common.DendroJob import SpecialJobOutput
+from .submit_job import _get_job_output_inputs, _resolve_job_output_inputs, _set_special_job_outputs
+
+
+# The server limits the number of jobs per createJobs request (see
+# maxNumJobsPerCreateJobsRequest in apiHelpers/requestHandlers.ts)
+_max_num_jobs_per_request = 200
+
+
+def submit_jobs(
+    *,
+    service_name: str,
+    job_definitions: List[DendroJobDefinition],
+    required_resources: Union[DendroJobRequiredResources, List[DendroJobRequiredResources]],
+    target_compute_client_ids: Union[List[str], None] = None,
+    tags: List[str] = [],
+    skip_cache: bool = False,
+    rerun_failing: bool = False,
+    delete_failing: bool = False,
+    max_concurrent_requests: int = 8
+) -> List[DendroJob]:
+    """
+    Submit many jobs to the Dendro service using as few requests as possible.
+
+    An input of one job may be an output file of another job in the same list
+    (the job providing the output does not need to be submitted first). The
+    jobs are sent in batches, and the dependencies within a batch are resolved
+    by the server.
+
+    Parameters
+    ----------
+    service_name : str
+        The name of the service to submit the jobs to.
+    job_definitions : List[DendroJobDefinition]
+        The job definitions.
+    required_resources : DendroJobRequiredResources or List[DendroJobRequiredResources]
+        The required resources, either for all jobs or for each job.
+    target_compute_client_ids : List[str], optional
+        The compute client IDs to target for the jobs. If None, all compute
+        clients are targeted.
+    tags : List[str], optional
+        The tags to associate with the jobs.
+    skip_cache : bool, optional
+        See submit_job.
+    rerun_failing : bool, optional
+        See submit_job.
+    delete_failing : bool, optional
+        See submit_job.
+    max_concurrent_requests : int, optional
+        The maximum number of concurrent createJob requests when the server
+        does not support batched job creation.
+
+    Returns
+    -------
+    List[DendroJob]
+        The jobs, in the same order as the job definitions.
+    """
+    user_api_key = os.environ.get('DENDRO_API_KEY', None)
+    if user_api_key is None:
+        raise Exception('DENDRO_API_KEY environment variable must be set')
+    if isinstance(required_resources, list):
+        if len(required_resources) != len(job_definitions):
+            raise Exception('The number of required resources must match the number of job definitions')
+        required_resources_list = required_resources
+    else:
+        required_resources_list = [required_resources for _ in job_definitions]
+    if target_compute_client_ids is None:
+        target_compute_client_ids = ['*']
+
+    # Find the inputs that are outputs of other jobs in this list
+    refs = _get_job_output_refs(job_definitions)
+    order = _get_submission_order(len(job_definitions), refs)
+
+    jobs: List[Union[DendroJob, None]] = [None for _ in job_definitions]
+    use_batch_endpoint = True
+    i = 0
+    while i < len(order):
+        chunk = order[i:i + _max_num_jobs_per_request]
+        if use_batch_endpoint:
+            try:
+                chunk_jobs = _submit_chunk(
+                    service_name=service_name,
+                    chunk=chunk,
+                    job_definitions=job_definitions,
+                    required_resources_list=required_resources_list,
+                    refs=refs,
+                    target_compute_client_ids=target_compute_client_ids,
+                    tags=tags,
+                    user_api_key=user_api_key,
+                    skip_cache=skip_cache,
+                    rerun_failing=rerun_failing,
+                    delete_failing=delete_failing
+                )
+            except HttpRequestError as e:
+                if e.status_code != 404:
+                    raise
+                print('The server does not support batched job creation. Submitting jobs individually.')
+                use_batch_endpoint = False
+                continue
+            for job_index, job in zip(chunk, chunk_jobs):
+                _set_special_job_outputs(job_definitions[job_index], job)
+                jobs[job_index] = job
+        else:
+            _submit_individually(
+                service_name=service_name,
+                job_indices=order[i:],
+                job_definitions=job_definitions,
+                required_resources_list=required_resources_list,
+                refs=refs,
+                target_compute_client_ids=target_compute_client_ids,
+                tags=tags,
+                user_api_key=user_api_key,
+                skip_cache=skip_cache,
+                rerun_failing=rerun_failing,
+                delete_failing=delete_failing,
+                max_concurrent_requests=max_concurrent_requests,
+                jobs=jobs
+            )
+            break
+        i += len(chunk)
+    ret: List[DendroJob] = []
+    for job in jobs:
+        assert job is not None
+        ret.append(job)
+    return ret
+
+
+def _get_job_output_refs(job_definitions: List[DendroJobDefinition]) -> Dict[int, List[Tuple[str, int, str]]]:
+    # map from job index to a list of (input name, other job index, output name)
+    output_file_owners: Dict[int, Tuple[int, str]] = {}
+    for job_index, job_definition in enumerate(job_definitions):
+        for output_file in job_definition.outputFiles:
+            output_file_owners[id(output_file)] = (job_index, output_file.name)
+    refs: Dict[int, List[Tuple[str, int, str]]] = {}
+    for job_index, job_definition in enumerate(job_definitions):
+        for input_file in job_definition.inputFiles:
+            if isinstance(input_file.url, DendroJobOutputFile) and id(input_file.url) in output_file_owners:
+                other_job_index, output_name = output_file_owners[id(input_file.url)]
+                if other_job_index == job_index:
+                    raise Exception(f'Job {job_index} uses its own output as an input')
+                refs.setdefault(job_index, []).append((input_file.name, other_job_index, output_name))
+    return refs
+
+
+def _get_submission_order(num_jobs: int, refs: Dict[int, List[Tuple[str, int, str]]]) -> List[int]:
+    # Each job comes after the jobs whose outputs it uses
+    order: List[int] = []
+    state: Dict[int, str] = {}
+
+    def visit(job_index: int):
+        if state.get(job_index) == 'done':
+            return
+        if state.get(job_index) == 'visiting':
+            raise Exception('Circular dependency between job definitions')
+        state[job_index] = 'visiting'
+        for _, other_job_index, _ in refs.get(job_index, []):
+            visit(other_job_index)
+        state[job_index] = 'done'
+        order.append(job_index)
+    for job_index in range(num_jobs):
+        visit(job_index)
+    return order
+
+
+def _submit_chunk(
+    *,
+    service_name: str,
+    chunk: List[int],
+    job_definitions: List[DendroJobDefinition],
+    required_resources_list: List[DendroJobRequiredResources],
+    refs: Dict[int, List[Tuple[str, int, str]]],
+    target_compute_client_ids: List[str],
+    tags: List[str],
+    user_api_key: str,
+    skip_cache: bool,
+    rerun_failing: bool,
+    delete_failing: bool
+) -> List[DendroJob]:
+    position_in_chunk = {job_index: k for k, job_index in enumerate(chunk)}
+    jobs_in_request = []
+    for job_index in chunk:
+        job_definition = job_definitions[job_index]
+        # Inputs that refer to jobs in this chunk are resolved by the server.
+        # Inputs that refer to jobs in previous chunks were already submitted
+        # and are resolved here.
+        job_output_refs = []
+        refs_in_chunk = {}
+        for input_name, other_job_index, output_name in refs.get(job_index, []):
+            if other_job_index in position_in_chunk:
+                refs_in_chunk[input_name] = other_job_index
+                job_output_refs.append({
+                    'inputName': input_name,
+                    'jobIndex': position_in_chunk[other_job_index],
+                    'outputName': output_name
+                })
+        # The job definition is not modified here, so that the jobs can
+        # still be submitted individually if the request fails
+        resolved_urls, job_dependencies = _get_job_output_inputs(job_definition, exclude_input_names=set(refs_in_chunk.keys()))
+        job_definition_dict = job_definition.model_dump(exclude_none=True)  # important to exclude none here for the cacheBust field
+        for f in job_definition_dict['inputFiles']:
+            if f['name'] in refs_in_chunk:
+                f['url'] = ''  # will be set by the server
+            elif f['name'] in resolved_urls:
+                f['url'] = resolved_urls[f['name']]
+        jobs_in_request.append({
+            'batchId': '',
+            'tags': tags,
+            'jobDefinition': job_definition_dict,
+            'requiredResources': required_resources_list[job_index].model_dump(),
+            'targetComputeClientIds': target_compute_client_ids,
+            'secrets': [],
+            'jobDependencies': job_dependencies,
+            'inputFileJobOutputRefs': job_output_refs
+        })
+    jobs = create_jobs(
+        service_name=service_name,
+        jobs=jobs_in_request,
+        user_api_key=user_api_key,
+        skip_cache=skip_cache,
+        rerun_failing=rerun_failing,
+        delete_failing=delete_failing
+    )
+    # Now that the jobs are created, update the inputs that are outputs of
+    # other jobs in the job definitions with the urls resolved by the server
+    for job_index, job in zip(chunk, jobs):
+        for input_file in job_definitions[job_index].inputFiles:
+            if isinstance(input_file.url, (SpecialJobOutput, DendroJobOutputFile)):
+                resolved = next((f for f in job.jobDefinition.inputFiles if f.name == input_file.name), None)
+                if resolved is not None:
+                    input_file.url = resolved.url
+    return jobs
+
+
+def _submit_individually(
+    *,
+    service_name: str,
+    job_indices: List[int],
+    job_definitions: List[DendroJobDefinition],
+    required_resources_list: List[DendroJobRequiredResources],
+    refs: Dict[int, List[Tuple[str, int, str]]],
+    target_compute_client_ids: List[str],
+    tags: List[str],
+    user_api_key: str,
+    skip_cache: bool,
+    rerun_failing: bool,
+    delete_failing: bool,
+    max_concurrent_requests: int,
+    jobs: List[Union[DendroJob, None]]
+):
+    # Fallback for servers without the createJobs endpoint. The jobs are
+    # submitted concurrently in waves, where each wave only contains jobs
+    # whose dependencies were submitted in previous waves.
+    remaining = list(job_indices)
+    with ThreadPoolExecutor(max_workers=max_concurrent_requests) as executor:
+        while len(remaining) > 0:
+            wave = [
+                job_index for job_index in remaining
+                if all(jobs[other_job_index] is not None for _, other_job_index, _ in refs.get(job_index, []))
+            ]
+            if len(wave) == 0:
+                raise Exception('Unexpected: unable to resolve dependencies between job definitions')
+
+            def submit(job_index: int) -> DendroJob:
+                job_definition = job_definitions[job_index]
+                job_dependencies = _resolve_job_output_inputs(job_definition)
+                return create_job(
+                    service_name=service_name,
+                    batch_id='',
+                    tags=tags,
+                    job_definition=job_definition,
+                    required_resources=required_resources_list[job_index],
+                    target_compute_client_ids=target_compute_client_ids,
+                    secrets=[],
+                    user_api_key=user_api_key,
+                    job_dependencies=job_dependencies,
+                    skip_cache=skip_cache,
+                    rerun_failing=rerun_failing,
+                    delete_failing=delete_failing
+                )
+            for job_index, job in zip(wave, executor.map(submit, wave)):
+                _set_special_job_outputs(job_definitions[job_index], job)
+                jobs[job_index] = job
+            remaining = [job_index for job_index in remaining if job_index not in wave]
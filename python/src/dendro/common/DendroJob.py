@@ -39,6 +39,17 @@ class DendroJobRequiredResources(BaseModel):
     timeSec: float
 
 
+# measured by the job (see internal_job_monitoring/JobSupervisor.py)
+class DendroJobResourceUsage(BaseModel):
+    source: str  # 'cgroup' or 'process_tree'
+    cpuSec: float
+    peakMemoryBytes: Union[float, None] = None
+    readBytes: Union[float, None] = None
+    writtenBytes: Union[float, None] = None
+    memoryHighEvents: Union[int, None] = None
+    oomKillEvents: Union[int, None] = None
+
+
 class DendroJobSecret(BaseModel):
     name: str
     value: str
@@ -97,6 +108,7 @@ class DendroJob(BaseModel):
     computeClientName: Union[str, None] = None
     computeClientUserId: Union[str, None] = None
     imageUri: Union[str, None] = None
+    resourceUsage: Union[DendroJobResourceUsage, None] = None
 
     @property
     def job_url(self):
@@ -150,7 +162,8 @@ class DendroJob(BaseModel):
                 'error',
                 'computeClientId',
                 'computeClientName',
-                'imageUri'
+                'imageUri',
+                'resourceUsage'
             ]
             for field in fields_to_copy:
                 setattr(self, field, getattr(job, field))
@@ -1,11 +1,10 @@
-import time
 import os
-import requests
 from typing import Union, Literal
 from typing import List
 from .dendro_types import DendroServiceApp
 from .DendroJob import DendroJob
 from ..common.dendro_types import DendroJobDefinition, DendroJobRequiredResources, DendroJobSecret
+from .http_session import get_http_session, with_retries, HttpRequestError
 
 dendro_api_url = os.getenv('DENDRO_API_URL', 'https://dendro.vercel.app')
 
@@ -41,13 +40,29 @@ def get_service_app(*,
     return app
 
 
+def get_service_apps(*, service_name: str) -> List[DendroServiceApp]:
+    req = {
+        'type': 'getServiceAppsRequest',
+        'serviceName': service_name
+    }
+    resp = _post_api_request(
+        url_path='/api/getServiceApps',
+        data=req,
+        headers={}
+    )
+    if resp['type'] != 'getServiceAppsResponse':
+        raise Exception('Unexpected response for getServiceAppsRequest')
+    return [DendroServiceApp(**app) for app in resp['serviceApps']]
+
+
 def set_job_status(
     *,
     job_id: str,
     job_private_key: str,
     compute_client_id: str,
     status: str,
-    error: Union[str, None]
+    error: Union[str, None],
+    resource_usage: Union[dict, None] = None
 ):
     # export type SetJobStatusRequest = {
     #   type: 'setJobStatusRequest'
@@ -55,6 +70,7 @@ def set_job_status(
     #   computeClientId: string
     #   status: DendroJobStatus
     #   error?: string
+    #   resourceUsage?: DendroJobResourceUsage
     # }
     req = {
         'type': 'setJobStatusRequest',
@@ -64,6 +80,8 @@ def set_job_status(
     }
     if error is not None:
         req['error'] = error
+    if resource_usage is not None:
+        req['resourceUsage'] = resource_usage
     headers = {
         'Authorization': f'Bearer: {job_private_key}'
     }
@@ -107,6 +125,30 @@ def get_runnable_jobs_for_compute_client(
     return runnable_jobs, running_jobs
 
 
+def compute_client_heartbeat(
+    *,
+    compute_client_id: str,
+    compute_client_private_key: str,
+    running_job_ids: List[str]
+) -> List[str]:
+    """Report the jobs running on the compute client and return the IDs of those that should be stopped"""
+    url_path = '/api/computeClientHeartbeat'
+    req = {
+        'type': 'computeClientHeartbeatRequest',
+        'computeClientId': compute_client_id,
+        'runningJobIds': running_job_ids
+    }
+    headers = {
+        'Authorization': f'Bearer {compute_client_private_key}'
+    }
+    resp = _post_api_request(
+        url_path=url_path,
+        data=req,
+        headers=headers
+    )
+    return resp['canceledJobIds']
+
+
 def get_runnable_job(*, job_id: str, user_api_key: str):
     url_path = '/api/getRunnableJob'
     req = {
@@ -185,7 +227,8 @@ def get_upload_url(*,
     upload_type: Literal['output', 'consoleOutput', 'resourceUtilizationLog', 'other'],
     output_name: Union[str, None],
     other_name: Union[str, None],
-    size: int
+    size: int,
+    upload_id: Union[str, None] = None
 ):
     # // getSignedUploadUrl
     # export type GetSignedUploadUrlRequest = {
@@ -195,6 +238,7 @@ def get_upload_url(*,
     #   outputName?: string
     #   otherName?: string
     #   size: number
+    #   uploadId?: string // to resume an existing multipart upload
     # }
     #
     # export type GetSignedUploadUrlResponse = {
@@ -215,6 +259,8 @@ def get_upload_url(*,
         req['outputName'] = output_name
     if other_name is not None:
         req['otherName'] = other_name
+    if upload_id is not None:
+        req['uploadId'] = upload_id
     headers = {
         'Authorization': f'Bearer {job_private_key}'
     }
@@ -362,6 +408,55 @@ def create_job(
     return job
 
 
+def create_jobs(
+    *,
+    service_name: str,
+    jobs: List[dict],
+    user_api_key: str,
+    skip_cache: bool = False,
+    rerun_failing: bool = False,
+    delete_failing: bool = False
+) -> List[DendroJob]:
+    # export type CreateJobsRequest = {
+    #   type: 'createJobsRequest'
+    #   serviceName: string
+    #   userId: string
+    #   jobs: CreateJobsRequestJob[]
+    #   skipCache?: boolean
+    #   rerunFailing?: boolean
+    #   deleteFailing?: boolean
+    # }
+    #
+    # export type CreateJobsResponse = {
+    #   type: 'createJobsResponse'
+    #   jobs: DendroJob[]
+    # }
+    req = {
+        'type': 'createJobsRequest',
+        'serviceName': service_name,
+        'userId': '',  # determined from the api key
+        'jobs': jobs,
+        'skipCache': skip_cache,
+        'rerunFailing': rerun_failing,
+        'deleteFailing': delete_failing
+    }
+    headers = {
+        'Authorization': f'Bearer: {user_api_key}'
+    }
+    resp = _post_api_request(
+        url_path='/api/createJobs',
+        data=req,
+        headers=headers,
+        # A failed request may have created some of the jobs. Without
+        # skip_cache, a retry gets those same jobs back from the server's job
+        # cache, but with skip_cache it would create them a second time.
+        num_retries=1 if skip_cache else 4
+    )
+    if resp['type'] != 'createJobsResponse':
+        raise Exception('Unexpected response for createJobsRequest')
+    return [DendroJob(**job) for job in resp['jobs']]
+
+
 def set_output_url(
     *,
     job_id: str,
@@ -418,24 +513,18 @@ def api_get_dandi_api_key(*,
 def _post_api_request(*,
     url_path: str,
     data: dict,
-    headers: Union[dict, None] = None
+    headers: Union[dict, None] = None,
+    num_retries: int = 4
 ) -> dict:
-    num_retries = 4
-    retry_delay = 1
-    for i in range(num_retries):
-        try:
-            return _post_api_request_try(
-                url_path=url_path,
-                data=data,
-                headers=headers
-            )
-        except Exception as e:
-            if i == num_retries - 1:
-                raise
-            print(f'Error in client post api request for {url_path}; retrying in {retry_delay} seconds; {e}')
-            time.sleep(retry_delay)
-            retry_delay *= 2
-    raise Exception('Impossible')
+    return with_retries(
+        lambda: _post_api_request_try(
+            url_path=url_path,
+            data=data,
+            headers=headers
+        ),
+        label=f'client post api request for {url_path}',
+        num_retries=num_retries
+    )
 
 
 def _post_api_request_try(*,
@@ -446,10 +535,10 @@ def _post_api_request_try(*,
     assert url_path.startswith('/api')
     url = f'{dendro_api_url}{url_path}'
     try:
-        resp = requests.post(url, headers=headers, json=data, timeout=60)
+        resp = get_http_session().post(url, headers=headers, json=data, timeout=60)
     except Exception as e:
         print(f'Error in client post api request for {url}; {e}')
         raise
     if resp.status_code != 200:
-        raise Exception(f'Error in client post api request for {url}: {resp.status_code} {resp.reason}: {resp.text}')
+        raise HttpRequestError(f'Error in client post api request for {url}: {resp.status_code} {resp.reason}: {resp.text}', status_code=resp.status_code)
     return resp.json()
@@ -0,0 +1,261 @@
+from typing import Dict, List, Union
+import os
+
+
+# Resource isolation and accounting of jobs with cgroups v2 (Linux).
+#
+# On the compute client, each job gets its own cgroup under the cgroup of the
+# compute client, with
+# * cpu.max: the number of CPUs of the job (hard limit on CPU time)
+# * memory.high: the memory of the job. This is a soft limit: the job is
+#   throttled and reclaimed when it goes over, but it is not killed, so that it
+#   can still clean up and report what happened
+# * io.weight: proportional to the number of CPUs of the job
+# This requires the cgroup of the compute client to be delegated to the user
+# (e.g., systemd-run --user --scope -p Delegate=yes), otherwise the jobs run
+# without limits. Set COMPUTE_CLIENT_USE_CGROUPS=0 to disable.
+#
+# Docker jobs get the same job cgroup, as the parent of the cgroup that docker
+# creates for the container (docker run --cgroup-parent), so that the limits
+# apply to the container. This needs the cgroupfs cgroup driver of docker (with
+# the systemd driver, the parent must be a systemd slice). Otherwise, docker
+# jobs are limited with the docker run options, and they get no soft memory
+# limit: docker has no option for memory.high, and --memory-reservation is
+# memory.low, which protects the memory of the container rather than limiting
+# it.
+#
+# In the job, the usage is read from the cgroup of the job (see
+# get_job_cgroup_dir and read_cgroup_usage).
+
+_cgroup_root = '/sys/fs/cgroup'
+_job_controllers = ['cpu', 'memory', 'io']
+
+
+def get_own_cgroup_dir() -> Union[str, None]:
+    """The cgroup v2 directory of this process, or None if cgroups v2 is not available"""
+    try:
+        with open('/proc/self/cgroup', 'r') as f:
+            lines = f.read().splitlines()
+    except: # noqa
+        return None
+    for line in lines:
+        # the cgroup v2 line is 0::<path>
+        if line.startswith('0::'):
+            path = _cgroup_root + line[3:].rstrip('/')
+            if os.path.exists(f'{path}/cgroup.procs'):
+                return path
+    return None
+
+
+def get_job_cgroup_dir() -> Union[str, None]:
+    """The cgroup of the job that this process is part of, as set by the compute client
+
+    DENDRO_JOB_CGROUP is either the path of the cgroup or "self" for the
+    cgroup of this process (e.g., the cgroup of a docker container).
+    """
+    x = os.environ.get('DENDRO_JOB_CGROUP', None)
+    if not x:
+        return None
+    if x == 'self':
+        return get_own_cgroup_dir()
+    return x if os.path.isdir(x) else None
+
+
+def read_cgroup_usage(cgroup_dir: str) -> Union[Dict[str, float], None]:
+    """Cumulative resource usage of all the processes that ran in the cgroup
+
+    Returns None if the usage can't be read. memory_peak is only available
+    with Linux 5.19 or later, and io is only available if the io controller is
+    enabled.
+    """
+    cpu_stat = _read_key_values(f'{cgroup_dir}/cpu.stat')
+    if cpu_stat is None or 'usage_usec' not in cpu_stat:
+        return None
+    ret: Dict[str, float] = {
+        'cpu_usage_sec': cpu_stat['usage_usec'] / 1e6,
+        'memory_current': float('nan'),
+        'memory_peak': float('nan'),
+        'memory_high_events': float('nan'),
+        'oom_kill_events': float('nan'),
+        'read_bytes': float('nan'),
+        'write_bytes': float('nan')
+    }
+    memory_current = _read_number(f'{cgroup_dir}/memory.current')
+    if memory_current is not None:
+        ret['memory_current'] = memory_current
+    memory_peak = _read_number(f'{cgroup_dir}/memory.peak')
+    if memory_peak is not None:
+        ret['memory_peak'] = memory_peak
+    memory_events = _read_key_values(f'{cgroup_dir}/memory.events')
+    if memory_events is not None:
+        ret['memory_high_events'] = memory_events.get('high', 0)
+        ret['oom_kill_events'] = memory_events.get('oom_kill', 0)
+    io_stat = _read_io_stat(f'{cgroup_dir}/io.stat')
+    if io_stat is not None:
+        ret['read_bytes'] = io_stat['rbytes']
+        ret['write_bytes'] = io_stat['wbytes']
+    return ret
+
+
+def create_job_cgroup(
+    *,
+    job_id: str,
+    num_cpus: Union[int, None],
+    memory_gb: Union[float, None],
+    for_child_cgroups: bool = False
+) -> Union[str, None]:
+    """Create a cgroup with the limits of the job, or return None if cgroups can't be used
+
+    With for_child_cgroups, the processes of the job go in child cgroups of
+    the job cgroup (e.g., the cgroup of a docker container) rather than in the
+    job cgroup itself, so the controllers are enabled for the children.
+    """
+    parent = _get_jobs_cgroup_parent()
+    if parent is None:
+        return None
+    path = f'{parent}/job-{job_id}'
+    try:
+        os.makedirs(path, exist_ok=True)
+        available = _read_controllers(f'{path}/cgroup.controllers')
+        if 'cpu' in available and num_cpus:
+            # quota and period in microseconds
+            _write(f'{path}/cpu.max', f'{int(num_cpus * 100000)} 100000')
+        if 'memory' in available and memory_gb:
+            _write(f'{path}/memory.high', str(int(memory_gb * 1024 * 1024 * 1024)))
+        if 'io' in available and os.path.exists(f'{path}/io.weight'):
+            _write(f'{path}/io.weight', f'default {min(10000, max(1, 100 * (num_cpus or 1)))}')
+        if for_child_cgroups:
+            enabled = [c for c in _job_controllers if c in available]
+            if enabled:
+                _write(f'{path}/cgroup.subtree_control', ' '.join(f'+{c}' for c in enabled))
+    except Exception as e:
+        print(f'Unable to set up cgroup for job {job_id}: {e}')
+        return None
+    return path
+
+
+def get_cgroup_path(cgroup_dir: str) -> str:
+    """The path of the cgroup relative to the cgroup root (e.g., for docker run --cgroup-parent)"""
+    return cgroup_dir[len(_cgroup_root):]
+
+
+def remove_job_cgroup(job_id: str):
+    """Remove the cgroup of a job (if any) once all its processes have exited"""
+    parent = _get_jobs_cgroup_parent()
+    if parent is None:
+        return
+    try:
+        os.rmdir(f'{parent}/job-{job_id}')
+    except OSError:
+        # still has processes, or already removed
+        pass
+
+
+def get_cgroup_enter_command(cgroup_dir: str, cmd: List[str]) -> List[str]:
+    """Wrap a command so that it runs in the cgroup (and so do all its descendants)
+
+    This is done by the child process itself rather than with a preexec_fn,
+    which is not safe in a process that has threads.
+    """
+    return ['/bin/sh', '-c', 'echo $$ > "$0/cgroup.procs" && exec "$@"', cgroup_dir] + cmd
+
+
+def enter_cgroup(cgroup_dir: str):
+    """Move this process into the cgroup"""
+    _write(f'{cgroup_dir}/cgroup.procs', str(os.getpid()))
+
+
+_jobs_cgroup_parent: Union[str, None] = None
+_jobs_cgroup_parent_checked = False
+
+
+def _get_jobs_cgroup_parent() -> Union[str, None]:
+    global _jobs_cgroup_parent, _jobs_cgroup_parent_checked
+    if _jobs_cgroup_parent_checked:
+        return _jobs_cgroup_parent
+    _jobs_cgroup_parent_checked = True
+    if os.environ.get('COMPUTE_CLIENT_USE_CGROUPS', '1') == '0':
+        return None
+    own = get_own_cgroup_dir()
+    if own is None or not os.access(own, os.W_OK) or not os.access(f'{own}/cgroup.subtree_control', os.W_OK):
+        print('cgroups v2 is not available or not delegated to this user. Jobs will run without resource limits.')
+        return None
+    try:
+        # A cgroup that has controllers enabled for its children can't have
+        # processes of its own (other than the root), so the compute client
+        # moves itself (and anything else in its cgroup) to a leaf cgroup
+        daemon_cgroup = f'{own}/compute_client'
+        os.makedirs(daemon_cgroup, exist_ok=True)
+        with open(f'{own}/cgroup.procs', 'r') as f:
+            pids = [line.strip() for line in f if line.strip()]
+        for pid in pids:
+            try:
+                _write(f'{daemon_cgroup}/cgroup.procs', pid)
+            except OSError:
+                # exited, or a kernel thread
+                pass
+        available = _read_controllers(f'{own}/cgroup.controllers')
+        enabled = [c for c in _job_controllers if c in available]
+        if enabled:
+            _write(f'{own}/cgroup.subtree_control', ' '.join(f'+{c}' for c in enabled))
+        print(f'Using cgroup {own} for the jobs (controllers: {", ".join(enabled)})')
+    except Exception as e:
+        print(f'Unable to set up cgroups for the jobs: {e}. Jobs will run without resource limits.')
+        return None
+    _jobs_cgroup_parent = own
+    return own
+
+
+def _read_controllers(path: str) -> List[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().split()
+    except: # noqa
+        return []
+
+
+def _read_number(path: str) -> Union[float, None]:
+    try:
+        with open(path, 'r') as f:
+            return float(f.read().strip())
+    except: # noqa
+        return None
+
+
+def _read_key_values(path: str) -> Union[Dict[str, float], None]:
+    # e.g., cpu.stat and memory.events: one "<key> <value>" per line
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except: # noqa
+        return None
+    ret: Dict[str, float] = {}
+    for line in lines:
+        parts = line.split()
+        if len(parts) == 2:
+            try:
+                ret[parts[0]] = float(parts[1])
+            except ValueError:
+                pass
+    return ret
+
+
+def _read_io_stat(path: str) -> Union[Dict[str, float], None]:
+    # one line per device: "<major>:<minor> rbytes=... wbytes=... rios=... ..."
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except: # noqa
+        return None
+    ret = {'rbytes': 0.0, 'wbytes': 0.0}
+    for line in lines:
+        for item in line.split()[1:]:
+            key, _, value = item.partition('=')
+            if key in ret:
+                ret[key] += float(value)
+    return ret
+
+
+def _write(path: str, value: str):
+    with open(path, 'w') as f:
+        f.write(value)
@@ -0,0 +1,91 @@
+from typing import Callable, TypeVar, Union
+import os
+import time
+import random
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# A single requests session is shared by everything in the process (API
+# requests, console output and resource log uploads, job status polling, ...)
+# so that connections are kept alive and reused rather than doing a new TCP and
+# TLS handshake for every request.
+
+_session: Union[requests.Session, None] = None
+_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Get the process-wide pooled HTTP session
+
+    The size of the connection pool (per host) can be set using the
+    DENDRO_HTTP_POOL_SIZE environment variable.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            pool_size = int(os.environ.get('DENDRO_HTTP_POOL_SIZE', '16'))
+            session = requests.Session()
+            # We do our own retries (see with_retries) so that they are jittered
+            # and so that the retry logic is the same for all requests
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def _reset_http_session_after_fork():
+    # Connections must not be shared between a parent and a forked child
+    global _session, _session_lock
+    _session = None
+    _session_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_http_session_after_fork)
+
+
+class HttpRequestError(Exception):
+    def __init__(self, message: str, *, status_code: Union[int, None] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """Whether a failed request is worth retrying
+
+    Network errors, server errors and rate limiting are retried, but other
+    client errors (e.g., 400 or 401) are not going to succeed on a retry.
+    """
+    if isinstance(e, HttpRequestError) and e.status_code is not None:
+        return e.status_code >= 500 or e.status_code == 429
+    return True
+
+
+T = TypeVar('T')
+
+
+def with_retries(
+    func: Callable[[], T],
+    *,
+    label: str,
+    num_retries: int = 4,
+    retry_delay: float = 1,
+    is_retryable: Callable[[Exception], bool] = is_retryable_error
+) -> T:
+    """Call func, retrying with jittered exponential backoff on retryable errors"""
+    for i in range(num_retries):
+        try:
+            return func()
+        except Exception as e:
+            if i == num_retries - 1 or not is_retryable(e):
+                raise
+            # randomize the delay so that many clients that failed at the
+            # same time don't all retry at the same time
+            delay = random.uniform(retry_delay / 2, retry_delay * 1.5)
+            print(f'Error in {label}; retrying in {delay:.1f} seconds; {e}')
+            time.sleep(delay)
+            retry_delay *= 2
+    raise Exception('Impossible')
@@ -1,12 +1,12 @@
-from typing import Optional
+from typing import Optional, List
 import os
 import time
-import shutil
-import multiprocessing
+import queue
 import traceback
-from pathlib import Path
 from .JobManager import JobManager
-from ..common.api_requests import get_pubsub_subscription, get_runnable_jobs_for_compute_client
+from .JobDirGarbageCollector import JobDirGarbageCollector
+from ..common.api_requests import get_pubsub_subscription, get_runnable_jobs_for_compute_client, compute_client_heartbeat
+from ..common.http_session import HttpRequestError
 from ._start_job import _start_job
 
 
@@ -29,9 +29,21 @@ class ComputeClientDaemon:
 
         self._is_idle = False  # this is relevant only if exit_when_idle is True
 
+        # Heartbeats are only useful for jobs with a control channel (see
+        # JobManager.cancel_job). Set to False if the server does not support
+        # them.
+        self._heartbeat_supported = not single_job
+
+        # All the things that the daemon reacts to (pubsub messages, job
+        # containers exiting) are posted to this queue as dicts with a type field
+        self._event_queue: queue.Queue = queue.Queue()
+
         self._job_manager = JobManager(
             compute_client_id=compute_client_id,
-            compute_client_private_key=compute_client_private_key
+            compute_client_private_key=compute_client_private_key,
+            event_queue=self._event_queue,
+            # in single job mode there are no pubsub messages to forward
+            use_control_channel=not single_job
         )
 
     def start(self, cleanup_old_jobs=True, timeout: Optional[float] = None):
@@ -47,33 +59,40 @@ class ComputeClientDaemon:
                 compute_client_private_key=self._compute_client_private_key
             )
             pubnub_subscribe_key = pubsub_subscription['pubnubSubscribeKey']
+            # The pubsub messages go directly into the event queue of the daemon
             pubsub_client = PubsubClient(
                 pubnub_subscribe_key=pubnub_subscribe_key,
                 pubnub_channel=pubsub_subscription['pubnubChannel'],
                 pubnub_user=pubsub_subscription['pubnubUser'],
-                compute_client_id=self._compute_client_id
+                compute_client_id=self._compute_client_id,
+                message_queue=self._event_queue
             )
         else:
             pubsub_client = None
 
-        # # Create file cache directory if needed
-        # file_cache_dir = os.path.join(os.getcwd(), 'file_cache')
-        # if not os.path.exists(file_cache_dir):
-        #     os.makedirs(file_cache_dir)
-
-        # Start cleaning up old job directories
-        # It's important to do this in a separate process
-        # because it can take a long time to delete all the files in the tmp directories
-        # and we don't want to block the main process from handling jobs
+        # Start cleaning up old job directories in a background thread (see
+        # JobDirGarbageCollector.py)
         if cleanup_old_jobs:
-            cleanup_old_jobs_process = multiprocessing.Process(target=_cleanup_old_job_working_directories, args=(os.getcwd() + '/jobs',))
-            cleanup_old_jobs_process.start()
+            job_dir_gc = JobDirGarbageCollector(
+                jobs_dir=os.getcwd() + '/jobs',
+                trash_dir=os.getcwd() + '/jobs_trash',
+                get_active_job_ids=self._job_manager.get_running_job_ids,
+                event_queue=self._event_queue
+            )
+            job_dir_gc.start()
+            # no new jobs when the disk is almost full
+            self._job_manager.set_job_dir_gc(job_dir_gc)
         else:
-            cleanup_old_jobs_process = None
+            job_dir_gc = None
 
         time_interval_to_check_for_new_jobs = 60 * 10
         if self._exit_when_idle:
             time_interval_to_check_for_new_jobs = 60 * 2
+        time_interval_to_report_running = 60 * 5
+        # One request for all the running jobs, which tells us about jobs that
+        # were canceled in case we missed the pubsub message
+        time_interval_to_send_heartbeat = 30
+        last_heartbeat = 0
 
         try:
             print('Starting compute client')
@@ -81,35 +100,71 @@ class ComputeClientDaemon:
             overall_timer = time.time()
             first_iteration = True
             while True:
+                # Block until something happens (a pubsub message, a job
+                # container exiting) or until the next timer is due
+                if first_iteration:
+                    events = []
+                else:
+                    next_deadline = min(
+                        timer_handle_jobs + time_interval_to_check_for_new_jobs,
+                        last_report_that_compute_client_is_running + time_interval_to_report_running
+                    )
+                    if self._heartbeat_supported and self._job_manager.get_num_running_jobs() > 0:
+                        next_deadline = min(next_deadline, last_heartbeat + time_interval_to_send_heartbeat)
+                    if timeout is not None:
+                        next_deadline = min(next_deadline, overall_timer + timeout)
+                    events = self._wait_for_events(timeout=max(0, next_deadline - time.time()))
+
                 elapsed_handle_jobs = time.time() - timer_handle_jobs
                 # normally we will get pubsub messages for updates, but if we don't, we should check every so often
                 is_time_to_handle_jobs = elapsed_handle_jobs > time_interval_to_check_for_new_jobs
-                if pubsub_client is not None:
-                    try:
-                        messages = pubsub_client.take_messages() if pubsub_client is not None else []
-                    except Exception as e:
-                        traceback.print_exc()
-                        print(f'Error getting pubsub messages: {e}')
-                        messages = []
-                    jobs_have_changed = False
-                    for msg in messages:
-                        # service_name = msg.get('serviceName', '')
-                        # todo: in future we want to restrict to only messages from the services that this compute client is subscribed to
-                        if msg['type'] == 'newPendingJob':
-                            jobs_have_changed = True
-                        elif msg['type'] == 'jobStatusChanged':
-                            jobs_have_changed = True
-                        elif msg['type'] == 'pingComputeClients':
-                            jobs_have_changed = True
-                            # will trigger a check for new jobs which will update the last active timestamp
-                else:
-                    jobs_have_changed = False
+                jobs_have_changed = False
+                for msg in events:
+                    # service_name = msg.get('serviceName', '')
+                    # todo: in future we want to restrict to only messages from the services that this compute client is subscribed to
+                    if msg['type'] == 'newPendingJob':
+                        jobs_have_changed = True
+                    elif msg['type'] == 'jobStatusChanged':
+                        jobs_have_changed = True
+                        if msg.get('canceled', False):
+                            # The job may be running on this node. Not for
+                            # the other statuses, e.g., completed or failed,
+                            # which a job sets itself when it finishes. A job
+                            # that was deleted is canceled by the heartbeat.
+                            try:
+                                self._job_manager.cancel_job(msg['jobId'])
+                            except Exception as e:
+                                print(f'Error canceling job {msg["jobId"]}: {e}')
+                    elif msg['type'] == 'pingComputeClients':
+                        jobs_have_changed = True
+                        # will trigger a check for new jobs which will update the last active timestamp
+                    elif msg['type'] == 'jobComputeFinished':
+                        self._job_manager.release_job_resources(msg['jobId'])
+                        jobs_have_changed = True
+                    elif msg['type'] == 'jobProcessExited' or msg['type'] == 'diskSpaceFreed':
+                        # resources were freed up, so there may be room for more jobs
+                        jobs_have_changed = True
+                    elif msg['type'] == 'imageReady':
+                        # jobs that were waiting for the image can start
+                        jobs_have_changed = True
 
                 if self._single_job and not first_iteration:
                     # do not handle additional jobs if we are in single job mode
                     is_time_to_handle_jobs = False
                     jobs_have_changed = False
 
+                # Reap the exited job containers before handling jobs so that
+                # their resources are available
+                try:
+                    self._job_manager.do_work()
+                except Exception as e:
+                    traceback.print_exc()
+                    print(f'Error doing work: {e}')
+
+                if self._heartbeat_supported and time.time() - last_heartbeat >= time_interval_to_send_heartbeat:
+                    last_heartbeat = time.time()
+                    self._send_heartbeat()
+
                 if is_time_to_handle_jobs or jobs_have_changed:
                     timer_handle_jobs = time.time()
                     try:
@@ -126,14 +181,8 @@ class ComputeClientDaemon:
                     print('No more jobs to run. Exiting because --single-job is set.')
                     return
 
-                try:
-                    self._job_manager.do_work()
-                except Exception as e:
-                    traceback.print_exc()
-                    print(f'Error doing work: {e}')
-
                 elapsed_since_report_that_compute_client_is_running = time.time() - last_report_that_compute_client_is_running
-                if elapsed_since_report_that_compute_client_is_running > 60 * 5:
+                if elapsed_since_report_that_compute_client_is_running >= time_interval_to_report_running:
                     print(f'Compute client is running: {self._compute_client_name}')
                     print(f'Compute client ID: {self._compute_client_id}')
                     config_url = f'https://dendro.vercel.app/compute_client/{self._compute_client_id}'
@@ -144,19 +193,33 @@ class ComputeClientDaemon:
                 if timeout is not None and overall_elapsed > timeout:
                     print(f'Compute client timed out after {timeout} seconds')
                     return
-                if overall_elapsed < 5:
-                    time.sleep(0.2) # for the first few seconds we can sleep for a short time
-                else:
-                    time.sleep(2)
 
                 first_iteration = False
         finally:
-            if cleanup_old_jobs_process is not None:
-                cleanup_old_jobs_process.terminate()
+            if job_dir_gc is not None:
+                job_dir_gc.stop()
             if pubsub_client is not None:
                 # right now there's no way to kill the pubsub client's websocket connection
                 pass
 
+    def _wait_for_events(self, *, timeout: float) -> List[dict]:
+        """Wait for at least one event (or the timeout) and return all pending events
+
+        Events that arrive together are returned together so that a burst of
+        pubsub messages results in a single check for new jobs.
+        """
+        events: List[dict] = []
+        try:
+            events.append(self._event_queue.get(block=True, timeout=timeout))
+        except queue.Empty:
+            return events
+        while True:
+            try:
+                events.append(self._event_queue.get(block=False))
+            except queue.Empty:
+                break
+        return events
+
     def run_pending_job(self, job_id: str, *, detach: bool = False):
         runnable_jobs, running_jobs = get_runnable_jobs_for_compute_client(
             compute_client_id=self._compute_client_id,
@@ -169,6 +232,34 @@ class ComputeClientDaemon:
             raise Exception(f'More than one runnable job with ID {job_id} found')
         _start_job(job=runnable_jobs[0], compute_client_id=self._compute_client_id, detach=detach)
 
+    def _send_heartbeat(self):
+        running_job_ids = self._job_manager.get_running_job_ids()
+        if len(running_job_ids) == 0:
+            return
+        try:
+            canceled_job_ids = compute_client_heartbeat(
+                compute_client_id=self._compute_client_id,
+                compute_client_private_key=self._compute_client_private_key,
+                running_job_ids=running_job_ids
+            )
+        except HttpRequestError as e:
+            if e.status_code == 404:
+                print('The server does not support compute client heartbeats.')
+                self._heartbeat_supported = False
+                return
+            print(f'Error sending heartbeat: {e}')
+            return
+        except Exception as e:
+            print(f'Error sending heartbeat: {e}')
+            return
+        for job_id in canceled_job_ids:
+            print(f'Job {job_id} should no longer be running. Canceling it.')
+            try:
+                if not self._job_manager.cancel_job(job_id):
+                    print(f'Unable to send cancel message to job {job_id}')
+            except Exception as e:
+                print(f'Error canceling job {job_id}: {e}')
+
     def _handle_jobs(self):
         # print('Checking for new jobs')
         runnable_jobs, running_jobs = get_runnable_jobs_for_compute_client(
@@ -176,25 +267,13 @@ class ComputeClientDaemon:
             compute_client_private_key=self._compute_client_private_key,
             single_job=self._single_job
         )
-        if len(runnable_jobs) > 0:
-            self._job_manager.handle_jobs(runnable_jobs)
-        else:
+        # Always hand the list to the job manager, even if it is empty, so
+        # that jobs that are no longer runnable get dropped from the local queue
+        self._job_manager.handle_jobs(runnable_jobs, running_jobs=running_jobs)
+        if len(runnable_jobs) == 0:
             if self._single_job:
                 self._is_idle = True
             else:
-                if len(running_jobs) == 0:
+                if len(running_jobs) == 0 and self._job_manager.get_num_running_jobs() == 0:
                     self._is_idle = True
 
-
-def _cleanup_old_job_working_directories(dir: str):
-    """Delete working dirs that are more than 24 hours old"""
-    jobs_dir = Path(dir)
-    while True:
-        if jobs_dir.exists():
-            for job_dir in jobs_dir.iterdir():
-                if job_dir.is_dir():
-                    elapsed = time.time() - job_dir.stat().st_mtime
-                    if elapsed > 24 * 60 * 60:
-                        print(f'Removing old working dir {job_dir}')
-                        shutil.rmtree(job_dir)
-        time.sleep(60)
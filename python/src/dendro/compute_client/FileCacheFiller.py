@@ -0,0 +1,107 @@
+from typing import Set, Union
+import os
+import json
+import socket
+import threading
+import traceback
+from ..sdk._file_cache import fill_cache_entry
+
+
+# Fills the input file cache (see sdk/_file_cache.py) on behalf of the jobs
+# that run in containers. The cache directory is mounted read-only into the
+# containers, so that a job can't modify the entries that the other jobs get.
+# Instead, a job asks for a file over a unix socket (fill.sock in the cache
+# directory, so it is mounted together with the cache), the file is downloaded
+# into the cache by the compute client, and the job gets the key of the entry.
+#
+# Only the input files of the jobs started by this compute client are filled
+# (see allow_urls), so that a job can't use the compute client to download
+# arbitrary urls. For other urls, the job downloads the file without the
+# cache.
+#
+# Protocol: one request per connection. The job sends a line of JSON
+# {"url": ...} and gets a line of JSON back: {"key": ..., "size": ...,
+# "hit": ...}, {"key": null} if the file can't be cached, or {"error": ...}.
+
+
+class FileCacheFiller:
+    def __init__(self, *, cache_dir: str, max_size: int) -> None:
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self.socket_path = f'{cache_dir}/fill.sock'
+        self._allowed_urls: Set[str] = set()
+        self._lock = threading.Lock()
+        self._sock: Union[socket.socket, None] = None
+
+    def start(self):
+        os.makedirs(self._cache_dir, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        # the jobs may run as a different user (e.g., root in docker)
+        os.chmod(self.socket_path, 0o666)
+        sock.listen(64)
+        self._sock = sock
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def allow_urls(self, urls: list):
+        """Allow the jobs to fill the cache with these urls"""
+        with self._lock:
+            self._allowed_urls.update(urls)
+
+    def _run(self):
+        assert self._sock is not None
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError as e:
+                print(f'File cache filler stopped: {e}')
+                return
+            # a download can take a while, so one thread per request
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn: socket.socket):
+        try:
+            with conn:
+                buf = b''
+                while not buf.endswith(b'\n'):
+                    data = conn.recv(4096)
+                    if not data:
+                        break
+                    buf += data
+                url = json.loads(buf.decode('utf-8'))['url']
+                try:
+                    resp = self._fill(url)
+                except Exception as e:
+                    print(f'Error filling file cache with {url}: {e}')
+                    resp = {'error': str(e)}
+                conn.sendall((json.dumps(resp) + '\n').encode('utf-8'))
+        except: # noqa
+            traceback.print_exc()
+
+    def _fill(self, url: str) -> dict:
+        with self._lock:
+            allowed = url in self._allowed_urls
+        if not allowed:
+            # the job downloads it without the cache
+            print(f'Not filling file cache with {url}: not an input file of a job of this compute client')
+            return {'key': None}
+        entry = fill_cache_entry(url, cache_dir=self._cache_dir, max_size=self._max_size)
+        if entry is None:
+            return {'key': None}
+        return entry
+
+
+_file_cache_filler: Union[FileCacheFiller, None] = None
+_file_cache_filler_lock = threading.Lock()
+
+
+def get_file_cache_filler(*, cache_dir: str, max_size: int) -> FileCacheFiller:
+    """The file cache filler of this compute client (one per process), started on first use"""
+    global _file_cache_filler
+    with _file_cache_filler_lock:
+        if _file_cache_filler is None:
+            _file_cache_filler = FileCacheFiller(cache_dir=cache_dir, max_size=max_size)
+            _file_cache_filler.start()
+        return _file_cache_filler
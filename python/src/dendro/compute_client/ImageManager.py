@@ -0,0 +1,405 @@
+from typing import Callable, Dict, List, Tuple, Union
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from ..common.http_session import get_http_session
+from ..common.api_requests import get_service_apps
+
+
+# Makes sure that the container images of the jobs are available locally
+# before the jobs start, and avoids pulling them again when they have not
+# changed.
+#
+# The digest of an image is obtained from its registry with a HEAD request on
+# the manifest, which is much cheaper than a pull. For docker, the image is
+# only pulled if the digest is not among the local digests of the image. For
+# apptainer, the image is converted to a SIF file once per digest and the SIF
+# files are cached in the image_cache directory of the compute client. If the
+# registry can't be reached, an image that was pulled less than
+# COMPUTE_CLIENT_IMAGE_PULL_TTL_SEC seconds ago (default one hour) is used as
+# is.
+#
+# An image that only exists locally (e.g., built with apps/*/build.sh and not
+# pushed) is used as is when it can't be pulled.
+#
+# Once an image has been checked, the result is reused for
+# COMPUTE_CLIENT_IMAGE_PULL_TTL_SEC seconds without contacting the registry,
+# so a burst of jobs with the same image makes a single check.
+#
+# prefetch() pulls images in the background, so that they are ready by the
+# time a job needs them. prefetch_service_images() does this for all the apps
+# of a service. get_image_if_ready() is for starting jobs from the daemon
+# thread: it never contacts the registry or docker itself (which could hold up
+# the start of all the other jobs). Unless the image was checked recently, it
+# returns None and checks (and pulls) the image in the background.
+
+_manifest_accept_header = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.manifest.v1+json'
+])
+
+
+class ImageManager:
+    def __init__(self, *, container_method: str, cache_dir: str) -> None:
+        self._container_method = container_method
+        self._cache_dir = cache_dir
+        self._pull_ttl_sec = float(os.environ.get('COMPUTE_CLIENT_IMAGE_PULL_TTL_SEC', str(60 * 60)))
+        # one lock per image so that an image is not pulled twice at the same
+        # time (e.g., by a prefetch and a job)
+        self._image_locks: Dict[str, threading.Lock] = {}
+        self._image_locks_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._pull_executor = ThreadPoolExecutor(max_workers=4)
+        # the following are shared with the pull threads (guarded by _lock)
+        self._lock = threading.Lock()
+        self._prefetched_images = set()
+        self._timestamp_service_images_prefetched: Dict[str, float] = {}
+        # the background pulls in progress, with the callbacks to call when
+        # they are done
+        self._pull_callbacks: Dict[str, List[Callable[[], None]]] = {}
+        # errors of the background pulls that jobs were waiting for
+        self._pull_errors: Dict[str, str] = {}
+        # (timestamp, what to pass to the container runtime) of the images
+        # that were checked, by image
+        self._checked_images: Dict[str, Tuple[float, str]] = {}
+
+    def get_image(self, image: str) -> str:
+        """Make sure that the image is available locally
+
+        Returns what to pass to the container runtime: the image name for
+        docker or the path of the SIF file for apptainer/singularity.
+        """
+        with self._get_image_lock(image):
+            ret = self._get_checked_image(image)
+            if ret is not None:
+                return ret
+            ret = self._check_image(image)
+            with self._lock:
+                self._checked_images[image] = (time.time(), ret)
+            return ret
+
+    def get_image_if_ready(self, image: str, *, on_ready: Callable[[], None]) -> Union[str, None]:
+        """Like get_image, but without waiting for the image to be pulled
+
+        Returns the image right away if it was checked recently. Otherwise
+        returns None, checks (and pulls if needed) the image in the
+        background, and calls on_ready (from another thread) once that is
+        done. If that pull failed, the next call raises the error.
+        """
+        with self._lock:
+            if image in self._pull_callbacks:
+                self._pull_callbacks[image].append(on_ready)
+                return None
+            error = self._pull_errors.pop(image, None)
+        if error is not None:
+            raise Exception(f'Unable to pull image {image}: {error}')
+        ret = self._get_checked_image(image)
+        if ret is None:
+            self._pull_in_background(image, on_ready=on_ready)
+        return ret
+
+    def prefetch(self, images: List[str]):
+        """Pull the images in the background"""
+        for image in images:
+            with self._lock:
+                if image in self._prefetched_images:
+                    continue
+                self._prefetched_images.add(image)
+            print(f'Prefetching image {image}')
+            self._pull_in_background(image, on_ready=None)
+
+    def prefetch_service_images(self, service_name: str):
+        """Pull the images of all the apps of the service in the background"""
+        with self._lock:
+            timestamp = self._timestamp_service_images_prefetched.get(service_name, 0)
+            if time.time() - timestamp < self._pull_ttl_sec:
+                return
+            self._timestamp_service_images_prefetched[service_name] = time.time()
+
+        def get_images():
+            try:
+                apps = get_service_apps(service_name=service_name)
+            except Exception as e:
+                print(f'Error getting apps of service {service_name}: {e}')
+                return
+            images = []
+            for app in apps:
+                for processor in app.appSpecification.processors:
+                    if processor.image and processor.image not in images:
+                        images.append(processor.image)
+            # allow the images to be checked for updates again
+            with self._lock:
+                for image in images:
+                    self._prefetched_images.discard(image)
+            self.prefetch(images)
+        self._pull_executor.submit(get_images)
+
+    def _pull_in_background(self, image: str, *, on_ready: Union[Callable[[], None], None]):
+        with self._lock:
+            if image in self._pull_callbacks:
+                # already in progress
+                if on_ready is not None:
+                    self._pull_callbacks[image].append(on_ready)
+                return
+            self._pull_callbacks[image] = [on_ready] if on_ready is not None else []
+        self._pull_executor.submit(self._background_pull, image)
+
+    def _background_pull(self, image: str):
+        error = None
+        try:
+            self.get_image(image)
+        except Exception as e:
+            print(f'Error pulling image {image}: {e}')
+            error = str(e)
+        with self._lock:
+            callbacks = self._pull_callbacks.pop(image, [])
+            if error is not None:
+                # try again next time
+                self._prefetched_images.discard(image)
+                if len(callbacks) > 0:
+                    # so that the jobs waiting for the image fail with this error
+                    self._pull_errors[image] = error
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f'Error in callback for image {image}: {e}')
+
+    def _get_checked_image(self, image: str) -> Union[str, None]:
+        # the result of a recent check of the image, if any
+        with self._lock:
+            x = self._checked_images.get(image, None)
+        if x is None or time.time() - x[0] >= self._pull_ttl_sec:
+            return None
+        if self._container_method != 'docker' and not os.path.exists(x[1]):
+            # the SIF file was removed
+            return None
+        return x[1]
+
+    def _check_image(self, image: str) -> str:
+        # pulls the image if needed
+        if self._container_method == 'docker':
+            return self._get_docker_image(image)
+        else:
+            return self._get_sif_image(image)
+
+    def _get_image_lock(self, image: str) -> threading.Lock:
+        with self._image_locks_lock:
+            if image not in self._image_locks:
+                self._image_locks[image] = threading.Lock()
+            return self._image_locks[image]
+
+    def _get_docker_image(self, image: str) -> str:
+        remote_digest = get_remote_image_digest(image)
+        # None if the image is not available locally
+        local_digests = _get_local_docker_digests(image)
+        if remote_digest is not None and local_digests is not None and remote_digest in local_digests:
+            return image
+        if remote_digest is None and local_digests is not None and self._was_pulled_recently(image):
+            print(f'Unable to check for updates of image {image}. Using the local image.')
+            return image
+        print(f'Pulling image {image}')
+        timer = time.time()
+        try:
+            subprocess.run(['docker', 'pull', image], check=True)
+        except subprocess.CalledProcessError:
+            if remote_digest is None and local_digests is not None:
+                # e.g., an image that was built locally and not pushed
+                print(f'Unable to pull image {image}. Using the local image.')
+                return image
+            raise
+        print(f'Pulled image {image} in {time.time() - timer:.1f} seconds')
+        self._update_state(image, {'timestampPulled': time.time()})
+        return image
+
+    def _get_sif_image(self, image: str) -> str:
+        executable = 'singularity' if self._container_method == 'singularity' else 'apptainer'
+        sif_dir = f'{self._cache_dir}/sif'
+        os.makedirs(sif_dir, exist_ok=True)
+        remote_digest = get_remote_image_digest(image)
+        if remote_digest is not None:
+            sif_path = f'{sif_dir}/{remote_digest.replace(":", "_")}.sif'
+            # pull by digest so that the SIF file matches its name
+            source = f'docker://{_strip_tag(image)}@{remote_digest}'
+        else:
+            entry = self._get_state(image)
+            if entry is not None and os.path.exists(entry['sifPath']) and self._was_pulled_recently(image):
+                print(f'Unable to check for updates of image {image}. Using the cached SIF file.')
+                return entry['sifPath']
+            sif_path = f'{sif_dir}/{hashlib.sha1(image.encode("utf-8")).hexdigest()}.sif'
+            source = f'docker://{image}'
+        # Without a digest we can't tell whether the cached SIF file is up to
+        # date, so we rebuild it once the TTL has expired
+        if remote_digest is None or not os.path.exists(sif_path):
+            print(f'Building SIF file for image {image}')
+            timer = time.time()
+            tmp_path = f'{sif_path}.{os.getpid()}.tmp'
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            try:
+                subprocess.run([executable, 'pull', tmp_path, source], check=True)
+            except subprocess.CalledProcessError:
+                if remote_digest is None and os.path.exists(sif_path):
+                    print(f'Unable to pull image {image}. Using the cached SIF file.')
+                    return sif_path
+                raise
+            # atomic, so that a job never sees a partial SIF file
+            os.rename(tmp_path, sif_path)
+            print(f'Built SIF file for image {image} in {time.time() - timer:.1f} seconds')
+        previous_entry = self._get_state(image)
+        self._update_state(image, {'timestampPulled': time.time(), 'sifPath': sif_path})
+        if previous_entry is not None and previous_entry.get('sifPath', sif_path) != sif_path:
+            # The image was updated. Jobs that are still using the previous
+            # SIF file keep it open, so it is safe to remove.
+            _remove_file_if_unused(previous_entry['sifPath'], state=self._load_state())
+        return sif_path
+
+    def _was_pulled_recently(self, image: str) -> bool:
+        entry = self._get_state(image)
+        return entry is not None and time.time() - entry['timestampPulled'] < self._pull_ttl_sec
+
+    def _get_state(self, image: str) -> Union[dict, None]:
+        with self._state_lock:
+            return self._load_state().get(image, None)
+
+    def _update_state(self, image: str, entry: dict):
+        with self._state_lock:
+            state = self._load_state()
+            state[image] = entry
+            os.makedirs(self._cache_dir, exist_ok=True)
+            fname = f'{self._cache_dir}/images.json'
+            with open(fname + '.tmp', 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(fname + '.tmp', fname)
+
+    def _load_state(self) -> dict:
+        fname = f'{self._cache_dir}/images.json'
+        if not os.path.exists(fname):
+            return {}
+        try:
+            with open(fname, 'r') as f:
+                return json.load(f)
+        except: # noqa
+            return {}
+
+
+_image_manager: Union[ImageManager, None] = None
+_image_manager_lock = threading.Lock()
+
+
+def get_image_manager() -> ImageManager:
+    """The image manager of this compute client (one per process)"""
+    global _image_manager
+    with _image_manager_lock:
+        if _image_manager is None:
+            container_method = os.environ.get('CONTAINER_METHOD')
+            if container_method is None:
+                raise Exception('CONTAINER_METHOD environment variable must be set to either docker or apptainer')
+            _image_manager = ImageManager(
+                container_method=container_method,
+                cache_dir=os.getcwd() + '/image_cache'
+            )
+        return _image_manager
+
+
+def get_remote_image_digest(image: str) -> Union[str, None]:
+    """Get the digest of an image from its registry, or None if that fails"""
+    registry, repository, reference = _parse_image_name(image)
+    if reference.startswith('sha256:'):
+        return reference
+    url = f'https://{registry}/v2/{repository}/manifests/{reference}'
+    headers = {'Accept': _manifest_accept_header}
+    try:
+        session = get_http_session()
+        r = session.head(url, headers=headers, timeout=20)
+        if r.status_code == 401:
+            # anonymous token for public images
+            token = _get_registry_token(r.headers.get('WWW-Authenticate', ''))
+            if token is None:
+                return None
+            r = session.head(url, headers={**headers, 'Authorization': f'Bearer {token}'}, timeout=20)
+        if r.status_code != 200:
+            print(f'Unable to get digest of image {image}: {r.status_code} {r.reason}')
+            return None
+        return r.headers.get('Docker-Content-Digest', None)
+    except Exception as e:
+        print(f'Unable to get digest of image {image}: {e}')
+        return None
+
+
+def _get_registry_token(www_authenticate: str) -> Union[str, None]:
+    # e.g., Bearer realm="https://auth.docker.io/token",service="registry.docker.io",scope="repository:library/ubuntu:pull"
+    if not www_authenticate.startswith('Bearer '):
+        return None
+    params = dict(re.findall(r'(\w+)="([^"]*)"', www_authenticate))
+    if 'realm' not in params:
+        return None
+    query = {k: v for k, v in params.items() if k in ['service', 'scope']}
+    r = get_http_session().get(params['realm'], params=query, timeout=20)
+    if r.status_code != 200:
+        return None
+    x = r.json()
+    return x.get('token', x.get('access_token', None))
+
+
+def _parse_image_name(image: str):
+    # returns (registry, repository, tag or digest)
+    name = image
+    if '@' in name:
+        name, reference = name.split('@', 1)
+    else:
+        last_component = name.split('/')[-1]
+        if ':' in last_component:
+            name, reference = name.rsplit(':', 1)
+        else:
+            reference = 'latest'
+    components = name.split('/')
+    if len(components) > 1 and ('.' in components[0] or ':' in components[0] or components[0] == 'localhost'):
+        registry = components[0]
+        repository = '/'.join(components[1:])
+    else:
+        registry = 'registry-1.docker.io'
+        repository = name if len(components) > 1 else f'library/{name}'
+    return registry, repository, reference
+
+
+def _strip_tag(image: str) -> str:
+    name = image.split('@')[0]
+    last_component = name.split('/')[-1]
+    if ':' in last_component:
+        name = name.rsplit(':', 1)[0]
+    return name
+
+
+def _get_local_docker_digests(image: str) -> Union[List[str], None]:
+    # The repo digests of the local image (empty for an image that was built
+    # locally and not pushed), or None if the image is not available locally
+    r = subprocess.run(
+        ['docker', 'image', 'inspect', '--format', '{{json .RepoDigests}}', image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    if r.returncode != 0:
+        return None
+    try:
+        repo_digests = json.loads(r.stdout.decode('utf-8'))
+    except: # noqa
+        return []
+    return [d.split('@')[-1] for d in (repo_digests or [])]
+
+
+def _remove_file_if_unused(path: str, *, state: dict):
+    if any(entry.get('sifPath', None) == path for entry in state.values()):
+        # another image has the same digest
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
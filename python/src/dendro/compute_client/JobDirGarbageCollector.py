@@ -0,0 +1,221 @@
+from typing import Callable, List, Union
+import os
+import time
+import shutil
+import queue
+import threading
+import traceback
+
+
+# Deletes the directories of old jobs (jobs/<job_id>) in a background thread
+# of the compute client.
+#
+# * Directories of finished jobs are deleted once they are older than
+#   COMPUTE_CLIENT_JOB_DIR_MAX_AGE_HOURS (default 24). The directories of jobs
+#   that are not known to be finished are only deleted after that age.
+# * When the free disk space falls below COMPUTE_CLIENT_GC_TARGET_FREE_DISK_GB
+#   (default 20), the directories of finished jobs are deleted right away,
+#   oldest first, until there is enough free space.
+# * When the free disk space is below COMPUTE_CLIENT_MIN_FREE_DISK_GB
+#   (default 5), no new jobs are started (see has_enough_disk_space). The
+#   job manager then calls hold_back_jobs(), and the collector checks the
+#   free disk space every few seconds until there is enough again, however
+#   the space was freed (by the collector, an output upload finishing, an
+#   operator, ...), and then posts a diskSpaceFreed event.
+#
+# A directory is first renamed into jobs_trash (atomic, so a partially deleted
+# directory is never visible under jobs/) and then deleted file by file at a
+# limited rate (COMPUTE_CLIENT_GC_MAX_DELETIONS_PER_SEC, default 1000) in a
+# low priority thread, so that the deletions don't starve the I/O of the
+# running jobs. Leftovers in jobs_trash (e.g., after a restart) are deleted
+# when the collector starts.
+
+
+class JobDirGarbageCollector:
+    def __init__(
+        self, *,
+        jobs_dir: str,
+        trash_dir: str,
+        get_active_job_ids: Callable[[], List[str]],
+        event_queue: Union[queue.Queue, None] = None
+    ) -> None:
+        self._jobs_dir = jobs_dir
+        self._trash_dir = trash_dir
+        self._get_active_job_ids = get_active_job_ids
+        self._event_queue = event_queue
+        self._max_age_sec = float(os.environ.get('COMPUTE_CLIENT_JOB_DIR_MAX_AGE_HOURS', '24')) * 60 * 60
+        self._min_free_bytes = float(os.environ.get('COMPUTE_CLIENT_MIN_FREE_DISK_GB', '5')) * 1024 ** 3
+        self._target_free_bytes = max(
+            self._min_free_bytes,
+            float(os.environ.get('COMPUTE_CLIENT_GC_TARGET_FREE_DISK_GB', '20')) * 1024 ** 3
+        )
+        self._max_deletions_per_sec = float(os.environ.get('COMPUTE_CLIENT_GC_MAX_DELETIONS_PER_SEC', '1000'))
+        self._check_interval_sec = 60
+        # while jobs are held back for lack of disk space
+        self._held_back_check_interval_sec = 5
+        self._jobs_held_back = threading.Event()
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def wake(self):
+        """Collect now"""
+        self._wake_event.set()
+
+    def hold_back_jobs(self):
+        """Jobs were not started for lack of disk space
+
+        A diskSpaceFreed event is posted as soon as there is enough free disk
+        space again.
+        """
+        if not self._jobs_held_back.is_set():
+            self._jobs_held_back.set()
+            # collect now rather than at the next check
+            self._wake_event.set()
+
+    def get_free_bytes(self) -> float:
+        path = self._jobs_dir if os.path.exists(self._jobs_dir) else os.path.dirname(self._jobs_dir)
+        return float(shutil.disk_usage(path).free)
+
+    def has_enough_disk_space(self) -> bool:
+        """Whether there is enough free disk space to start a new job"""
+        try:
+            return self.get_free_bytes() >= self._min_free_bytes
+        except OSError:
+            # can't tell
+            return True
+
+    def _run(self):
+        try:
+            # lowest CPU priority for this thread (on Linux, the priority is
+            # per thread)
+            os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), 19)
+        except: # noqa
+            pass
+        self._empty_trash()
+        timestamp_last_collect = 0.0
+        while not self._stop_event.is_set():
+            if self._wake_event.is_set() or time.time() - timestamp_last_collect >= self._check_interval_sec:
+                self._wake_event.clear()
+                timestamp_last_collect = time.time()
+                try:
+                    self._collect()
+                except: # noqa
+                    # never let an error stop the collector
+                    print('Error collecting old job directories')
+                    traceback.print_exc()
+            if self._jobs_held_back.is_set() and self.has_enough_disk_space():
+                self._jobs_held_back.clear()
+                if self._event_queue is not None:
+                    # so that the jobs that were held back can start
+                    self._event_queue.put({'type': 'diskSpaceFreed'})
+            if self._jobs_held_back.is_set():
+                timeout = self._held_back_check_interval_sec
+            else:
+                timeout = max(0, self._check_interval_sec - (time.time() - timestamp_last_collect))
+            self._wake_event.wait(timeout)
+
+    def _collect(self):
+        if not os.path.exists(self._jobs_dir):
+            return
+        active_job_ids = set(self._get_active_job_ids())
+        candidates = []
+        for name in os.listdir(self._jobs_dir):
+            job_dir = f'{self._jobs_dir}/{name}'
+            if name in active_job_ids or not os.path.isdir(job_dir):
+                continue
+            try:
+                mtime = os.stat(job_dir).st_mtime
+            except FileNotFoundError:
+                continue
+            candidates.append((mtime, name, job_dir))
+        # oldest first
+        candidates.sort()
+        for mtime, name, job_dir in candidates:
+            if self._stop_event.is_set():
+                return
+            age = time.time() - mtime
+            if age > self._max_age_sec:
+                reason = f'older than {self._max_age_sec / 3600:g} hours'
+            elif self.get_free_bytes() < self._target_free_bytes and _job_is_finished(job_dir):
+                reason = f'low on disk space ({self.get_free_bytes() / 1024 ** 3:.1f} GB free)'
+            else:
+                continue
+            print(f'Removing job directory {name} ({reason})')
+            self._remove(job_dir)
+
+    def _remove(self, job_dir: str):
+        os.makedirs(self._trash_dir, exist_ok=True)
+        trash_path = f'{self._trash_dir}/{os.path.basename(job_dir)}.{int(time.time() * 1000)}'
+        try:
+            os.rename(job_dir, trash_path)
+        except OSError as e:
+            # e.g., the trash is on a different file system
+            print(f'Unable to move {job_dir} to the trash ({e}). Deleting it in place.')
+            trash_path = job_dir
+        self._delete_throttled(trash_path)
+
+    def _empty_trash(self):
+        if not os.path.exists(self._trash_dir):
+            return
+        for name in os.listdir(self._trash_dir):
+            self._delete_throttled(f'{self._trash_dir}/{name}')
+
+    def _delete_throttled(self, path: str):
+        num_deleted = 0
+        timer = time.time()
+
+        def throttle():
+            nonlocal num_deleted
+            num_deleted += 1
+            if self._max_deletions_per_sec > 0:
+                ahead = num_deleted / self._max_deletions_per_sec - (time.time() - timer)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        if not os.path.isdir(path) or os.path.islink(path):
+            os.remove(path)
+            return
+        num_errors = 0
+        for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+            for fname in filenames:
+                try:
+                    os.remove(os.path.join(dirpath, fname))
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    # e.g., files created by root in a docker container
+                    num_errors += 1
+                throttle()
+            for dname in dirnames:
+                p = os.path.join(dirpath, dname)
+                try:
+                    if os.path.islink(p):
+                        os.remove(p)
+                    else:
+                        os.rmdir(p)
+                except FileNotFoundError:
+                    pass
+                except OSError:
+                    num_errors += 1
+        try:
+            os.rmdir(path)
+        except OSError:
+            num_errors += 1
+        if num_errors > 0:
+            print(f'Unable to delete {num_errors} files or directories in {path}')
+
+
+def _job_is_finished(job_dir: str) -> bool:
+    # see run.sh in _start_job.py
+    return (
+        os.path.exists(f'{job_dir}/tmp/_dendro_parent_process_succeeded.txt') or
+        os.path.exists(f'{job_dir}/tmp/_dendro_parent_process_failed.txt')
+    )
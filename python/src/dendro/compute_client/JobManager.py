@@ -1,25 +1,193 @@
-from typing import List
+from typing import List, Dict, Union
+import os
+import json
+import time
+import errno
+import queue
+import threading
+import subprocess
 from dendro.common.DendroJob import DendroJob
 from dendro.common.api_requests import set_job_status
+from .LocalJobScheduler import LocalJobScheduler, get_compute_client_capacity
+from .TrustedAppPool import TrustedAppJobProcess, get_trusted_app_pool
+from ..common.cgroups import remove_job_cgroup
+from .JobDirGarbageCollector import JobDirGarbageCollector
 
 
 class JobManager:
     def __init__(
         self, *,
         compute_client_id: str,
-        compute_client_private_key: str
+        compute_client_private_key: str,
+        event_queue: Union[queue.Queue, None] = None,
+        use_control_channel: bool = False
     ) -> None:
         self._compute_client_id = compute_client_id
         self._compute_client_private_key = compute_client_private_key
+        self._event_queue = event_queue
+        # whether the jobs get a control channel (see cancel_job)
+        self._use_control_channel = use_control_channel
 
         # important to keep track of which jobs we attempted to start
         # so that we don't attempt multiple times in the case where starting failed
         self._attempted_to_start_job_ids = set()
         self._attempted_to_fail_job_ids = set()
 
-    def handle_jobs(self, jobs: List[DendroJob]):
-        for job in jobs:
-            self._start_job(job)
+        capacity = get_compute_client_capacity()
+        print(f'Compute client capacity: {capacity}')
+        self._scheduler = LocalJobScheduler(capacity=capacity)
+
+        # the container processes of the jobs that we started and that are still running
+        # (or the job processes of trusted apps, see TrustedAppPool.py)
+        self._running_job_processes: Dict[str, Union[subprocess.Popen, TrustedAppJobProcess]] = {}
+        # how often the running jobs are checked for the compute finished marker
+        self._compute_finished_check_interval_sec = 1
+
+        # if set, no jobs are started when the disk is almost full
+        self._job_dir_gc: Union[JobDirGarbageCollector, None] = None
+        self._timestamp_last_disk_space_warning = 0.0
+
+        trusted_app_pool = get_trusted_app_pool()
+        if trusted_app_pool is not None:
+            # so that the apps are loaded by the time the first jobs arrive
+            trusted_app_pool.start_zygotes()
+
+    def set_job_dir_gc(self, job_dir_gc: JobDirGarbageCollector):
+        self._job_dir_gc = job_dir_gc
+
+    def handle_jobs(self, jobs: List[DendroJob], running_jobs: Union[List[DendroJob], None] = None):
+        """Queue the runnable jobs and start the ones that fit on this node
+
+        running_jobs is the list of jobs that the server considers to be
+        running on this compute client. Those that we did not start ourselves
+        still count against the capacity of the node.
+        """
+        if os.environ.get('COMPUTE_CLIENT_PREFETCH_IMAGES', '1') != '0':
+            # so that the images are ready by the time the jobs of these
+            # services start
+            from .ImageManager import get_image_manager
+            for service_name in set(job.serviceName for job in jobs + (running_jobs or [])):
+                get_image_manager().prefetch_service_images(service_name)
+        self._scheduler.set_queue([
+            job for job in jobs
+            if job.jobId not in self._attempted_to_start_job_ids and job.jobId not in self._attempted_to_fail_job_ids
+        ])
+        if running_jobs is not None:
+            self._scheduler.set_external_running_jobs([
+                job for job in running_jobs
+                if job.jobId not in self._attempted_to_start_job_ids
+            ])
+        self._start_queued_jobs()
+
+    def get_num_running_jobs(self) -> int:
+        return len(self._running_job_processes)
+
+    def get_running_job_ids(self) -> List[str]:
+        return list(self._running_job_processes.keys())
+
+    def get_num_queued_jobs(self) -> int:
+        return self._scheduler.get_num_queued_jobs()
+
+    def cancel_job(self, job_id: str) -> bool:
+        """Tell the parent process of a job running on this node to cancel the job
+
+        The message is written to the control channel (a named pipe in the job
+        directory) of the job. This also works for jobs that were started
+        before the daemon restarted. Returns False if the job is not running
+        on this node.
+        """
+        from ._start_job import get_job_control_fifo_path
+        fifo_path = get_job_control_fifo_path(job_id)
+        if not os.path.exists(fifo_path):
+            return False
+        try:
+            # non-blocking so that we don't hang if the job is no longer reading
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # no reader, so the job is not running
+                return False
+            raise
+        try:
+            os.write(fd, (json.dumps({'type': 'cancel'}) + '\n').encode('utf-8'))
+        finally:
+            os.close(fd)
+        print(f'Sent cancel message to job {job_id}')
+        return True
+
+    def release_job_resources(self, job_id: str):
+        """The job is only uploading its outputs, so other jobs can use its resources"""
+        if job_id in self._running_job_processes:
+            print(f'Job {job_id} finished computing. Releasing its resources while it uploads its outputs.')
+            self._scheduler.release(job_id)
+
+    def do_work(self):
+        self._reap_finished_jobs()
+        self._start_queued_jobs()
+
+    def _reap_finished_jobs(self):
+        for job_id, proc in list(self._running_job_processes.items()):
+            retcode = proc.poll()
+            if retcode is None:
+                continue
+            print(f'Container for job {job_id} exited with code {retcode}')
+            del self._running_job_processes[job_id]
+            remove_job_cgroup(job_id)
+            self._scheduler.release(job_id)
+
+    def _start_queued_jobs(self):
+        if self._job_dir_gc is not None and self._scheduler.get_num_queued_jobs() > 0 and not self._job_dir_gc.has_enough_disk_space():
+            # The jobs stay queued. The collector posts an event as soon as
+            # there is enough space again.
+            if time.time() - self._timestamp_last_disk_space_warning > 60 * 5:
+                self._timestamp_last_disk_space_warning = time.time()
+                print(f'Not starting new jobs: low on disk space ({self._job_dir_gc.get_free_bytes() / 1024 ** 3:.1f} GB free)')
+            self._job_dir_gc.hold_back_jobs()
+            return
+        for job in self._scheduler.get_jobs_to_start():
+            self._scheduler.claim(job)
+            proc = self._start_job(job)
+            if isinstance(proc, (subprocess.Popen, TrustedAppJobProcess)):
+                self._running_job_processes[job.jobId] = proc
+                self._watch_job_process(job.jobId, proc)
+            else:
+                # the job did not start, so it is not using any resources
+                self._scheduler.release(job.jobId)
+                if proc == 'image_not_ready':
+                    # The job is queued again the next time the jobs are
+                    # handled, which is right away once the image is pulled
+                    # (imageReady event)
+                    self._attempted_to_start_job_ids.discard(job.jobId)
+
+    def _watch_job_process(self, job_id: str, proc: Union[subprocess.Popen, TrustedAppJobProcess]):
+        # Post an event when the container exits so that the daemon can reap
+        # it and start more jobs right away
+        event_queue = self._event_queue
+        if event_queue is None:
+            return
+
+        from ._start_job import get_job_compute_finished_marker_path
+        compute_finished_marker = get_job_compute_finished_marker_path(job_id)
+
+        def wait_for_exit():
+            # Also post an event when the computation is done and only the
+            # output uploads are left, so that the resources can be released.
+            # The marker is checked between the waits, and once it is found
+            # we just wait for the exit.
+            while True:
+                try:
+                    proc.wait(timeout=self._compute_finished_check_interval_sec)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if os.path.exists(compute_finished_marker):
+                    event_queue.put({'type': 'jobComputeFinished', 'jobId': job_id})
+                    proc.wait()
+                    break
+            event_queue.put({'type': 'jobProcessExited', 'jobId': job_id})
+        thread = threading.Thread(target=wait_for_exit)
+        thread.daemon = True
+        thread.start()
 
     def _start_job(self, job: DendroJob):
         job_id = job.jobId
@@ -28,14 +196,21 @@ class JobManager:
         self._attempted_to_start_job_ids.add(job_id)
         app_name = job.jobDefinition.appName
         processor_name = job.jobDefinition.processorName
+        event_queue = self._event_queue
+        from ._start_job import _start_job, ImageNotReadyException
         try:
             print(f'Starting job {job_id} {app_name}:{processor_name}')
-            from ._start_job import _start_job
             return _start_job(
                 job=job,
                 compute_client_id=self._compute_client_id,
-                detach=True
+                detach=True,
+                use_control_channel=self._use_control_channel,
+                # without an event queue, wait for the image to be pulled
+                on_image_ready=(lambda: event_queue.put({'type': 'imageReady'})) if event_queue is not None else None
             )
+        except ImageNotReadyException as e:
+            print(f'Not starting job {job_id} yet: {str(e)}')
+            return 'image_not_ready'
         except Exception as e: # pylint: disable=broad-except
             # do a traceback
             import traceback
@@ -45,9 +220,6 @@ class JobManager:
             self._fail_job(job, msg)
             return ''
 
-    def do_work(self):
-        pass
-
     def _fail_job(self, job: DendroJob, error: str):
         job_id = job.jobId
         if job_id in self._attempted_to_fail_job_ids:
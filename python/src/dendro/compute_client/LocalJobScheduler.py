@@ -0,0 +1,234 @@
+from typing import List, Dict, Union
+import os
+import time
+from dataclasses import dataclass
+import psutil
+from ..common.DendroJob import DendroJob
+
+
+@dataclass
+class ComputeResources:
+    """An amount of compute resources (either a capacity or a claim)"""
+    numCpus: float
+    numGpus: float
+    memoryGb: float
+
+    def fits_within(self, other: 'ComputeResources') -> bool:
+        return (
+            self.numCpus <= other.numCpus and
+            self.numGpus <= other.numGpus and
+            self.memoryGb <= other.memoryGb
+        )
+
+    def plus(self, other: 'ComputeResources') -> 'ComputeResources':
+        return ComputeResources(
+            numCpus=self.numCpus + other.numCpus,
+            numGpus=self.numGpus + other.numGpus,
+            memoryGb=self.memoryGb + other.memoryGb
+        )
+
+    def minus(self, other: 'ComputeResources') -> 'ComputeResources':
+        return ComputeResources(
+            numCpus=self.numCpus - other.numCpus,
+            numGpus=self.numGpus - other.numGpus,
+            memoryGb=self.memoryGb - other.memoryGb
+        )
+
+    def __str__(self) -> str:
+        return f'{self.numCpus:g} CPUs, {self.numGpus:g} GPUs, {self.memoryGb:.1f} GB'
+
+    @staticmethod
+    def for_job(job: DendroJob) -> 'ComputeResources':
+        rr = job.requiredResources
+        return ComputeResources(
+            numCpus=rr.numCpus,
+            numGpus=rr.numGpus,
+            memoryGb=rr.memoryGb
+        )
+
+
+@dataclass
+class _ResourceClaim:
+    job_id: str
+    resources: ComputeResources
+    timestamp_started: float
+    time_sec: float
+
+    @property
+    def expected_end(self) -> float:
+        return self.timestamp_started + self.time_sec
+
+
+def get_compute_client_capacity() -> ComputeResources:
+    """Determine the resources of this node that are available for running jobs
+
+    The values can be overridden using the COMPUTE_CLIENT_NUM_CPUS,
+    COMPUTE_CLIENT_NUM_GPUS and COMPUTE_CLIENT_MEMORY_GB environment variables.
+    """
+    num_cpus = os.environ.get('COMPUTE_CLIENT_NUM_CPUS', None)
+    num_gpus = os.environ.get('COMPUTE_CLIENT_NUM_GPUS', None)
+    memory_gb = os.environ.get('COMPUTE_CLIENT_MEMORY_GB', None)
+    return ComputeResources(
+        numCpus=float(num_cpus) if num_cpus is not None else float(os.cpu_count() or 1),
+        numGpus=float(num_gpus) if num_gpus is not None else float(_get_num_gpus()),
+        memoryGb=float(memory_gb) if memory_gb is not None else psutil.virtual_memory().total / 1024 ** 3
+    )
+
+
+def _get_num_gpus() -> int:
+    try:
+        import GPUtil  # type: ignore
+        return len(GPUtil.getGPUs())
+    except: # noqa
+        return 0
+
+
+class LocalJobScheduler:
+    """Decides which of the runnable jobs can be started on this node
+
+    Each started job claims the resources listed in its requiredResources until
+    it is released. Jobs are admitted in the order that they were first seen
+    (first come first served). When the job at the head of the queue does not
+    fit, we reserve resources for it at the earliest time that it could start
+    (based on the timeSec of the running jobs) and backfill smaller jobs around
+    it, as long as they don't delay the head job (EASY backfilling).
+    """
+    def __init__(self, *, capacity: ComputeResources) -> None:
+        self._capacity = capacity
+        self._queue: List[DendroJob] = []
+        self._first_seen: Dict[str, float] = {}
+        self._claims: Dict[str, _ResourceClaim] = {}
+        # claims for jobs that are running on this compute client but were not
+        # started by this scheduler (e.g., started before the daemon restarted)
+        self._external_claims: Dict[str, _ResourceClaim] = {}
+        self._reported_too_large_job_ids = set()
+
+    @property
+    def capacity(self) -> ComputeResources:
+        return self._capacity
+
+    def set_queue(self, jobs: List[DendroJob]):
+        """Replace the queue with the latest list of runnable jobs from the server
+
+        Jobs that are no longer runnable (e.g., they were picked up by another
+        compute client) are dropped from the queue.
+        """
+        now = time.time()
+        for job in jobs:
+            if job.jobId not in self._first_seen:
+                self._first_seen[job.jobId] = now
+        job_ids = set(job.jobId for job in jobs)
+        for job_id in list(self._first_seen.keys()):
+            if job_id not in job_ids:
+                del self._first_seen[job_id]
+        self._queue = sorted(
+            [job for job in jobs if job.jobId not in self._claims],
+            key=lambda job: self._first_seen[job.jobId]
+        )
+
+    def set_external_running_jobs(self, jobs: List[DendroJob]):
+        """Account for jobs that are running on this compute client but are not tracked locally"""
+        now = time.time()
+        new_external_claims: Dict[str, _ResourceClaim] = {}
+        for job in jobs:
+            if job.jobId in self._claims:
+                continue
+            timestamp_started = job.timestampStartedSec or job.timestampStartingSec or now
+            new_external_claims[job.jobId] = _ResourceClaim(
+                job_id=job.jobId,
+                resources=ComputeResources.for_job(job),
+                timestamp_started=timestamp_started,
+                time_sec=job.requiredResources.timeSec
+            )
+        self._external_claims = new_external_claims
+
+    def claim(self, job: DendroJob):
+        self._claims[job.jobId] = _ResourceClaim(
+            job_id=job.jobId,
+            resources=ComputeResources.for_job(job),
+            timestamp_started=time.time(),
+            time_sec=job.requiredResources.timeSec
+        )
+        self._queue = [j for j in self._queue if j.jobId != job.jobId]
+        if job.jobId in self._external_claims:
+            del self._external_claims[job.jobId]
+
+    def release(self, job_id: str):
+        if job_id in self._claims:
+            del self._claims[job_id]
+
+    def remove_from_queue(self, job_id: str):
+        self._queue = [j for j in self._queue if j.jobId != job_id]
+
+    def get_num_queued_jobs(self) -> int:
+        return len(self._queue)
+
+    def get_claimed_resources(self) -> ComputeResources:
+        ret = ComputeResources(numCpus=0, numGpus=0, memoryGb=0)
+        for c in self._all_claims():
+            ret = ret.plus(c.resources)
+        return ret
+
+    def get_jobs_to_start(self) -> List[DendroJob]:
+        """Return the queued jobs that should be started now, in order
+
+        The caller is responsible for calling claim() for each job that is
+        actually started.
+        """
+        now = time.time()
+        free = self._capacity.minus(self.get_claimed_resources())
+        ret: List[DendroJob] = []
+        # Once the head job is blocked, these are set to the time at which it
+        # is expected to be able to start and the resources that will be left
+        # over at that time
+        shadow_time: Union[float, None] = None
+        extra: Union[ComputeResources, None] = None
+        head_is_blocked = False
+        for job in self._queue:
+            required = ComputeResources.for_job(job)
+            if not required.fits_within(self._capacity):
+                if job.jobId not in self._reported_too_large_job_ids:
+                    print(f'Job {job.jobId} requires more resources ({required}) than this compute client has ({self._capacity}). Not starting it.')
+                    self._reported_too_large_job_ids.add(job.jobId)
+                continue
+            if not head_is_blocked:
+                if required.fits_within(free):
+                    ret.append(job)
+                    free = free.minus(required)
+                else:
+                    head_is_blocked = True
+                    shadow_time, extra = self._compute_reservation(
+                        required=required,
+                        free=free,
+                        now=now
+                    )
+                continue
+            # backfilling
+            if not required.fits_within(free):
+                continue
+            finishes_before_shadow = shadow_time is not None and now + job.requiredResources.timeSec <= shadow_time
+            if finishes_before_shadow:
+                ret.append(job)
+                free = free.minus(required)
+            elif extra is not None and required.fits_within(extra):
+                ret.append(job)
+                free = free.minus(required)
+                extra = extra.minus(required)
+        return ret
+
+    def _compute_reservation(self, *, required: ComputeResources, free: ComputeResources, now: float):
+        # Jobs that are started during this scheduling round are not yet in the
+        # claims, but they are already subtracted from free, so they are
+        # conservatively treated as never finishing
+        claims = sorted(self._all_claims(), key=lambda c: c.expected_end)
+        available = free
+        for c in claims:
+            available = available.plus(c.resources)
+            if required.fits_within(available):
+                return max(c.expected_end, now), available.minus(required)
+        # The head job can't start until the jobs started in this round have
+        # finished, so we don't allow backfilling
+        return None, None
+
+    def _all_claims(self) -> List[_ResourceClaim]:
+        return list(self._claims.values()) + list(self._external_claims.values())
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Union
 import queue
 from pubnub.pnconfiguration import PNConfiguration
 from pubnub.callbacks import SubscribeCallback
@@ -16,9 +16,12 @@ class PubsubClient:
         pubnub_subscribe_key: str,
         pubnub_channel: str,
         pubnub_user: str,
-        compute_client_id: str
+        compute_client_id: str,
+        message_queue: Union[queue.Queue, None] = None
     ):
-        self._message_queue = queue.Queue()
+        # If a message queue is provided, the caller can block on it rather
+        # than polling take_messages()
+        self._message_queue = message_queue if message_queue is not None else queue.Queue()
         pnconfig = PNConfiguration()
         pnconfig.subscribe_key = pubnub_subscribe_key # type: ignore (not sure why we need to type ignore this)
         pnconfig.user_id = pubnub_user
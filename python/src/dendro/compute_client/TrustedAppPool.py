@@ -0,0 +1,185 @@
+from typing import Dict, Union
+import os
+import json
+import time
+import socket
+import threading
+import subprocess
+import psutil
+
+
+# Opt-in fast path for apps that the operator of the compute client trusts
+# enough to run without a container. The apps are listed in the
+# COMPUTE_CLIENT_TRUSTED_APPS environment variable as comma-separated
+# <app_name>=<path to main.py> pairs, and they must be installable in the
+# python environment of the compute client. Each app gets a zygote process
+# (see sdk/_app_zygote.py) that has the app loaded and forks a process for each
+# job, so a job starts in milliseconds instead of seconds.
+
+
+class TrustedAppJobProcess:
+    """The parts of subprocess.Popen that the job manager uses, for a job process forked by a zygote
+
+    The job process is not a child of this process. It is reaped by the
+    zygote, which writes its exit status to exit_code_file. The return code
+    is -1 if the process exited without the zygote reporting its exit status
+    (e.g., the zygote exited first).
+    """
+    def __init__(self, pid: int, *, exit_code_file: str) -> None:
+        self.pid = pid
+        self._exit_code_file = exit_code_file
+        try:
+            self._process: Union[psutil.Process, None] = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            self._process = None
+        self._timestamp_exited: Union[float, None] = None
+        self.returncode: Union[int, None] = None
+
+    def poll(self) -> Union[int, None]:
+        if self.returncode is None:
+            # is_running also checks that the pid was not reused
+            try:
+                running = self._process is not None and self._process.is_running() and self._process.status() != psutil.STATUS_ZOMBIE
+            except psutil.NoSuchProcess:
+                running = False
+            if not running:
+                exit_code = self._read_exit_code()
+                if exit_code is not None:
+                    self.returncode = exit_code
+                elif self._timestamp_exited is None:
+                    # the zygote may not have reaped it yet
+                    self._timestamp_exited = time.time()
+                elif time.time() - self._timestamp_exited > 10:
+                    self.returncode = -1  # unknown
+        return self.returncode
+
+    def wait(self, timeout: Union[float, None] = None) -> int:
+        timer = time.time()
+        while self.poll() is None:
+            remaining = None if timeout is None else timeout - (time.time() - timer)
+            if remaining is not None and remaining <= 0:
+                raise subprocess.TimeoutExpired(cmd=f'trusted app job process {self.pid}', timeout=timeout)  # type: ignore
+            if self._process is not None and self._timestamp_exited is None:
+                # returns once the zygote has reaped the process
+                try:
+                    self._process.wait(timeout=remaining)
+                except (psutil.TimeoutExpired, psutil.NoSuchProcess):
+                    pass
+            else:
+                # waiting for the exit status from the zygote
+                time.sleep(0.1 if remaining is None else min(0.1, remaining))
+        assert self.returncode is not None
+        return self.returncode
+
+    def _read_exit_code(self) -> Union[int, None]:
+        try:
+            with open(self._exit_code_file, 'r') as f:
+                return int(f.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
+
+
+class TrustedAppPool:
+    def __init__(self, *, trusted_apps: Dict[str, str], dir: str) -> None:
+        self._trusted_apps = trusted_apps
+        self._dir = dir
+        self._zygote_processes: Dict[str, subprocess.Popen] = {}
+        self._lock = threading.Lock()
+
+    def is_trusted_app(self, app_name: str) -> bool:
+        return app_name in self._trusted_apps
+
+    def start_zygotes(self):
+        """Start the zygotes of all the trusted apps, so that the apps are loaded before the first job"""
+        for app_name in self._trusted_apps:
+            try:
+                self._get_zygote_socket(app_name, wait=False)
+            except Exception as e:
+                print(f'Error starting zygote for trusted app {app_name}: {e}')
+
+    def start_job(
+        self, *,
+        app_name: str,
+        job_id: str,
+        job_private_key: str,
+        compute_client_id: str,
+        job_timeout_sec: Union[int, None],
+        env_vars: dict,
+        parent_output_file: str
+    ) -> TrustedAppJobProcess:
+        socket_path = self._get_zygote_socket(app_name, wait=True)
+        # written by the zygote when the job process exits
+        exit_code_file = os.path.join(os.path.dirname(parent_output_file), '_dendro_job_process_exit_code.txt')
+        request = {
+            'jobId': job_id,
+            'jobPrivateKey': job_private_key,
+            'computeClientId': compute_client_id,
+            'jobTimeoutSec': job_timeout_sec,
+            'env': env_vars,
+            'parentOutputFile': parent_output_file,
+            'exitCodeFile': exit_code_file
+        }
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(60)
+            sock.connect(socket_path)
+            sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+            buf = b''
+            while not buf.endswith(b'\n'):
+                data = sock.recv(4096)
+                if not data:
+                    raise Exception(f'Unexpected: no response from zygote for trusted app {app_name}')
+                buf += data
+        pid = json.loads(buf)['pid']
+        print(f'Started job {job_id} in process {pid} (trusted app {app_name})')
+        return TrustedAppJobProcess(pid, exit_code_file=exit_code_file)
+
+    def _get_zygote_socket(self, app_name: str, *, wait: bool) -> str:
+        socket_path = f'{self._dir}/{app_name}.sock'
+        with self._lock:
+            proc = self._zygote_processes.get(app_name, None)
+            if proc is None or proc.poll() is not None:
+                if proc is not None:
+                    print(f'Zygote for trusted app {app_name} exited with code {proc.returncode}. Restarting.')
+                os.makedirs(self._dir, exist_ok=True)
+                if os.path.exists(socket_path):
+                    os.remove(socket_path)
+                cmd = ['dendro', 'internal-app-zygote', '--app-executable', self._trusted_apps[app_name], '--socket', socket_path]
+                print(f'Starting zygote for trusted app {app_name}: {" ".join(cmd)}')
+                with open(f'{self._dir}/{app_name}.log', 'a') as log_file:
+                    proc = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+                self._zygote_processes[app_name] = proc
+        if wait:
+            # loading the app can take a while (imports)
+            timer = time.time()
+            while not os.path.exists(socket_path):
+                if proc.poll() is not None:
+                    raise Exception(f'Zygote for trusted app {app_name} exited with code {proc.returncode}. See {self._dir}/{app_name}.log')
+                if time.time() - timer > 120:
+                    raise Exception(f'Timed out waiting for zygote for trusted app {app_name}')
+                time.sleep(0.1)
+        return socket_path
+
+
+_trusted_app_pool: Union[TrustedAppPool, None] = None
+_trusted_app_pool_lock = threading.Lock()
+
+
+def get_trusted_app_pool() -> Union[TrustedAppPool, None]:
+    """The pool of trusted apps of this compute client, or None if there are no trusted apps"""
+    global _trusted_app_pool
+    x = os.environ.get('COMPUTE_CLIENT_TRUSTED_APPS', '')
+    if not x:
+        return None
+    with _trusted_app_pool_lock:
+        if _trusted_app_pool is None:
+            trusted_apps: Dict[str, str] = {}
+            for item in x.split(','):
+                item = item.strip()
+                if not item:
+                    continue
+                if '=' not in item:
+                    raise Exception(f'Invalid item in COMPUTE_CLIENT_TRUSTED_APPS (expected <app_name>=<path to main.py>): {item}')
+                app_name, app_executable = item.split('=', 1)
+                trusted_apps[app_name.strip()] = os.path.abspath(app_executable.strip())
+            _trusted_app_pool = TrustedAppPool(trusted_apps=trusted_apps, dir=os.getcwd() + '/zygotes')
+        return _trusted_app_pool
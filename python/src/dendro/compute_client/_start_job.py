@@ -1,33 +1,54 @@
 import os
 import subprocess
 import time
-from typing import Union
+from typing import Callable, Union
 from ..common.DendroJob import DendroJob
 from ..common.api_requests import set_job_status, get_service_app
 from ..common.dendro_types import DendroServiceApp
+from .ImageManager import get_image_manager
+from .TrustedAppPool import get_trusted_app_pool
+from .FileCacheFiller import get_file_cache_filler
+from ..common.cgroups import create_job_cgroup, get_cgroup_enter_command, get_cgroup_path, remove_job_cgroup
 
 
 class JobException(Exception):
     pass
 
 
+class ImageNotReadyException(Exception):
+    """The image of the job is being pulled (see the on_image_ready argument of _start_job)"""
+    pass
+
+
+def get_job_control_fifo_path(job_id: str) -> str:
+    # The compute client daemon writes control messages (e.g., to cancel the
+    # job) to this named pipe and the job parent process reads them. It is in
+    # the tmp directory of the job, which is mounted as /tmp in the container.
+    return os.getcwd() + '/jobs/' + job_id + '/tmp/_dendro_control'
+
+
+def get_job_compute_finished_marker_path(job_id: str) -> str:
+    # Written by the job parent process when the computation is done and only
+    # the output uploads are left (see sdk/_run_job_parent_process.py)
+    return os.getcwd() + '/jobs/' + job_id + '/tmp/_dendro_compute_finished.txt'
+
+
 def _start_job(*,
     job: DendroJob,
     compute_client_id: str,
-    detach: bool
+    detach: bool,
+    use_control_channel: bool = False,
+    on_image_ready: Union[Callable[[], None], None] = None
 ):
+    # If on_image_ready is given, the job is not started while its image
+    # needs to be pulled: ImageNotReadyException is raised (before the status
+    # of the job is changed) and on_image_ready is called once the image has
+    # been pulled in the background, so that the caller can try again.
     job_id = job.jobId
     job_private_key = job.jobPrivateKey
     if job_private_key is None:
         raise JobException('Unexpected: job_private_key is None')
     job_required_resources = job.requiredResources
-    set_job_status(
-        job_id=job_id,
-        job_private_key=job_private_key,
-        compute_client_id=compute_client_id,
-        status='starting',
-        error=None
-    )
     app: DendroServiceApp = get_service_app(service_name=job.serviceName, app_name=job.jobDefinition.appName)
 
     processor = next((p for p in app.appSpecification.processors if p.name == job.jobDefinition.processorName), None)
@@ -37,12 +58,38 @@ def _start_job(*,
     processor_image = processor.image
     processor_executable = processor.executable
 
+    trusted_app_pool = get_trusted_app_pool()
+    is_trusted_app = trusted_app_pool is not None and trusted_app_pool.is_trusted_app(job.jobDefinition.appName)
+    image_ref = None
+    if not is_trusted_app and on_image_ready is not None:
+        image_ref = get_image_manager().get_image_if_ready(processor_image, on_ready=on_image_ready)
+        if image_ref is None:
+            raise ImageNotReadyException(f'Image {processor_image} is being pulled')
+
+    set_job_status(
+        job_id=job_id,
+        job_private_key=job_private_key,
+        compute_client_id=compute_client_id,
+        status='starting',
+        error=None
+    )
+
     # WARNING!!! The job_dir is going to get cleaned up after the job is finished
     # so it's very important to not set the working directory to a directory that is
     # used for other purposes
     job_dir = os.getcwd() + '/jobs/' + job_id
     os.makedirs(job_dir, exist_ok=True)
 
+    # The input file cache is shared by all the jobs on this compute client
+    # (see sdk/_file_cache.py). Setting COMPUTE_CLIENT_FILE_CACHE_MAX_SIZE_GB
+    # to 0 disables it.
+    file_cache_max_size_gb = os.environ.get('COMPUTE_CLIENT_FILE_CACHE_MAX_SIZE_GB', '100')
+    if float(file_cache_max_size_gb) > 0:
+        file_cache_dir = os.getcwd() + '/file_cache'
+        os.makedirs(file_cache_dir, exist_ok=True)
+    else:
+        file_cache_dir = None
+
     env_vars = {
         'PYTHONUNBUFFERED': '1',
         'JOB_ID': job_id,
@@ -55,6 +102,34 @@ def _start_job(*,
     if job_required_resources.timeSec is not None:
         env_vars['JOB_TIMEOUT_SEC'] = str(int(job_required_resources.timeSec))
 
+    if file_cache_dir is not None:
+        env_vars['DENDRO_FILE_CACHE_DIR'] = '/file_cache'
+        env_vars['DENDRO_FILE_CACHE_MAX_SIZE_GB'] = file_cache_max_size_gb
+        if not is_trusted_app:
+            # The cache is mounted read-only in the container and the
+            # compute client fills it for the job (see FileCacheFiller.py)
+            file_cache_filler = get_file_cache_filler(
+                cache_dir=file_cache_dir,
+                max_size=int(float(file_cache_max_size_gb) * 1024 ** 3)
+            )
+            file_cache_filler.allow_urls([input_file.url for input_file in job.jobDefinition.inputFiles])
+            env_vars['DENDRO_FILE_CACHE_FILL_SOCKET'] = '/file_cache/fill.sock'
+
+    # opt-in profiling of the jobs (see sdk/_profiler.py)
+    job_profile = os.environ.get('COMPUTE_CLIENT_JOB_PROFILE', '')
+    if job_profile:
+        env_vars['DENDRO_JOB_PROFILE'] = job_profile
+
+    if use_control_channel:
+        # Only when the daemon is listening for pubsub messages. Otherwise the
+        # job process needs to poll the job status to find out whether it was
+        # canceled.
+        control_fifo_path = get_job_control_fifo_path(job_id)
+        os.makedirs(os.path.dirname(control_fifo_path), exist_ok=True)
+        if not os.path.exists(control_fifo_path):
+            os.mkfifo(control_fifo_path, 0o600)
+        env_vars['DENDRO_JOB_CONTROL_FIFO'] = '/tmp/_dendro_control'
+
     # Not doing this any more -- instead we are setting a custom backend for kachery uploads
     # kachery_cloud_client_id, kachery_cloud_private_key = _get_kachery_cloud_credentials()
     # if kachery_cloud_client_id is not None:
@@ -62,14 +137,33 @@ def _start_job(*,
     #     assert kachery_cloud_private_key, 'Unexpected: kachery_cloud_private_key is not set even though kachery_cloud_client_id is set'
     #     env_vars['KACHERY_CLOUD_PRIVATE_KEY'] = kachery_cloud_private_key
 
+    if is_trusted_app:
+        return _run_trusted_app_job(
+            app_name=job.jobDefinition.appName,
+            job_id=job_id,
+            job_private_key=job_private_key,
+            compute_client_id=compute_client_id,
+            job_timeout_sec=int(job_required_resources.timeSec) if job_required_resources.timeSec is not None else None,
+            env_vars=env_vars,
+            job_dir=job_dir,
+            file_cache_dir=file_cache_dir,
+            num_cpus=job_required_resources.numCpus,
+            memory_gb=job_required_resources.memoryGb,
+            detach=detach
+        )
+
     return _run_container_job(
+        job_id=job_id,
         processor_executable=processor_executable,
         processor_image=processor_image,
+        image_ref=image_ref,
         env_vars=env_vars,
         job_dir=job_dir,
+        file_cache_dir=file_cache_dir,
         num_cpus=job_required_resources.numCpus,
+        # only a soft limit, because we don't want the process being harshly terminated - it needs to be able to clean up
+        memory_gb=job_required_resources.memoryGb,
         use_gpu=job_required_resources.numGpus > 0,
-        # don't actually limit the memory, because we don't want the process being harshly terminated - it needs to be able to clean up
         detach=detach
     )
 
@@ -94,15 +188,69 @@ def _start_job(*,
 #         else:
 #             break
 
+def _run_trusted_app_job(*,
+    app_name: str,
+    job_id: str,
+    job_private_key: str,
+    compute_client_id: str,
+    job_timeout_sec: Union[int, None],
+    env_vars: dict,
+    job_dir: str,
+    file_cache_dir: Union[str, None],
+    num_cpus: Union[int, None],
+    memory_gb: Union[float, None],
+    detach: bool
+):
+    # No container: the job is forked from the zygote of the app (see
+    # TrustedAppPool.py), so the paths are the host paths that correspond to
+    # the paths that are mounted in the container
+    trusted_app_pool = get_trusted_app_pool()
+    assert trusted_app_pool is not None
+    tmpdir = job_dir + '/tmp'
+    os.makedirs(tmpdir + '/working', exist_ok=True)
+    env_vars['DENDRO_JOB_CLEANUP_DIR'] = tmpdir
+    env_vars['DENDRO_JOB_WORKING_DIR'] = tmpdir + '/working'
+    env_vars['KACHERY_CLOUD_DIR'] = tmpdir + '/.kachery-cloud'
+    env_vars['TMPDIR'] = tmpdir
+    if file_cache_dir is not None:
+        env_vars['DENDRO_FILE_CACHE_DIR'] = file_cache_dir
+    if 'DENDRO_JOB_CONTROL_FIFO' in env_vars:
+        env_vars['DENDRO_JOB_CONTROL_FIFO'] = get_job_control_fifo_path(job_id)
+    # the forked job process moves itself into the cgroup (see sdk/_app_zygote.py)
+    cgroup_dir = create_job_cgroup(job_id=job_id, num_cpus=num_cpus, memory_gb=memory_gb)
+    if cgroup_dir is not None:
+        env_vars['DENDRO_JOB_CGROUP'] = cgroup_dir
+    print(f'Running job {job_id} with trusted app {app_name} (no container)')
+    proc = trusted_app_pool.start_job(
+        app_name=app_name,
+        job_id=job_id,
+        job_private_key=job_private_key,
+        compute_client_id=compute_client_id,
+        job_timeout_sec=job_timeout_sec,
+        env_vars=env_vars,
+        parent_output_file=f'{tmpdir}/_dendro_parent_process_output.txt'
+    )
+    if detach:
+        return proc
+    proc.wait()
+    remove_job_cgroup(job_id)
+    return None
+
 def _run_container_job(*,
+    job_id: str,
     processor_executable: str,
     processor_image: str,
+    image_ref: Union[str, None],
     env_vars: dict,
     job_dir: str,
+    file_cache_dir: Union[str, None],
     num_cpus: Union[int, None],
+    memory_gb: Union[float, None],
     use_gpu: bool,
     detach: bool
 ):
+    # image_ref is what to pass to the container runtime for processor_image,
+    # if it was already obtained from the image manager
     tmpdir = job_dir + '/tmp' # important to provide a /tmp directory for singularity or apptainer so that it doesn't run out of disk space
     os.makedirs(tmpdir, exist_ok=True)
     exe = f'python {processor_executable}' if processor_executable.endswith('.py') else processor_executable
@@ -135,8 +283,28 @@ fi
             'docker', 'run'
         ]
         cmd2.extend(['-v', f'{tmpdir}:/tmp'])
+        if file_cache_dir is not None:
+            # read-only, so that a job can't modify the files that the other
+            # jobs get (the jobs run as root in the container)
+            cmd2.extend(['-v', f'{file_cache_dir}:/file_cache:ro'])
         env_vars['DENDRO_JOB_CLEANUP_DIR'] = '/tmp'
         env_vars['DENDRO_JOB_WORKING_DIR'] = '/tmp/working'
+        # The container is started in a cgroup that we set up for the job,
+        # which has the soft memory limit (memory.high) and the I/O weight,
+        # if docker uses the cgroupfs cgroup driver and cgroups v2 is
+        # delegated to the compute client (see common/cgroups.py)
+        cgroup_dir = None
+        if _get_docker_cgroup_driver() == 'cgroupfs':
+            cgroup_dir = create_job_cgroup(job_id=job_id, num_cpus=num_cpus, memory_gb=memory_gb, for_child_cgroups=True)
+        if cgroup_dir is not None:
+            cmd2.extend(['--cgroup-parent', get_cgroup_path(cgroup_dir)])
+            # so that the job can read the usage and the memory events of the
+            # job cgroup, which is above the cgroup of the container
+            cmd2.extend(['--cgroupns', 'host'])
+            env_vars['DENDRO_JOB_CGROUP'] = cgroup_dir
+        else:
+            # the cgroup that docker creates for the container
+            env_vars['DENDRO_JOB_CGROUP'] = 'self'
         cmd2.extend(['--workdir', '/tmp/working']) # the working directory will be /tmp/working
         for k, v in env_vars.items():
             cmd2.extend(['-e', f'{k}={v}'])
@@ -144,18 +312,25 @@ fi
         cmd2.extend(['-e', 'KACHERY_CLOUD_DIR=/tmp/.kachery-cloud'])
         if num_cpus is not None:
             cmd2.extend(['--cpus', str(num_cpus)])
+            if cgroup_dir is None:
+                # relative to the other containers (10 to 1000)
+                cmd2.extend(['--blkio-weight', str(min(1000, max(10, 100 * num_cpus)))])
+        if memory_gb and cgroup_dir is None:
+            # Without the job cgroup, docker jobs get no soft memory limit:
+            # this is memory.low, which only protects the memory of the
+            # container when the machine is short of memory
+            cmd2.extend(['--memory-reservation', f'{int(memory_gb * 1024)}m'])
         if use_gpu:
             cmd2.extend(['--gpus', 'all'])
         if dendro_api_url.startswith('http://localhost:'):
             # in this case we are in dev mode and we need to allow access to the host network
             cmd2.extend(['--network', 'host'])
-        cmd2.extend([processor_image])
+        # pulls the image only if it was updated (or not yet pulled)
+        cmd2.extend([image_ref if image_ref is not None else get_image_manager().get_image(processor_image)])
         cmd2.extend(['/bin/bash', '/tmp/run.sh'])
-        print(f'Pulling image {processor_image}')
-        subprocess.run(['docker', 'pull', processor_image])
         print(f'Running: {" ".join(cmd2)}')
         if detach:
-            subprocess.Popen(
+            proc = subprocess.Popen(
                 cmd2,
                 cwd=job_dir,
                 start_new_session=True, # This is important so it keeps running even if the compute resource is stopped
@@ -164,12 +339,14 @@ fi
                 stderr=subprocess.DEVNULL,
             )
         else:
+            proc = None
             subprocess.run(
                 cmd2,
                 cwd=job_dir,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
+            remove_job_cgroup(job_id)
     elif container_method == 'singularity' or container_method == 'apptainer':
         os.makedirs(tmpdir, exist_ok=True)
         os.makedirs(tmpdir + '/working', exist_ok=True)
@@ -184,6 +361,9 @@ fi
 
         cmd2 = [executable, 'exec']
         cmd2.extend(['--bind', f'{tmpdir}:/tmp'])
+        if file_cache_dir is not None:
+            # see comment above for docker
+            cmd2.extend(['--bind', f'{file_cache_dir}:/file_cache:ro'])
         # The working directory should be /tmp/working so that if the container wants to write to the working directory, it will not run out of space
         env_vars['DENDRO_JOB_CLEANUP_DIR'] = '/tmp'
         env_vars['DENDRO_JOB_WORKING_DIR'] = '/tmp/working'
@@ -192,6 +372,13 @@ fi
         cmd2.extend(['--contain']) # we don't want singularity or apptainer to mount the home or tmp directories of the host
         if use_gpu:
             cmd2.extend(['--nv'])
+        # Rather than --cpus (which runs into cgroups issues and the container
+        # fails to start), the container is started in a cgroup that we set
+        # up, if cgroups v2 is delegated to the compute client
+        cgroup_dir = create_job_cgroup(job_id=job_id, num_cpus=num_cpus, memory_gb=memory_gb)
+        if cgroup_dir is not None:
+            # /sys is mounted in the container
+            env_vars['DENDRO_JOB_CGROUP'] = cgroup_dir
         for k, v in env_vars.items():
             cmd2.extend(['--env', f'{k}={v}'])
         # we want kachery temporary files to be stored in the /tmp/.kachery-cloud directory
@@ -202,15 +389,14 @@ fi
             # maybe nothing special needs to be done here
             pass
 
-        # don't use --cpus for now because we run into cgroups issues and the container fails to start
-        # if num_cpus is not None:
-        #     cmd2.extend(['--cpus', str(num_cpus)])
-
-        cmd2.extend([f'docker://{processor_image}']) # todo: what if it's not a dockerhub image?
+        # a cached SIF file for the current digest of the image
+        cmd2.extend([image_ref if image_ref is not None else get_image_manager().get_image(processor_image)])
         cmd2.extend(['/bin/bash', '/tmp/run.sh'])
+        if cgroup_dir is not None:
+            cmd2 = get_cgroup_enter_command(cgroup_dir, cmd2)
         print(f'Running: {" ".join(cmd2)}')
         if detach:
-            subprocess.Popen(
+            proc = subprocess.Popen(
                 cmd2,
                 cwd=job_dir,
                 start_new_session=True, # This is important so it keeps running even if the compute resource is stopped
@@ -219,12 +405,14 @@ fi
                 stderr=subprocess.DEVNULL,
             )
         else:
+            proc = None
             subprocess.run(
                 cmd2,
                 cwd=job_dir,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
+            remove_job_cgroup(job_id)
     else:
         raise JobException(f'Unexpected container method: {container_method}')
     # Wait a bit and see if the process has failed right away. This can often happen
@@ -238,3 +426,18 @@ fi
         elif os.path.exists(f'{tmpdir}/_dendro_parent_process_succeeded.txt'):
             break
         time.sleep(0.1)
+    # In detached mode, return the process handle so that the caller can tell
+    # when the container has exited
+    return proc
+
+
+_docker_cgroup_driver: Union[str, None] = None
+
+
+def _get_docker_cgroup_driver() -> str:
+    # cgroupfs or systemd
+    global _docker_cgroup_driver
+    if _docker_cgroup_driver is None:
+        r = subprocess.run(['docker', 'info', '--format', '{{.CgroupDriver}}'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        _docker_cgroup_driver = r.stdout.decode('utf-8').strip() if r.returncode == 0 else ''
+    return _docker_cgroup_driver
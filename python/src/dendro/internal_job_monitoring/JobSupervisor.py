@@ -0,0 +1,275 @@
+from typing import Callable, List, Tuple, Union
+import os
+import json
+import time
+import heapq
+import atexit
+import threading
+import traceback
+import numpy as np
+from .console_output_monitor import do_upload as upload_console_output
+from .resource_utilization_monitor import do_upload as upload_resource_utilization_log
+from .resource_utilization_monitor import get_sample, ProcessTreeSampler
+from .ResourceUtilizationLog import ResourceUtilizationLog
+from .job_status_monitor import check_job_status
+from ..common.cgroups import get_job_cgroup_dir
+
+
+# Runs in a thread of the job parent process and takes care of the periodic
+# tasks of a running job: uploading the console output, sampling and uploading
+# the resource utilization, and checking whether the job was canceled. The
+# tasks are scheduled in a single timer heap, and all the requests go through
+# the shared HTTP session of the process.
+#
+# When the compute client daemon provides a control channel (a named pipe, see
+# DENDRO_JOB_CONTROL_FIFO), cancel messages arrive there as soon as the daemon
+# receives them and the job status is not polled.
+#
+# The resource usage of the job is measured from the cgroup of the job when
+# there is one (see common/cgroups.py) and otherwise from the process tree.
+# When the job goes over its memory limit (memory.high) or processes are
+# killed for lack of memory, a warning is written to the console output of the
+# job. get_resource_usage() is the summary that goes to the job record.
+#
+# stop() does the final uploads. It is also registered with atexit so that the
+# final uploads happen if the parent process exits without calling it (e.g.,
+# after an unexpected exception).
+
+
+def _get_upload_interval(elapsed: float) -> float:
+    # upload often at the beginning of the job, then less often
+    if elapsed < 60:
+        return 10
+    elif elapsed < 60 * 5:
+        return 30
+    elif elapsed < 60 * 20:
+        return 60
+    else:
+        return 120
+
+
+class JobSupervisor:
+    def __init__(self, *, job_id: str, job_private_key: str, console_out_file: str, process_tree_pid: int, control_fifo: Union[str, None] = None) -> None:
+        self._job_id = job_id
+        self._job_private_key = job_private_key
+        self._console_out_file = console_out_file
+        self._resource_utilization_log = ResourceUtilizationLog()
+        self._resource_utilization_upload_state = {'numChunks': 0}
+        self._process_tree_sampler = ProcessTreeSampler(process_tree_pid)
+        self._cgroup_dir = get_job_cgroup_dir()
+        self._last_sample: Union[np.ndarray, None] = None
+        self._peak_rss = 0.0
+        self._timestamp_last_memory_high_warning = 0.0
+        # the resource utilization log is also used by the final flush, which
+        # may run while the thread is still busy
+        self._resource_utilization_lock = threading.Lock()
+        self._control_fifo = control_fifo
+        self._cancel_message: Union[str, None] = None
+        self._cancel_event = threading.Event()
+        self._start_time = time.time()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._stopped = False
+        self._stop_lock = threading.Lock()
+        # (time, sequence number, task name, task function, interval function)
+        self._timers: List[Tuple[float, int, str, Callable[[], None], Callable[[float], float]]] = []
+        self._sequence_number = 0
+
+    def start(self):
+        self._schedule('console_output', self._upload_console_output, _get_upload_interval, delay=10)
+        self._schedule('resource_utilization_sample', self._sample_resource_utilization, lambda elapsed: 10, delay=0)
+        self._schedule('resource_utilization_upload', self._upload_resource_utilization_log, _get_upload_interval, delay=10)
+        control_fd = self._open_control_fifo() if self._control_fifo is not None else None
+        if control_fd is not None:
+            threading.Thread(target=self._read_control_fifo, args=(control_fd,), daemon=True).start()
+        else:
+            self._schedule('job_status', self._check_job_status, _get_upload_interval, delay=10)
+        atexit.register(self.stop)
+        self._thread.start()
+
+    def get_cancel_message(self) -> Union[str, None]:
+        """The reason the job was canceled, or None if it was not canceled"""
+        return self._cancel_message
+
+    def wait_for_cancel(self, timeout: float) -> bool:
+        """Wait until the job is canceled or the timeout expires. Returns whether the job was canceled"""
+        return self._cancel_event.wait(timeout)
+
+    def stop(self):
+        """Stop the periodic tasks and do the final uploads"""
+        with self._stop_lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._stop_event.set()
+        if self._thread.is_alive():
+            # give an ongoing upload a chance to finish
+            self._thread.join(timeout=60)
+        try:
+            self._sample_resource_utilization()
+            self._upload_resource_utilization_log(final=True)
+        except: # noqa
+            traceback.print_exc()
+        try:
+            ok, errmsg = upload_console_output(
+                job_id=self._job_id,
+                job_private_key=self._job_private_key,
+                console_out_file=self._console_out_file
+            )
+            if not ok:
+                print('WARNING: problem uploading final console output')
+                print(errmsg)
+        except: # noqa
+            traceback.print_exc()
+
+    def _schedule(self, name: str, func: Callable[[], None], interval_func: Callable[[float], float], *, delay: float):
+        self._sequence_number += 1
+        heapq.heappush(self._timers, (time.time() + delay, self._sequence_number, name, func, interval_func))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            t, _, name, func, interval_func = self._timers[0]
+            wait = t - time.time()
+            if wait > 0:
+                self._stop_event.wait(wait)
+                continue
+            heapq.heappop(self._timers)
+            try:
+                func()
+            except: # noqa
+                # never let an error stop the supervisor
+                print(f'Error in job supervisor task {name}')
+                traceback.print_exc()
+            if name == 'job_status' and self._cancel_message is not None:
+                # no need to keep checking
+                continue
+            self._schedule(name, func, interval_func, delay=interval_func(time.time() - self._start_time))
+
+    def _upload_console_output(self):
+        upload_console_output(
+            job_id=self._job_id,
+            job_private_key=self._job_private_key,
+            console_out_file=self._console_out_file
+        )
+
+    def get_resource_usage(self) -> Union[dict, None]:
+        """Summary of the resource usage of the job (see DendroJobResourceUsage)"""
+        s = self._last_sample
+        if s is None:
+            return None
+        if not np.isnan(s['cgroup_cpu_usage_sec']):
+            peak_memory = s['cgroup_memory_peak']
+            if np.isnan(peak_memory):
+                # memory.peak requires Linux 5.19
+                peak_memory = self._peak_rss
+            return {
+                'source': 'cgroup',
+                'cpuSec': float(s['cgroup_cpu_usage_sec']),
+                'peakMemoryBytes': float(peak_memory),
+                'readBytes': _float_or_none(s['cgroup_read_bytes']),
+                'writtenBytes': _float_or_none(s['cgroup_write_bytes']),
+                'memoryHighEvents': _int_or_none(s['cgroup_memory_high_events']),
+                'oomKillEvents': _int_or_none(s['cgroup_oom_kill_events'])
+            }
+        return {
+            'source': 'process_tree',
+            'cpuSec': float(s['proc_cpu_user_sec'] + s['proc_cpu_system_sec']),
+            'peakMemoryBytes': float(self._peak_rss),
+            'readBytes': float(s['proc_read_bytes']),
+            'writtenBytes': float(s['proc_write_bytes'])
+        }
+
+    def _sample_resource_utilization(self):
+        sample = get_sample(self._process_tree_sampler, cgroup_dir=self._cgroup_dir)
+        with self._resource_utilization_lock:
+            self._resource_utilization_log.add_sample(sample)
+            previous_sample = self._last_sample
+            self._last_sample = sample
+            memory = sample['cgroup_memory_current'] if not np.isnan(sample['cgroup_memory_current']) else sample['proc_rss']
+            self._peak_rss = max(self._peak_rss, float(memory))
+        if previous_sample is not None:
+            self._check_memory_events(previous_sample, sample)
+
+    def _check_memory_events(self, previous_sample: np.ndarray, sample: np.ndarray):
+        # NaN if there is no cgroup, in which case the comparisons are false
+        if sample['cgroup_oom_kill_events'] > previous_sample['cgroup_oom_kill_events']:
+            n = int(sample['cgroup_oom_kill_events'] - previous_sample['cgroup_oom_kill_events'])
+            self._write_console_warning(f'{n} process(es) of the job were killed because the job ran out of memory')
+        if sample['cgroup_memory_high_events'] > previous_sample['cgroup_memory_high_events']:
+            # at most every 5 minutes, since this can happen continuously
+            if time.time() - self._timestamp_last_memory_high_warning > 60 * 5:
+                self._timestamp_last_memory_high_warning = time.time()
+                self._write_console_warning('The job is using more memory than it requested and is being slowed down. Consider increasing requiredResources.memoryGb.')
+
+    def _write_console_warning(self, msg: str):
+        print(f'WARNING: {msg}')
+        try:
+            # so that the user sees it in the console output of the job
+            with open(self._console_out_file, 'a') as f:
+                f.write(f'[dendro] WARNING: {msg}\n')
+        except: # noqa
+            traceback.print_exc()
+
+    def _upload_resource_utilization_log(self, final: bool = False):
+        with self._resource_utilization_lock:
+            upload_resource_utilization_log(
+                log=self._resource_utilization_log,
+                upload_state=self._resource_utilization_upload_state,
+                final=final,
+                job_id=self._job_id,
+                job_private_key=self._job_private_key
+            )
+
+    def _check_job_status(self):
+        try:
+            cancel_message = check_job_status(self._job_id)
+        except: # noqa
+            # maybe there was a network error
+            # so we don't want to cancel the job at this point
+            print('Error getting job status')
+            traceback.print_exc()
+            return
+        if cancel_message is not None:
+            self._cancel(cancel_message)
+
+    def _cancel(self, cancel_message: str):
+        print(f'{cancel_message}. Canceling.')
+        self._cancel_message = cancel_message
+        self._cancel_event.set()
+
+    def _open_control_fifo(self) -> Union[int, None]:
+        assert self._control_fifo is not None
+        try:
+            # Opening for reading and writing does not block until there is a
+            # writer, and we don't get an end of file each time the daemon
+            # closes its end
+            return os.open(self._control_fifo, os.O_RDWR)
+        except: # noqa
+            print(f'Error opening control channel {self._control_fifo}. Falling back to checking the job status.')
+            traceback.print_exc()
+            return None
+
+    def _read_control_fifo(self, fd: int):
+        buf = b''
+        while True:
+            data = os.read(fd, 4096)
+            if not data:
+                break
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                try:
+                    msg = json.loads(line)
+                except: # noqa
+                    print(f'Unexpected message on control channel: {line!r}')
+                    continue
+                if msg.get('type') == 'cancel':
+                    self._cancel('Job was canceled')
+
+
+def _float_or_none(x) -> Union[float, None]:
+    return None if np.isnan(x) else float(x)
+
+
+def _int_or_none(x) -> Union[int, None]:
+    return None if np.isnan(x) else int(x)
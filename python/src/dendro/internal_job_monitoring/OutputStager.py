@@ -0,0 +1,164 @@
+from typing import Callable, Dict, List, Union
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+# not the same as the builtin TimeoutError before python 3.11
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+
+# Uploads the output files of a job in the background, so that the uploads
+# overlap with the rest of the computation.
+#
+# The job parent process creates the staging directory (_dendro/output_staging
+# in the job working directory) before it starts the job child process. When
+# the directory exists, OutputFile.upload in the child moves the file into it,
+# appends an entry to manifest.jsonl and returns right away (see
+# stage_output_file). The stager, which runs in the parent process, picks up
+# the entries and uploads the files. The job is only marked as completed once
+# all the uploads have finished (see drain). Set DENDRO_OUTPUT_STAGING=0 to
+# upload synchronously in the child as before.
+
+_manifest_fname = 'manifest.jsonl'
+
+
+def get_output_staging_dir() -> Union[str, None]:
+    """The staging directory if the parent process is staging the outputs, otherwise None"""
+    working_dir = os.environ.get('DENDRO_JOB_WORKING_DIR', None)
+    d = f'{working_dir}/_dendro/output_staging' if working_dir is not None else '_dendro/output_staging'
+    return d if os.path.isdir(d) else None
+
+
+def stage_output_file(*, staging_dir: str, output_name: str, local_file_name: str, delete_local_file: bool):
+    """Hand an output file to the stager of the parent process (called in the job child process)"""
+    staged_file = f'{staging_dir}/{uuid.uuid4().hex}_{output_name}'
+    if delete_local_file:
+        try:
+            # same file system, so this doesn't copy anything
+            os.rename(local_file_name, staged_file)
+        except OSError:
+            shutil.copyfile(local_file_name, staged_file)
+            os.remove(local_file_name)
+    else:
+        # the processor may keep using the file, so the staged file must not
+        # change
+        shutil.copyfile(local_file_name, staged_file)
+    line = json.dumps({'outputName': output_name, 'stagedFile': staged_file}) + '\n'
+    # a single write to a file opened for appending, so that the stager never
+    # sees a partial line from a concurrent write
+    fd = os.open(f'{staging_dir}/{_manifest_fname}', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+
+class OutputStager:
+    def __init__(self, *, job_id: str, job_private_key: str, staging_dir: str, log: Callable[[str], None]) -> None:
+        self._job_id = job_id
+        self._job_private_key = job_private_key
+        self._staging_dir = staging_dir
+        self._log = log
+        num_workers = int(os.environ.get('DENDRO_OUTPUT_UPLOAD_CONCURRENCY', '2'))
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._manifest_offset = 0
+        self._futures: Dict[str, Future] = {}
+        self._errors: List[str] = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self._staging_dir, exist_ok=True)
+        self._thread.start()
+
+    def drain(self, *, should_abort: Callable[[], Union[str, None]]) -> List[str]:
+        """Wait for all the staged files to be uploaded. Returns the errors
+
+        should_abort is called periodically and returns a reason to stop
+        waiting (e.g., the job was canceled), or None.
+        """
+        self._stop_event.set()
+        self._thread.join()
+        # entries that were added after the last check
+        self._check_manifest()
+        num_pending = sum(1 for f in self._futures.values() if not f.done())
+        if num_pending > 0:
+            self._log(f'Waiting for {num_pending} output upload(s) to finish')
+        for future in list(self._futures.values()):
+            while True:
+                try:
+                    future.result(timeout=1)
+                    break
+                except FutureTimeoutError:
+                    reason = should_abort()
+                    if reason is not None:
+                        self.stop()
+                        return self._errors + [reason]
+                except Exception:
+                    # recorded in _upload
+                    break
+        self._executor.shutdown(wait=True)
+        return self._errors
+
+    def stop(self):
+        """Stop without waiting for the uploads that have not started (e.g., because the job failed)"""
+        self._stop_event.set()
+        for future in self._futures.values():
+            future.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _run(self):
+        while not self._stop_event.wait(0.5):
+            try:
+                self._check_manifest()
+            except: # noqa
+                traceback.print_exc()
+
+    def _check_manifest(self):
+        fname = f'{self._staging_dir}/{_manifest_fname}'
+        if not os.path.exists(fname):
+            return
+        with open(fname, 'rb') as f:
+            f.seek(self._manifest_offset)
+            data = f.read()
+        # only complete lines
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            return
+        self._manifest_offset += end
+        for line in data[:end].splitlines():
+            entry = json.loads(line)
+            output_name = entry['outputName']
+            if output_name in self._futures:
+                # uploaded again, so make sure that the last one wins
+                wait([self._futures[output_name]])
+            self._futures[output_name] = self._executor.submit(self._upload, output_name, entry['stagedFile'])
+
+    def _upload(self, output_name: str, staged_file: str):
+        from ..sdk._upload_file import upload_file_to_dendro
+        from ..sdk._timings import timed_span
+        timer = time.time()
+        size = os.path.getsize(staged_file)
+        self._log(f'Uploading output file {output_name} ({size / 1024 ** 2:.1f} MB)')
+        try:
+            with timed_span('upload', output=output_name, size=size):
+                upload_file_to_dendro(
+                    staged_file,
+                    job_id=self._job_id,
+                    job_private_key=self._job_private_key,
+                    upload_type='output',
+                    output_name=output_name,
+                    other_name=None
+                )
+        except Exception as e:
+            with self._lock:
+                self._errors.append(f'Error uploading output file {output_name}: {e}')
+            self._log(f'Error uploading output file {output_name}: {e}')
+            raise
+        os.remove(staged_file)
+        self._log(f'Uploaded output file {output_name} in {time.time() - timer:.1f} seconds')
@@ -0,0 +1,208 @@
+from typing import List, Union
+import json
+import numpy as np
+
+
+# The samples are stored in numpy structured arrays used as ring buffers, at
+# three resolutions. The raw samples (every 10 seconds) are kept for two
+# hours, per-minute averages for two days and per-hour averages for 90 days,
+# so the memory used and the size of the uploaded log are bounded no matter
+# how long the job runs. The full resolution samples are also handed out in
+# chunks (see get_unchunked_samples) that are uploaded once each.
+
+sample_dtype = np.dtype([
+    ('timestamp', 'f8'),
+    ('cpu_percent', 'f4'),
+    ('memory_total', 'f8'),
+    ('memory_available', 'f8'),
+    ('memory_used', 'f8'),
+    ('memory_percent', 'f4'),
+    ('disk_read_bytes', 'f8'),
+    ('disk_write_bytes', 'f8'),
+    ('net_bytes_sent', 'f8'),
+    ('net_bytes_recv', 'f8'),
+    ('gpu_load', 'f4'),  # NaN if there are no GPUs
+    ('upload_bytes_sent', 'f8'),  # NaN if there are no uploads
+    ('upload_bytes_per_sec', 'f4'),
+    ('proc_num_processes', 'i4'),
+    ('proc_rss', 'f8'),
+    ('proc_cpu_percent', 'f4'),  # as a percent of the whole machine
+    ('proc_cpu_user_sec', 'f8'),
+    ('proc_cpu_system_sec', 'f8'),
+    ('proc_read_bytes', 'f8'),
+    ('proc_write_bytes', 'f8'),
+    # usage of the cgroup of the job (NaN if not available, see common/cgroups.py)
+    ('cgroup_cpu_usage_sec', 'f8'),
+    ('cgroup_memory_current', 'f8'),
+    ('cgroup_memory_peak', 'f8'),
+    ('cgroup_read_bytes', 'f8'),
+    ('cgroup_write_bytes', 'f8'),
+    ('cgroup_memory_high_events', 'f8'),
+    ('cgroup_oom_kill_events', 'f8'),
+])
+
+# Fields that are cumulative counters, for which we keep the last value
+# rather than the average when downsampling
+_cumulative_fields = [
+    'timestamp',
+    'disk_read_bytes', 'disk_write_bytes',
+    'net_bytes_sent', 'net_bytes_recv',
+    'upload_bytes_sent',
+    'proc_cpu_user_sec', 'proc_cpu_system_sec',
+    'proc_read_bytes', 'proc_write_bytes',
+    'memory_total', 'proc_num_processes',
+    'cgroup_cpu_usage_sec', 'cgroup_memory_peak',
+    'cgroup_read_bytes', 'cgroup_write_bytes',
+    'cgroup_memory_high_events', 'cgroup_oom_kill_events'
+]
+
+
+class _RingBuffer:
+    def __init__(self, capacity: int) -> None:
+        self._data = np.zeros(capacity, dtype=sample_dtype)
+        self._start = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, sample: np.ndarray):
+        capacity = len(self._data)
+        self._data[(self._start + self._count) % capacity] = sample
+        if self._count < capacity:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % capacity
+
+    def get(self) -> np.ndarray:
+        """All the samples, oldest first"""
+        capacity = len(self._data)
+        inds = (self._start + np.arange(self._count)) % capacity
+        return self._data[inds]
+
+
+def _downsample(samples: np.ndarray) -> np.ndarray:
+    ret = np.zeros(1, dtype=sample_dtype)[0]
+    for name in sample_dtype.names or []:
+        if name in _cumulative_fields:
+            ret[name] = samples[name][-1]
+        else:
+            ret[name] = np.mean(samples[name])
+    return ret
+
+
+class ResourceUtilizationLog:
+    def __init__(self) -> None:
+        self._raw = _RingBuffer(capacity=6 * 60 * 2)
+        self._minutes = _RingBuffer(capacity=60 * 24 * 2)
+        self._hours = _RingBuffer(capacity=24 * 90)
+        # samples that have not yet been aggregated into the coarser levels
+        self._pending_minute: List[np.ndarray] = []
+        self._pending_hour: List[np.ndarray] = []
+        self._current_minute: Union[int, None] = None
+        self._current_hour: Union[int, None] = None
+        # samples that have not yet been handed out in a chunk
+        self._unchunked: List[np.ndarray] = []
+
+    def add_sample(self, sample: np.ndarray):
+        self._raw.append(sample)
+        self._unchunked.append(sample)
+        minute = int(sample['timestamp'] // 60)
+        if self._current_minute is not None and minute != self._current_minute and len(self._pending_minute) > 0:
+            m = _downsample(np.array(self._pending_minute, dtype=sample_dtype))
+            self._pending_minute = []
+            self._minutes.append(m)
+            hour = int(m['timestamp'] // 3600)
+            if self._current_hour is not None and hour != self._current_hour and len(self._pending_hour) > 0:
+                self._hours.append(_downsample(np.array(self._pending_hour, dtype=sample_dtype)))
+                self._pending_hour = []
+            self._current_hour = hour
+            self._pending_hour.append(m)
+        self._current_minute = minute
+        self._pending_minute.append(sample)
+
+    def get_num_unchunked_samples(self) -> int:
+        return len(self._unchunked)
+
+    def get_unchunked_samples(self) -> bytes:
+        """The full resolution samples since the previous chunk, as JSON lines"""
+        return _to_json_lines(np.array(self._unchunked, dtype=sample_dtype), resolution_sec=None)
+
+    def clear_unchunked_samples(self):
+        """Call this once the chunk from get_unchunked_samples has been uploaded"""
+        self._unchunked = []
+
+    def get_summary(self) -> bytes:
+        """The whole history as JSON lines, at decreasing resolution for older samples"""
+        raw = self._raw.get()
+        minutes = self._minutes.get()
+        hours = self._hours.get()
+        t_raw = raw['timestamp'][0] if len(raw) > 0 else np.inf
+        minutes = minutes[minutes['timestamp'] < t_raw]
+        t_minutes = minutes['timestamp'][0] if len(minutes) > 0 else t_raw
+        hours = hours[hours['timestamp'] < t_minutes]
+        return (
+            _to_json_lines(hours, resolution_sec=3600) +
+            _to_json_lines(minutes, resolution_sec=60) +
+            _to_json_lines(raw, resolution_sec=None)
+        )
+
+
+def _to_json_lines(samples: np.ndarray, *, resolution_sec: Union[int, None]) -> bytes:
+    lines = []
+    for s in samples:
+        # Same format as the original (uncompressed) log records, so that the
+        # log can be displayed by older versions of the web app
+        record = {
+            'timestamp': float(s['timestamp']),
+            'cpu': {
+                'percent': float(s['cpu_percent'])
+            },
+            'virtual_memory': {
+                'total': float(s['memory_total']),
+                'available': float(s['memory_available']),
+                'percent': float(s['memory_percent']),
+                'used': float(s['memory_used'])
+            },
+            'disk_io_counters': {
+                'read_bytes': float(s['disk_read_bytes']),
+                'write_bytes': float(s['disk_write_bytes'])
+            },
+            'net_io_counters': {
+                'bytes_sent': float(s['net_bytes_sent']),
+                'bytes_recv': float(s['net_bytes_recv'])
+            },
+            'gpu': {
+                'loads': [float(s['gpu_load'])]
+            } if not np.isnan(s['gpu_load']) else None,
+            'upload': {
+                'bytes_sent': float(s['upload_bytes_sent']),
+                'bytes_per_sec': float(s['upload_bytes_per_sec'])
+            } if not np.isnan(s['upload_bytes_sent']) else None,
+            'process_tree': {
+                'num_processes': int(s['proc_num_processes']),
+                'rss': float(s['proc_rss']),
+                'cpu_percent': float(s['proc_cpu_percent']),
+                'cpu_user_sec': float(s['proc_cpu_user_sec']),
+                'cpu_system_sec': float(s['proc_cpu_system_sec']),
+                'read_bytes': float(s['proc_read_bytes']),
+                'write_bytes': float(s['proc_write_bytes'])
+            },
+            'cgroup': {
+                'cpu_usage_sec': float(s['cgroup_cpu_usage_sec']),
+                'memory_current': _float_or_none(s['cgroup_memory_current']),
+                'memory_peak': _float_or_none(s['cgroup_memory_peak']),
+                'read_bytes': _float_or_none(s['cgroup_read_bytes']),
+                'write_bytes': _float_or_none(s['cgroup_write_bytes']),
+                'memory_high_events': _float_or_none(s['cgroup_memory_high_events']),
+                'oom_kill_events': _float_or_none(s['cgroup_oom_kill_events'])
+            } if not np.isnan(s['cgroup_cpu_usage_sec']) else None
+        }
+        if resolution_sec is not None:
+            record['resolution_sec'] = resolution_sec
+        lines.append(json.dumps(record) + '\n')
+    return ''.join(lines).encode('utf-8')
+
+
+def _float_or_none(x) -> Union[float, None]:
+    return None if np.isnan(x) else float(x)
@@ -1,91 +1,136 @@
+from typing import Union
 import os
-import time
+import json
+import fcntl
 import traceback
-from .utils import _process_is_alive
 from ..common.api_requests import get_upload_url
+from ..common.http_session import get_http_session
 
 
-def console_output_monitor(parent_pid: str):
-    """
-    Monitor console output of a job.
-    """
-    job_id = os.environ.get('JOB_ID', None)
-    if job_id is None:
-        raise KeyError('JOB_ID is not set')
-    job_private_key = os.environ.get('JOB_PRIVATE_KEY', None)
-    if job_private_key is None:
-        raise KeyError('JOB_PRIVATE_KEY is not set')
-    console_out_file = os.environ.get('CONSOLE_OUT_FILE', None)
-    if console_out_file is None:
-        raise KeyError('CONSOLE_OUT_FILE is not set')
-
-    last_upload_timestamp = 0
-    overall_timer = time.time()
-
-    while True:
-        if not _process_is_alive(parent_pid):
-            print(f'Parent process {parent_pid} is no longer alive. Doing final upload.')
-            do_upload(
-                console_out_file=console_out_file,
-                job_id=job_id,
-                job_private_key=job_private_key
-            )
-            print('Exiting.')
-            break
-
-        elapsed_since_upload = time.time() - last_upload_timestamp
-        overall_elapsed = time.time() - overall_timer
-        if overall_elapsed < 60:
-            interval = 10
-        elif overall_elapsed < 60 * 5:
-            interval = 30
-        elif overall_elapsed < 60 * 20:
-            interval = 60
-        else:
-            interval = 120
-        if elapsed_since_upload >= interval:
-            last_upload_timestamp = time.time()
-            do_upload(
-                console_out_file=console_out_file,
-                job_id=job_id,
-                job_private_key=job_private_key
-            )
+# The console output is uploaded incrementally. Once the part of the file that
+# has not yet been uploaded reaches the segment size, it is uploaded once as a
+# sealed segment (an "other" file output of the job named
+# console_output/segment_NNNNN.txt). The console output of the job itself is
+# only the tail of the file (at most _max_tail_size bytes), so the cost of each
+# upload does not grow with the total output. The upload state is kept in a
+# file next to the console output so that the final upload by the parent
+# process continues where the monitor left off.
+
+_segment_size = 4 * 1024 * 1024
+_max_tail_size = 1024 * 1024
 
-        time.sleep(1)
 
 def do_upload(*, console_out_file, job_id, job_private_key):
-    import requests
     if not os.path.exists(console_out_file):
         return True, ''
-    with open(console_out_file, 'r') as f:
-        console_text = f.read()
-    console_text_lines = console_text.split('\n')
-    new_lines = []
-    for line in console_text_lines:
-        # handle carriage return (e.g. in progress bar)
-        # find the last \r
-        last_cr_index = line.rfind('\r')
-        if last_cr_index != -1:
-            new_lines.append(line[last_cr_index + 1:].encode('utf-8'))
-        else:
-            new_lines.append(line.encode('utf-8'))
-    text_to_upload = b'\n'.join(new_lines)
     try:
-        console_output_upload_url, _ = get_upload_url(
-            job_id=job_id,
-            job_private_key=job_private_key,
-            upload_type='consoleOutput',
-            output_name=None,
-            other_name=None,
-            size=len(text_to_upload)
-        )
-        if not isinstance(console_output_upload_url, str):
-            raise Exception(f'Error getting console output upload url (not a string): {console_output_upload_url}')
-        r = requests.put(console_output_upload_url, data=text_to_upload, timeout=5)
-        if r.status_code != 200:
-            raise Exception(f'Error uploading console output: {r.status_code} {r.text}')
+        with _UploadStateLock(console_out_file):
+            state = _load_upload_state(console_out_file)
+            size = os.path.getsize(console_out_file)
+            if size == state['uploadedSize']:
+                # nothing new
+                return True, ''
+            with open(console_out_file, 'rb') as f:
+                while size - state['sealedOffset'] >= _segment_size:
+                    f.seek(state['sealedOffset'])
+                    data = f.read(_segment_size)
+                    # end the segment at a line break if possible
+                    cut = data.rfind(b'\n') + 1
+                    if cut == 0:
+                        cut = len(data)
+                    segment_name = f'console_output/segment_{state["numSegments"] + 1:05d}.txt'
+                    _upload_data(
+                        data=_process_carriage_returns(data[:cut]),
+                        job_id=job_id,
+                        job_private_key=job_private_key,
+                        upload_type='other',
+                        other_name=segment_name
+                    )
+                    state['sealedOffset'] += cut
+                    state['numSegments'] += 1
+                    _save_upload_state(console_out_file, state)
+                tail_start = max(0, size - _max_tail_size)
+                f.seek(tail_start)
+                tail = f.read(size - tail_start)
+            if tail_start > 0:
+                # start at a line break
+                tail = tail[tail.find(b'\n') + 1:]
+                header = f'[Showing the last {len(tail) / 1e6:.1f} MB of the console output. The earlier output is in the console_output/ files of this job.]\n'.encode('utf-8')
+            else:
+                header = b''
+            _upload_data(
+                data=header + _process_carriage_returns(tail),
+                job_id=job_id,
+                job_private_key=job_private_key,
+                upload_type='consoleOutput',
+                other_name=None
+            )
+            state['uploadedSize'] = size
+            _save_upload_state(console_out_file, state)
         return True, ''
     except: # noqa
         print('Error uploading console output')
         traceback.print_exc()
         return False, traceback.format_exc()
+
+
+def _process_carriage_returns(data: bytes) -> bytes:
+    new_lines = []
+    for line in data.split(b'\n'):
+        # handle carriage return (e.g. in progress bar)
+        # find the last \r
+        last_cr_index = line.rfind(b'\r')
+        if last_cr_index != -1:
+            new_lines.append(line[last_cr_index + 1:])
+        else:
+            new_lines.append(line)
+    return b'\n'.join(new_lines)
+
+
+def _upload_data(*, data: bytes, job_id: str, job_private_key: str, upload_type: str, other_name: Union[str, None]):
+    upload_url, _ = get_upload_url(
+        job_id=job_id,
+        job_private_key=job_private_key,
+        upload_type=upload_type,  # type: ignore
+        output_name=None,
+        other_name=other_name,
+        size=len(data)
+    )
+    if not isinstance(upload_url, str):
+        raise Exception(f'Error getting console output upload url (not a string): {upload_url}')
+    r = get_http_session().put(upload_url, data=data, timeout=60)
+    if r.status_code != 200:
+        raise Exception(f'Error uploading console output: {r.status_code} {r.text}')
+
+
+def _load_upload_state(console_out_file: str) -> dict:
+    fname = console_out_file + '.upload_state.json'
+    if os.path.exists(fname):
+        with open(fname, 'r') as f:
+            return json.load(f)
+    return {'sealedOffset': 0, 'numSegments': 0, 'uploadedSize': -1}
+
+
+def _save_upload_state(console_out_file: str, state: dict):
+    fname = console_out_file + '.upload_state.json'
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(fname + '.tmp', fname)
+
+
+class _UploadStateLock:
+    # The monitor and the parent process (final upload) may upload at the
+    # same time, and a segment must not be uploaded twice
+    def __init__(self, console_out_file: str) -> None:
+        self._fname = console_out_file + '.upload_state.lock'
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = os.open(self._fname, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
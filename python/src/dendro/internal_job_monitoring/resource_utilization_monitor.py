@@ -1,136 +1,191 @@
+from typing import Union
 import os
 import time
 import traceback
 import json
+import numpy as np
 import psutil
-from .utils import _process_is_alive
+from .ResourceUtilizationLog import ResourceUtilizationLog, sample_dtype
 from ..common.api_requests import get_upload_url
+from ..common.http_session import get_http_session
+from ..common.cgroups import read_cgroup_usage
 
+# one hour of samples per chunk
+_samples_per_chunk = 360
+# minimum time between uploads of the resource utilization log (the summary),
+# which is otherwise uploaded at the start and at the end of the job
+_summary_upload_interval_sec = 60 * 10
 
-def resource_utilization_monitor(parent_pid: str):
-    """
-    Monitor resource utilization of a job.
+
+def get_sample(process_tree_sampler: 'ProcessTreeSampler', cgroup_dir: Union[str, None] = None) -> np.ndarray:
+    sample = np.zeros(1, dtype=sample_dtype)[0]
+    sample['timestamp'] = time.time()
+    sample['cpu_percent'] = psutil.cpu_percent()
+    virtual_memory = psutil.virtual_memory()
+    sample['memory_total'] = virtual_memory.total
+    sample['memory_available'] = virtual_memory.available
+    sample['memory_used'] = virtual_memory.used
+    sample['memory_percent'] = virtual_memory.percent
+    disk_io_counters = psutil.disk_io_counters()
+    if disk_io_counters:
+        sample['disk_read_bytes'] = disk_io_counters.read_bytes
+        sample['disk_write_bytes'] = disk_io_counters.write_bytes
+    net_io_counters = psutil.net_io_counters(pernic=False, nowrap=True)
+    sample['net_bytes_sent'] = net_io_counters.bytes_sent
+    sample['net_bytes_recv'] = net_io_counters.bytes_recv
+    gpu_loads = _get_gpu_loads()
+    # we only keep the total load over all the GPUs
+    sample['gpu_load'] = sum(gpu_loads) if gpu_loads else np.nan
+    upload_stats = _get_upload_stats()
+    sample['upload_bytes_sent'] = upload_stats['bytes_sent'] if upload_stats else np.nan
+    sample['upload_bytes_per_sec'] = upload_stats['bytes_per_sec'] if upload_stats else np.nan
+    process_tree_sampler.fill_sample(sample)
+    cgroup_usage = read_cgroup_usage(cgroup_dir) if cgroup_dir is not None else None
+    for k in ['cpu_usage_sec', 'memory_current', 'memory_peak', 'read_bytes', 'write_bytes', 'memory_high_events', 'oom_kill_events']:
+        sample[f'cgroup_{k}'] = cgroup_usage[k] if cgroup_usage is not None else np.nan
+    return sample
+
+class ProcessTreeSampler:
+    """Resource usage of the job's process tree (the job parent process and all its descendants)
+
+    Note that the processes in a docker container are not descendants of the
+    job process, so they are not included for docker jobs.
     """
-    job_id = os.environ.get('JOB_ID', None)
-    if job_id is None:
-        raise KeyError('JOB_ID is not set')
-    job_private_key = os.environ.get('JOB_PRIVATE_KEY', None)
-    if job_private_key is None:
-        raise KeyError('JOB_PRIVATE_KEY is not set')
-    last_report_timestamp = 0
-    last_upload_timestamp = 0
-    overall_timer = time.time()
-    all_lines = []
+    def __init__(self, pid: int) -> None:
+        self._pid = pid
+        self._last_cpu_sec = None
+        self._last_timestamp = None
+        self._num_cpus = psutil.cpu_count() or 1
 
-    while True:
-        if not _process_is_alive(parent_pid):
-            print(f'Parent process {parent_pid} is no longer alive. Doing final upload.')
-            do_upload(
-                all_lines=all_lines,
-                job_id=job_id,
-                job_private_key=job_private_key
-            )
-            print('Exiting.')
-            break
+    def fill_sample(self, sample: np.ndarray):
+        try:
+            parent = psutil.Process(self._pid)
+            processes = [parent] + parent.children(recursive=True)
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return
+        num_processes = 0
+        rss = 0
+        cpu_user = 0.0
+        cpu_system = 0.0
+        read_bytes = 0
+        write_bytes = 0
+        for p in processes:
+            try:
+                with p.oneshot():
+                    mem = p.memory_info()
+                    cpu_times = p.cpu_times()
+                    try:
+                        io_counters = p.io_counters()
+                    except (AttributeError, psutil.AccessDenied):
+                        # not available on all platforms
+                        io_counters = None
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            num_processes += 1
+            rss += mem.rss
+            # include the children that have exited and been waited for, so
+            # that the totals don't drop when a subprocess finishes
+            cpu_user += cpu_times.user + getattr(cpu_times, 'children_user', 0)
+            cpu_system += cpu_times.system + getattr(cpu_times, 'children_system', 0)
+            if io_counters is not None:
+                read_bytes += io_counters.read_bytes
+                write_bytes += io_counters.write_bytes
+        timestamp = time.time()
+        cpu_sec = cpu_user + cpu_system
+        if self._last_cpu_sec is not None and self._last_timestamp is not None and timestamp > self._last_timestamp:
+            cpu_percent = max(0, cpu_sec - self._last_cpu_sec) / (timestamp - self._last_timestamp) / self._num_cpus * 100
+        else:
+            cpu_percent = 0
+        self._last_cpu_sec = cpu_sec
+        self._last_timestamp = timestamp
+        sample['proc_num_processes'] = num_processes
+        sample['proc_rss'] = rss
+        sample['proc_cpu_percent'] = cpu_percent
+        sample['proc_cpu_user_sec'] = cpu_user
+        sample['proc_cpu_system_sec'] = cpu_system
+        sample['proc_read_bytes'] = read_bytes
+        sample['proc_write_bytes'] = write_bytes
 
-        elapsed_since_report = time.time() - last_report_timestamp
-        if elapsed_since_report >= 10:
-            last_report_timestamp = time.time()
-            cpu_percent = psutil.cpu_percent()
-            virtual_memory = psutil.virtual_memory()
-            disk_io_counters = psutil.disk_io_counters()
-            net_io_counters = psutil.net_io_counters(pernic=False, nowrap=True)
-            gpu_loads = _get_gpu_loads()
-            log_record = {
-                'timestamp': time.time(),
-                'cpu': {
-                    'percent': cpu_percent
-                },
-                'virtual_memory': {
-                    'total': virtual_memory.total,
-                    'available': virtual_memory.available,
-                    'percent': virtual_memory.percent,
-                    'used': virtual_memory.used,
-                    'free': virtual_memory.free,
-                    'active': virtual_memory.active,
-                    'inactive': virtual_memory.inactive,
-                    'buffers': virtual_memory.buffers,
-                    'cached': virtual_memory.cached,
-                    'shared': virtual_memory.shared,
-                    'slab': virtual_memory.slab
-                },
-                'disk_io_counters': {
-                    'read_count': disk_io_counters.read_count,
-                    'write_count': disk_io_counters.write_count,
-                    'read_bytes': disk_io_counters.read_bytes,
-                    'write_bytes': disk_io_counters.write_bytes,
-                    'read_time': disk_io_counters.read_time,
-                    'write_time': disk_io_counters.write_time
-                } if disk_io_counters else None,
-                'net_io_counters': {
-                    'bytes_sent': net_io_counters.bytes_sent,
-                    'bytes_recv': net_io_counters.bytes_recv,
-                    'packets_sent': net_io_counters.packets_sent,
-                    'packets_recv': net_io_counters.packets_recv,
-                    'errin': net_io_counters.errin,
-                    'errout': net_io_counters.errout,
-                    'dropin': net_io_counters.dropin,
-                    'dropout': net_io_counters.dropout
-                },
-                'gpu': {
-                    'loads': gpu_loads
-                } if gpu_loads else None
-            }
-            line = (json.dumps(log_record) + '\n').encode('utf-8') # important to encode this string
-            all_lines.append(line)
-            elapsed_since_upload = time.time() - last_upload_timestamp
-            overall_elapsed = time.time() - overall_timer
-            if overall_elapsed < 60:
-                interval = 10
-            elif overall_elapsed < 60 * 5:
-                interval = 30
-            elif overall_elapsed < 60 * 20:
-                interval = 60
-            else:
-                interval = 120
-            if elapsed_since_upload >= interval:
-                last_upload_timestamp = time.time()
-                do_upload(
-                    all_lines=all_lines,
-                    job_id=job_id,
-                    job_private_key=job_private_key
-                )
+def _get_upload_stats():
+    # written by the uploader in the job process (see sdk/_upload_file.py)
+    working_dir = os.environ.get('DENDRO_JOB_WORKING_DIR', None)
+    if working_dir is None:
+        return None
+    fname = f'{working_dir}/_dendro/upload_stats.json'
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            x = json.load(f)
+    except: # noqa
+        return None
+    if x['num_active'] == 0 and time.time() - x['timestamp'] > 60:
+        # no recent uploads
+        return None
+    return {
+        'bytes_sent': x['bytes_sent'],
+        'bytes_per_sec': x['bytes_per_sec']
+    }
 
-        time.sleep(1)
+_gpu_warning_printed = False
 
 def _get_gpu_loads():
-    """This is a helper function for _resource_utilization_log_reader"""
+    global _gpu_warning_printed
     try:
         import GPUtil  # type: ignore
         gpus = GPUtil.getGPUs()
         return [gpu.load for gpu in gpus]
     except: # noqa
-        print('Warning: Error getting GPU loads. Perhaps GPUtil is not installed?')
+        if not _gpu_warning_printed:
+            # only once, since this now runs inside the job parent process
+            print('Warning: Error getting GPU loads. Perhaps GPUtil is not installed?')
+            _gpu_warning_printed = True
         return None
 
-def do_upload(*, all_lines, job_id, job_private_key):
-    import requests
-    print(f'Uploading {len(all_lines)} lines of resource utilization data')
-    text_to_upload = b'\n'.join(all_lines)
+def do_upload(*, log: ResourceUtilizationLog, upload_state: dict, final: bool, job_id: str, job_private_key: str):
+    # The full resolution samples are uploaded in chunks, each chunk once
+    # (as other files of the job). The resource utilization log itself is the
+    # downsampled history, which has a bounded size but is uploaded in full
+    # each time, so it is only uploaded every _summary_upload_interval_sec.
     try:
-        resource_utilization_log_upload_url, _ = get_upload_url(
-            job_id=job_id,
-            job_private_key=job_private_key,
-            upload_type='resourceUtilizationLog',
-            other_name=None,
-            output_name=None,
-            size=len(text_to_upload)
-        )
-        if not isinstance(resource_utilization_log_upload_url, str):
-            raise Exception(f'Error getting console output upload url (not a string): {resource_utilization_log_upload_url}')
-        r = requests.put(resource_utilization_log_upload_url, data=text_to_upload, timeout=5)
-        if r.status_code != 200:
-            raise Exception(f'Error uploading resource utilization log: {r.status_code} {r.text}')
+        num_unchunked = log.get_num_unchunked_samples()
+        if num_unchunked >= _samples_per_chunk or (final and num_unchunked > 0):
+            chunk_name = f'resource_utilization/chunk_{upload_state["numChunks"]:05d}.jsonl'
+            print(f'Uploading {num_unchunked} samples of resource utilization data to {chunk_name}')
+            _upload_data(
+                data=log.get_unchunked_samples(),
+                job_id=job_id,
+                job_private_key=job_private_key,
+                upload_type='other',
+                other_name=chunk_name
+            )
+            log.clear_unchunked_samples()
+            upload_state['numChunks'] += 1
+        timestamp_summary_uploaded = upload_state.get('timestampSummaryUploaded', None)
+        if final or timestamp_summary_uploaded is None or time.time() - timestamp_summary_uploaded >= _summary_upload_interval_sec:
+            _upload_data(
+                data=log.get_summary(),
+                job_id=job_id,
+                job_private_key=job_private_key,
+                upload_type='resourceUtilizationLog',
+                other_name=None
+            )
+            upload_state['timestampSummaryUploaded'] = time.time()
     except: # noqa
         print('Error uploading resource utilization log')
         traceback.print_exc()
+
+def _upload_data(*, data: bytes, job_id: str, job_private_key: str, upload_type: str, other_name: Union[str, None]):
+    upload_url, _ = get_upload_url(
+        job_id=job_id,
+        job_private_key=job_private_key,
+        upload_type=upload_type,  # type: ignore
+        other_name=other_name,
+        output_name=None,
+        size=len(data)
+    )
+    if not isinstance(upload_url, str):
+        raise Exception(f'Error getting resource utilization log upload url (not a string): {upload_url}')
+    r = get_http_session().put(upload_url, data=data, timeout=60)
+    if r.status_code != 200:
+        raise Exception(f'Error uploading resource utilization log: {r.status_code} {r.text}')
@@ -1,7 +1,11 @@
 from typing import Union
-import requests
+import os
 import tempfile
 from pydantic import BaseModel, Field
+from ..common.http_session import HttpRequestError
+from ._download_file import download_file, FileDownloadError
+from ._file_cache import get_cached_file
+from ._timings import timed_span
 # from .resolve_dandi_url import resolve_dandi_url
 
 
@@ -29,6 +33,10 @@ class InputFile(BaseModel):
         return url
 
     def download(self, dest_file_path: Union[str, None] = None):
+        with timed_span('download', input=self.name):
+            self._download(dest_file_path)
+
+    def _download(self, dest_file_path: Union[str, None]):
         if self.local_file_name is not None:
             # In the case of a local file, we just copy it
             if dest_file_path is not None and dest_file_path != self.local_file_name:
@@ -42,6 +50,19 @@ class InputFile(BaseModel):
         url = self.get_url()
         if url is None:
             raise ValueError('Cannot download file because url is not set')
+        cached_file_path = _get_cached_file(url)
+        if cached_file_path is not None:
+            # The file is in the file cache of the compute client, which is
+            # read-only and shared between jobs, so we link to it rather than
+            # making a copy
+            if dest_file_path is not None and dest_file_path != cached_file_path:
+                if os.path.lexists(dest_file_path):
+                    os.remove(dest_file_path)
+                os.symlink(cached_file_path, dest_file_path)
+                self.local_file_name = dest_file_path
+            else:
+                self.local_file_name = cached_file_path
+            return
         if dest_file_path is not None:
             # We have a destination file path and we don't have a cache
             print(f'Downloading {url} to {dest_file_path}')
@@ -74,12 +95,15 @@ class InputFile(BaseModel):
         else:
             raise ValueError(f'Unexpected type for InputFile: {type(value)}')
 
+def _get_cached_file(url: str) -> Union[str, None]:
+    try:
+        return get_cached_file(url)
+    except (FileDownloadError, HttpRequestError) as e:
+        raise InputFileDownloadError(str(e)) from e
+
+
 def _download_file(url: str, dest_file_path: str):
-    # stream the download
-    r = requests.get(url, stream=True, timeout=60 * 60 * 24 * 7)
-    if r.status_code != 200:
-        raise InputFileDownloadError(f'Error downloading file {url}: {r.status_code} {r.reason}')
-    with open(dest_file_path, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+    try:
+        download_file(url, dest_file_path)
+    except (FileDownloadError, HttpRequestError) as e:
+        raise InputFileDownloadError(str(e)) from e
@@ -7,4 +7,5 @@ from .App import App
 from .ProcessorBase import ProcessorBase
 
 from .upload_additional_job_output import upload_additional_job_output
+from ._upload_file import upload_file_parts, UploadFilePart, clear_upload_progress
 
@@ -0,0 +1,243 @@
+from typing import Any, Dict, Union
+import os
+import sys
+import json
+import time
+import runpy
+import signal
+import socket
+import tempfile
+import traceback
+import subprocess
+from .App import App
+
+
+# A zygote is a process that has a trusted app loaded (dendro, pydantic and
+# the modules imported by the main.py of the app) and that forks a new process
+# for each job, so that the job doesn't have to start a container and import
+# everything again. See compute_client/TrustedAppPool.py.
+#
+# The zygote itself stays single-threaded, which makes forking safe. The
+# forked job process runs _run_job_parent_process as usual, but before it
+# starts any threads it forks the job child process, which waits until the
+# parent tells it to start (see _prefork_job_child).
+#
+# The zygote reaps the job processes (which are not children of the compute
+# client) and writes the exit status of each one to the exitCodeFile of its
+# request, with the same convention as subprocess.Popen.returncode.
+
+
+def run_app_zygote(*, app_executable: str, socket_path: str):
+    app = _load_app(app_executable)
+    print(f'Loaded app {app._app_name} from {app_executable}')
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.listen(16)
+    # so that we can check whether the compute client is still running
+    sock.settimeout(5)
+    # exit code files of the running job processes, by pid
+    exit_code_files: Dict[int, str] = {}
+    # exit codes of the job processes that exited before they were registered
+    unclaimed_exit_codes: Dict[int, int] = {}
+
+    def reap_job_processes(signum, frame):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            # same convention as subprocess.Popen (os.waitstatus_to_exitcode requires python 3.9)
+            exit_code = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            if pid in exit_code_files:
+                _write_exit_code_file(exit_code_files.pop(pid), exit_code)
+            else:
+                unclaimed_exit_codes[pid] = exit_code
+    signal.signal(signal.SIGCHLD, reap_job_processes)
+    daemon_pid = os.getppid()
+    print(f'Listening on {socket_path}')
+    while True:
+        try:
+            conn, _ = sock.accept()
+        except socket.timeout:
+            if os.getppid() != daemon_pid:
+                print('The compute client is no longer running. Exiting.')
+                break
+            continue
+        try:
+            conn.settimeout(None)
+            request = json.loads(_read_line(conn))
+            pid = os.fork()
+            if pid == 0:
+                conn.close()
+                sock.close()
+                _run_forked_job(app=app, app_executable=app_executable, request=request)
+                os._exit(0)  # not reached
+            print(f'Started job {request["jobId"]} in process {pid}')
+            exit_code_files[pid] = request['exitCodeFile']
+            if pid in unclaimed_exit_codes:
+                _write_exit_code_file(exit_code_files.pop(pid), unclaimed_exit_codes.pop(pid))
+            conn.sendall((json.dumps({'pid': pid}) + '\n').encode('utf-8'))
+        except: # noqa
+            traceback.print_exc()
+        finally:
+            conn.close()
+    sock.close()
+
+
+def _write_exit_code_file(fname: str, exit_code: int):
+    try:
+        with open(fname + '.tmp', 'w') as f:
+            f.write(f'{exit_code}\n')
+        os.replace(fname + '.tmp', fname)
+    except: # noqa
+        traceback.print_exc()
+
+
+def _load_app(app_executable: str) -> App:
+    # the main.py of an app only calls app.run() when it is run as a script
+    sys.path.insert(0, os.path.dirname(os.path.abspath(app_executable)))
+    g = runpy.run_path(app_executable, run_name='__dendro_zygote__')
+    app = next((v for v in g.values() if isinstance(v, App)), None)
+    if app is None:
+        raise Exception(f'No app found in {app_executable}')
+    return app
+
+
+def _read_line(conn: socket.socket) -> str:
+    buf = b''
+    while not buf.endswith(b'\n'):
+        data = conn.recv(4096)
+        if not data:
+            break
+        buf += data
+    return buf.decode('utf-8')
+
+
+def _run_forked_job(*, app: App, app_executable: str, request: dict):
+    exit_code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # so that the compute client stopping does not stop the job
+        os.setsid()
+        os.environ.update(request['env'])
+        # read at import time, i.e., before the environment of the job was set
+        from ..common import api_requests
+        api_requests.dendro_api_url = os.environ.get('DENDRO_API_URL', api_requests.dendro_api_url)
+        # tempfile caches the temporary directory
+        tempfile.tempdir = None
+        # same as the output of the parent process in a container (see run.sh in _start_job.py)
+        fd = os.open(request['parentOutputFile'], os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        working_dir = request['env']['DENDRO_JOB_WORKING_DIR']
+        os.makedirs(working_dir, exist_ok=True)
+        os.chdir(working_dir)
+        if request['env'].get('DENDRO_JOB_CGROUP', None):
+            # before forking the job child, which inherits the cgroup
+            from ..common.cgroups import enter_cgroup
+            enter_cgroup(request['env']['DENDRO_JOB_CGROUP'])
+
+        launch_child = _prefork_job_child(
+            app=app,
+            job_id=request['jobId'],
+            job_private_key=request['jobPrivateKey']
+        )
+        from ._run_job_parent_process import _run_job_parent_process
+        _run_job_parent_process(
+            job_id=request['jobId'],
+            job_private_key=request['jobPrivateKey'],
+            processor_executable=app_executable,
+            job_timeout_sec=request.get('jobTimeoutSec', None),
+            compute_client_id=request['computeClientId'],
+            launch_child=launch_child
+        )
+        exit_code = 0
+    except: # noqa
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        # same as run.sh in _start_job.py (see also JobDirGarbageCollector.py)
+        try:
+            marker = '_dendro_parent_process_succeeded.txt' if exit_code == 0 else '_dendro_parent_process_failed.txt'
+            with open(os.path.join(os.path.dirname(request['parentOutputFile']), marker), 'w') as f:
+                f.write('Parent process completed successfully\n' if exit_code == 0 else 'Parent process failed\n')
+        except: # noqa
+            pass
+        os._exit(exit_code)
+
+
+def _prefork_job_child(*, app: App, job_id: str, job_private_key: str):
+    # Fork the job child process now, while this process has no threads. The
+    # child waits for the console output file, which is created later by the
+    # parent.
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(w)
+        exit_code = 1
+        try:
+            # in its own process group (see _terminate_job_child_process)
+            os.setsid()
+            with os.fdopen(r, 'rb') as f:
+                line = f.readline()
+            if not line:
+                # the parent did not start the job
+                os._exit(1)
+            msg = json.loads(line)
+            fd = os.open(msg['consoleOutFile'], os.O_WRONLY | os.O_APPEND)
+            os.dup2(fd, 1)
+            os.dup2(fd, 2)
+            os.close(fd)
+            working_dir = os.environ['DENDRO_JOB_WORKING_DIR']
+            os.makedirs(working_dir + '/tmp', exist_ok=True)
+            os.environ['TMPDIR'] = working_dir + '/tmp'
+            tempfile.tempdir = None
+            from ._run_job_child_process import _run_job_child_process
+            _run_job_child_process(job_id=job_id, job_private_key=job_private_key, processors=app._processors)
+            exit_code = 0
+        except: # noqa
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+    os.close(r)
+
+    def launch_child(*, job_id: str, job_private_key: str, processor_executable: str, console_out_file: Any):
+        os.write(w, (json.dumps({'consoleOutFile': os.path.abspath(console_out_file.name)}) + '\n').encode('utf-8'))
+        os.close(w)
+        return ForkedProcess(pid)
+    return launch_child
+
+
+class ForkedProcess:
+    """The parts of subprocess.Popen that are used for a job child process, for a child created with os.fork"""
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+        self.returncode: Union[int, None] = None
+        self.stdout = None
+        self.stderr = None
+
+    def poll(self) -> Union[int, None]:
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid != 0:
+                # same convention as subprocess.Popen (os.waitstatus_to_exitcode requires python 3.9)
+                self.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return self.returncode
+
+    def wait(self, timeout: Union[float, None] = None) -> int:
+        timer = time.time()
+        while self.poll() is None:
+            if timeout is not None and time.time() - timer > timeout:
+                raise subprocess.TimeoutExpired(cmd=f'job child process {self.pid}', timeout=timeout)
+            time.sleep(0.1)
+        assert self.returncode is not None
+        return self.returncode
@@ -0,0 +1,248 @@
+from typing import List, Union
+import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from ..common.http_session import get_http_session, with_retries, is_retryable_error, HttpRequestError
+
+
+# Downloads are split into parts that are fetched in parallel using HTTP Range
+# requests. Each part is written directly to its place in a preallocated file
+# (using pwrite), so no reassembly is needed. The completed parts are recorded
+# in a sidecar file next to the destination so that an interrupted download can
+# be resumed. If the server does not support range requests, we fall back to a
+# single streamed request.
+
+_buffer_size = 1024 * 1024
+
+
+class FileDownloadError(Exception):
+    pass
+
+
+def _is_retryable(e: Exception) -> bool:
+    return not isinstance(e, FileDownloadError) and is_retryable_error(e)
+
+
+def download_file(
+    url: str,
+    dest_file_path: str,
+    *,
+    num_connections: Union[int, None] = None,
+    part_size: Union[int, None] = None,
+    remote_file_info: Union[dict, None] = None
+):
+    """Download a file using parallel range requests
+
+    The number of parallel connections and the part size (in MB) can be set
+    using the DENDRO_DOWNLOAD_NUM_CONNECTIONS and DENDRO_DOWNLOAD_PART_SIZE_MB
+    environment variables. If remote_file_info (from get_remote_file_info) is
+    not provided, it is retrieved from the server.
+    """
+    if num_connections is None:
+        num_connections = int(os.environ.get('DENDRO_DOWNLOAD_NUM_CONNECTIONS', '8'))
+    if part_size is None:
+        part_size = int(os.environ.get('DENDRO_DOWNLOAD_PART_SIZE_MB', '16')) * 1024 * 1024
+
+    timer = time.time()
+    info = remote_file_info if remote_file_info is not None else get_remote_file_info(url)
+    if info['size'] is None or info['size'] <= part_size:
+        # Either the server does not support range requests or the file is
+        # small enough that there is nothing to gain
+        num_bytes = with_retries(lambda: _download_in_single_request(url, dest_file_path, expected_size=info['size']), label=f'downloading {url}', is_retryable=_is_retryable)
+    else:
+        _download_in_parts(
+            url,
+            dest_file_path,
+            resolved_url=info['resolvedUrl'],
+            size=info['size'],
+            etag=info['etag'],
+            num_connections=num_connections,
+            part_size=part_size
+        )
+        num_bytes = info['size']
+    elapsed = time.time() - timer
+    rate = num_bytes / elapsed if elapsed > 0 else 0
+    print(f'Downloaded {num_bytes / 1e6:.1f} MB in {elapsed:.1f} seconds ({rate / 1e6:.1f} MB/s)')
+
+
+def get_remote_file_info(url: str) -> dict:
+    """Get the size and ETag of a remote file
+
+    The size is None if the server does not support range requests.
+    """
+    return with_retries(lambda: _probe(url), label=f'probing {url}', is_retryable=_is_retryable)
+
+
+def _probe(url: str) -> dict:
+    # Request the first byte to find out whether ranges are supported and to
+    # get the size of the file
+    with get_http_session().get(url, headers={'Range': 'bytes=0-0', 'Accept-Encoding': 'identity'}, stream=True, timeout=60) as r:
+        if r.status_code == 206:
+            content_range = r.headers.get('Content-Range', '')  # e.g., bytes 0-0/12345
+            total = content_range.split('/')[-1]
+            if total.isdigit():
+                etag = r.headers.get('ETag', None)
+                if etag is not None and etag.startswith('W/'):
+                    # weak validators can't be used with If-Range
+                    etag = None
+                # r.url is the url after redirects (e.g., DANDI to S3), so
+                # that the parts don't each need to follow the redirect
+                return {'size': int(total), 'etag': etag, 'resolvedUrl': r.url}
+            return {'size': None, 'etag': None, 'resolvedUrl': None}
+        if r.status_code == 200:
+            return {'size': None, 'etag': None, 'resolvedUrl': None}
+        raise HttpRequestError(f'Error downloading file {url}: {r.status_code} {r.reason}', status_code=r.status_code)
+
+
+def _download_in_single_request(url: str, dest_file_path: str, *, expected_size: Union[int, None]) -> int:
+    with get_http_session().get(url, headers={'Accept-Encoding': 'identity'}, stream=True, timeout=60 * 60 * 24 * 7) as r:
+        if r.status_code != 200:
+            raise HttpRequestError(f'Error downloading file {url}: {r.status_code} {r.reason}', status_code=r.status_code)
+        if expected_size is None and r.headers.get('Content-Length', '').isdigit():
+            expected_size = int(r.headers['Content-Length'])
+        num_bytes = 0
+        with open(dest_file_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=_buffer_size):
+                if chunk:
+                    f.write(chunk)
+                    num_bytes += len(chunk)
+    if expected_size is not None and num_bytes != expected_size:
+        raise FileDownloadError(f'Unexpected size of downloaded file {url}: {num_bytes} != {expected_size}')
+    return num_bytes
+
+
+def _download_in_parts(
+    url: str,
+    dest_file_path: str,
+    *,
+    resolved_url: str,
+    size: int,
+    etag: Union[str, None],
+    num_connections: int,
+    part_size: int
+):
+    num_parts = (size + part_size - 1) // part_size
+    sidecar_path = dest_file_path + '.dendro-download'
+    completed_parts = _load_completed_parts(
+        sidecar_path,
+        dest_file_path=dest_file_path,
+        url=url,
+        size=size,
+        etag=etag,
+        part_size=part_size
+    )
+    if len(completed_parts) > 0:
+        print(f'Resuming download: {len(completed_parts)} of {num_parts} parts already downloaded')
+
+    fd = os.open(dest_file_path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if len(completed_parts) == 0:
+            os.ftruncate(fd, 0)
+        os.ftruncate(fd, size)
+        sidecar_lock = threading.Lock()
+
+        def download_part(part_index: int):
+            start = part_index * part_size
+            end = min(start + part_size, size)
+            # position is shared between retries so that a retry continues
+            # from where the previous attempt stopped
+            position = [start]
+
+            def attempt():
+                headers = {
+                    'Range': f'bytes={position[0]}-{end - 1}',
+                    'Accept-Encoding': 'identity'
+                }
+                if etag is not None:
+                    # If the file changed on the server, we get a 200 rather
+                    # than mixing parts of two different files
+                    headers['If-Range'] = etag
+                with get_http_session().get(resolved_url, headers=headers, stream=True, timeout=60 * 10) as r:
+                    if r.status_code != 206:
+                        if r.status_code == 200:
+                            raise FileDownloadError(f'File changed on the server during download or range requests are not supported: {url}')
+                        raise HttpRequestError(f'Error downloading part of file {url}: {r.status_code} {r.reason}', status_code=r.status_code)
+                    for chunk in r.iter_content(chunk_size=_buffer_size):
+                        if not chunk:
+                            continue
+                        if position[0] + len(chunk) > end:
+                            raise FileDownloadError(f'Received more data than requested for part of file {url}')
+                        os.pwrite(fd, chunk, position[0])
+                        position[0] += len(chunk)
+                if position[0] != end:
+                    raise HttpRequestError(f'Incomplete part of file {url}: received {position[0] - start} of {end - start} bytes')
+            with_retries(attempt, label=f'downloading part {part_index + 1} of {url}', is_retryable=_is_retryable)
+            with sidecar_lock:
+                completed_parts.add(part_index)
+                _save_completed_parts(
+                    sidecar_path,
+                    url=url,
+                    size=size,
+                    etag=etag,
+                    part_size=part_size,
+                    completed_parts=sorted(completed_parts)
+                )
+
+        remaining_parts = [i for i in range(num_parts) if i not in completed_parts]
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            for _ in executor.map(download_part, remaining_parts):
+                pass
+        os.fsync(fd)
+        actual_size = os.fstat(fd).st_size
+    except FileDownloadError:
+        # The partial download can't be trusted
+        if os.path.exists(sidecar_path):
+            os.remove(sidecar_path)
+        raise
+    finally:
+        os.close(fd)
+    if actual_size != size or len(completed_parts) != num_parts:
+        raise FileDownloadError(f'Unexpected size of downloaded file {url}: {actual_size} != {size}')
+    os.remove(sidecar_path)
+
+
+def _load_completed_parts(
+    sidecar_path: str,
+    *,
+    dest_file_path: str,
+    url: str,
+    size: int,
+    etag: Union[str, None],
+    part_size: int
+) -> set:
+    if not os.path.exists(sidecar_path) or not os.path.exists(dest_file_path):
+        return set()
+    try:
+        with open(sidecar_path, 'r') as f:
+            x = json.load(f)
+    except: # noqa
+        return set()
+    if x.get('url') != url or x.get('size') != size or x.get('etag') != etag or x.get('partSize') != part_size:
+        return set()
+    if etag is None:
+        # Without an ETag we can't tell whether the file changed on the server
+        return set()
+    return set(x.get('completedParts', []))
+
+
+def _save_completed_parts(
+    sidecar_path: str,
+    *,
+    url: str,
+    size: int,
+    etag: Union[str, None],
+    part_size: int,
+    completed_parts: List[int]
+):
+    tmp_path = sidecar_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({
+            'url': url,
+            'size': size,
+            'etag': etag,
+            'partSize': part_size,
+            'completedParts': completed_parts
+        }, f)
+    os.replace(tmp_path, sidecar_path)
@@ -0,0 +1,258 @@
+from typing import Dict, Union
+import os
+import json
+import time
+import fcntl
+import socket
+import hashlib
+from ._download_file import download_file, get_remote_file_info, FileDownloadError
+
+
+# A cache of downloaded input files that is shared by all the jobs on a compute
+# client. The compute client mounts the cache directory into the job containers
+# and sets the DENDRO_FILE_CACHE_DIR environment variable.
+#
+# Layout of the cache directory:
+#   entries/<key>   - complete files (read-only)
+#   partial/<key>   - files that are being downloaded (can be resumed)
+#   locks/<key>            - lock files pinning the entries, see below
+#   locks/<key>.download   - lock files held while downloading the entries
+#   evict.lock             - held while evicting entries
+#
+# The key is the sha1 of the url together with the ETag (or the size if there
+# is no ETag), so a file that changes on the server gets a new entry.
+#
+# The cache is mounted read-only into the containers, so that a job can't
+# modify the entries that other jobs get. The jobs in containers ask the
+# compute client to fill the cache for them over the unix socket given by
+# DENDRO_FILE_CACHE_FILL_SOCKET (see compute_client/FileCacheFiller.py). The
+# jobs of trusted apps, which run on the host, fill it themselves.
+#
+# A job holds a shared lock on locks/<key> for as long as it is using the
+# entry (the lifetime of the process), so any number of jobs can use the same
+# entry at once. Eviction takes an exclusive lock (non-blocking) and skips the
+# entries that are locked, so an entry is never removed from under a running
+# job. On a miss, the download is done under an exclusive lock on
+# locks/<key>.download so that the file is only downloaded once, while the
+# other jobs wanting the same file wait for it and then get a hit. Entries are
+# moved into place with an atomic rename, so a job never sees a partially
+# downloaded entry.
+
+# lock files held by this process, by key (closing them would release the locks)
+_held_lock_files: Dict[str, int] = {}
+
+_stats = {'hits': 0, 'misses': 0, 'bytes_hit': 0, 'bytes_downloaded': 0}
+
+
+def get_file_cache_dir() -> Union[str, None]:
+    return os.environ.get('DENDRO_FILE_CACHE_DIR', None)
+
+
+def get_file_cache_stats() -> dict:
+    return dict(_stats)
+
+
+def get_cached_file(url: str) -> Union[str, None]:
+    """Return the path of a cached copy of the file, downloading it if needed
+
+    Returns None if there is no file cache or if the file can't be cached
+    (e.g., the server does not report the size of the file). The returned file
+    is read-only and remains available for the lifetime of this process.
+    """
+    cache_dir = get_file_cache_dir()
+    if cache_dir is None:
+        return None
+    fill_socket = os.environ.get('DENDRO_FILE_CACHE_FILL_SOCKET', None)
+    # the entry may be evicted between filling it and pinning it, in which
+    # case it is filled again
+    for _ in range(3):
+        if fill_socket is not None:
+            entry = _request_fill(fill_socket, url)
+        else:
+            entry = fill_cache_entry(url, cache_dir=cache_dir, max_size=_get_max_cache_size())
+        if entry is None:
+            return None
+        key: str = entry['key']
+        size: int = entry['size']
+        entry_path = f'{cache_dir}/entries/{key}'
+        if key in _held_lock_files:
+            # already in use by this process
+            _stats['hits'] += 1
+            _stats['bytes_hit'] += size
+            return entry_path
+        # read-only, because the cache may be mounted read-only
+        lock_fd = os.open(f'{cache_dir}/locks/{key}', os.O_RDONLY)
+        try:
+            # Shared lock held for the lifetime of the process so that the
+            # entry is not evicted while we are using it. This only waits for
+            # an eviction in progress, never for the other jobs using the
+            # entry.
+            fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        except: # noqa
+            os.close(lock_fd)
+            raise
+        if not _is_complete_entry(entry_path, size):
+            os.close(lock_fd)
+            continue
+        _held_lock_files[key] = lock_fd
+        if entry['hit']:
+            _stats['hits'] += 1
+            _stats['bytes_hit'] += size
+            print(f'[dendro] File cache hit: {url} ({size / 1e6:.1f} MB)')
+        else:
+            _stats['misses'] += 1
+            _stats['bytes_downloaded'] += size
+            print(f'[dendro] File cache miss: {url} ({size / 1e6:.1f} MB)')
+        print(f'[dendro] File cache stats: {_stats["hits"]} hits ({_stats["bytes_hit"] / 1e6:.1f} MB), {_stats["misses"]} misses ({_stats["bytes_downloaded"] / 1e6:.1f} MB downloaded)')
+        return entry_path
+    raise Exception(f'Unable to get file from the file cache: {url}')
+
+
+def fill_cache_entry(url: str, *, cache_dir: str, max_size: int) -> Union[dict, None]:
+    """Make sure that the file is in the cache, downloading it if needed
+
+    Returns a dict with the key and size of the entry and whether it was a
+    hit, or None if the file can't be cached. The entry is not pinned, see
+    get_cached_file.
+    """
+    info = get_remote_file_info(url)
+    if info['size'] is None:
+        return None
+    size: int = info['size']
+    key = hashlib.sha1(f'{url}\n{info["etag"] or size}'.encode('utf-8')).hexdigest()
+    for subdir in ['entries', 'partial', 'locks']:
+        os.makedirs(f'{cache_dir}/{subdir}', exist_ok=True)
+    entry_path = f'{cache_dir}/entries/{key}'
+    lock_fd = os.open(f'{cache_dir}/locks/{key}', os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        # so that the entry is not evicted while we are filling it
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        if _is_complete_entry(entry_path, size):
+            _touch(entry_path)
+            hit = True
+        else:
+            hit = _download_entry(cache_dir, key, url, info=info, entry_path=entry_path, max_size=max_size)
+    finally:
+        os.close(lock_fd)
+    return {'key': key, 'size': size, 'hit': hit}
+
+
+def _request_fill(fill_socket: str, url: str) -> Union[dict, None]:
+    # see compute_client/FileCacheFiller.py
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(fill_socket)
+            sock.sendall((json.dumps({'url': url}) + '\n').encode('utf-8'))
+            buf = b''
+            while not buf.endswith(b'\n'):
+                data = sock.recv(4096)
+                if not data:
+                    break
+                buf += data
+    except OSError as e:
+        # e.g., the compute client is no longer running
+        print(f'[dendro] Unable to reach the file cache of the compute client: {e}')
+        return None
+    if not buf:
+        raise Exception(f'No response from the file cache of the compute client for {url}')
+    resp = json.loads(buf.decode('utf-8'))
+    if resp.get('error', None) is not None:
+        raise FileDownloadError(f'Unable to download {url} into the file cache: {resp["error"]}')
+    if resp.get('key', None) is None:
+        return None
+    return resp
+
+
+def _is_complete_entry(entry_path: str, size: int) -> bool:
+    return os.path.exists(entry_path) and os.path.getsize(entry_path) == size
+
+
+def _touch(entry_path: str):
+    # update the modification time for the LRU eviction
+    os.utime(entry_path)
+
+
+def _download_entry(cache_dir: str, key: str, url: str, *, info: dict, entry_path: str, max_size: int) -> bool:
+    # Exclusive lock so that the file is only downloaded once. Others
+    # missing the same file wait here and then get a hit. Returns whether
+    # it was a hit after all.
+    size: int = info['size']
+    download_lock_fd = os.open(f'{cache_dir}/locks/{key}.download', os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(download_lock_fd, fcntl.LOCK_EX)
+        if _is_complete_entry(entry_path, size):
+            # downloaded by someone else while we were waiting
+            _touch(entry_path)
+            return True
+        print(f'[dendro] Downloading {url} into the file cache ({size / 1e6:.1f} MB)')
+        _evict(cache_dir, required_space=size, max_size=max_size)
+        partial_path = f'{cache_dir}/partial/{key}'
+        # resumes from the partial file if a previous download was interrupted
+        download_file(url, partial_path, remote_file_info=info)
+        if os.path.getsize(partial_path) != size:
+            raise Exception(f'Unexpected size of downloaded file {url}')
+        os.chmod(partial_path, 0o444)
+        os.rename(partial_path, entry_path)
+        return False
+    finally:
+        os.close(download_lock_fd)
+
+
+def _get_max_cache_size() -> int:
+    return int(float(os.environ.get('DENDRO_FILE_CACHE_MAX_SIZE_GB', '100')) * 1024 ** 3)
+
+
+def _evict(cache_dir: str, *, required_space: int, max_size: int):
+    # Remove the least recently used entries until there is room for the new
+    # entry. Entries that are in use by running jobs are skipped.
+    evict_lock_fd = os.open(f'{cache_dir}/evict.lock', os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(evict_lock_fd, fcntl.LOCK_EX)
+        entries = []
+        total_size = 0
+        for key in os.listdir(f'{cache_dir}/entries'):
+            try:
+                st = os.stat(f'{cache_dir}/entries/{key}')
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, key))
+            total_size += st.st_size
+        for _, partial_size, _ in _list_partial(cache_dir):
+            total_size += partial_size
+        entries.sort()
+        for _, entry_size, key in entries:
+            if total_size + required_space <= max_size:
+                break
+            lock_fd = os.open(f'{cache_dir}/locks/{key}', os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue  # in use
+                print(f'[dendro] Evicting file cache entry {key} ({entry_size / 1e6:.1f} MB)')
+                os.remove(f'{cache_dir}/entries/{key}')
+                total_size -= entry_size
+            finally:
+                os.close(lock_fd)
+        if total_size + required_space > max_size:
+            print(f'[dendro] Warning: file cache is over its size limit ({(total_size + required_space) / 1e9:.1f} GB > {max_size / 1e9:.1f} GB) because the entries are in use')
+    finally:
+        os.close(evict_lock_fd)
+
+
+def _list_partial(cache_dir: str):
+    ret = []
+    for fname in os.listdir(f'{cache_dir}/partial'):
+        try:
+            st = os.stat(f'{cache_dir}/partial/{fname}')
+        except FileNotFoundError:
+            continue
+        if time.time() - st.st_mtime > 60 * 60 * 24:
+            # abandoned partial download
+            try:
+                os.remove(f'{cache_dir}/partial/{fname}')
+            except FileNotFoundError:
+                pass
+            continue
+        ret.append((st.st_mtime, st.st_size, fname))
+    return ret
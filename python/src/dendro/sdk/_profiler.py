@@ -0,0 +1,99 @@
+from typing import Dict, List, Union
+import os
+import sys
+import threading
+
+
+# Opt-in profiling of the processor of a job, enabled by the
+# DENDRO_JOB_PROFILE environment variable (COMPUTE_CLIENT_JOB_PROFILE on the
+# compute client):
+# * cprofile: deterministic profile of the main thread with cProfile. Writes
+#   profile.prof (for snakeviz, pstats, ...) and profile.txt (the top
+#   functions by cumulative time).
+# * sample: samples the stacks of all the threads every
+#   DENDRO_JOB_PROFILE_INTERVAL_MS milliseconds (default 10), like py-spy but
+#   in process. Writes profile.folded.txt, in the collapsed stack format of
+#   flamegraph.pl and speedscope. This has a lower overhead than cProfile and
+#   also shows the time spent in C extensions and in other threads.
+# The files are uploaded as other files of the job (see
+# upload_additional_job_output).
+
+
+class _CProfileProfiler:
+    def __init__(self) -> None:
+        import cProfile
+        self._profile = cProfile.Profile()
+
+    def start(self):
+        self._profile.enable()
+
+    def stop(self, output_dir: str) -> List[str]:
+        import pstats
+        import io
+        self._profile.disable()
+        prof_fname = f'{output_dir}/profile.prof'
+        self._profile.dump_stats(prof_fname)
+        s = io.StringIO()
+        stats = pstats.Stats(self._profile, stream=s)
+        stats.sort_stats('cumulative').print_stats(60)
+        txt_fname = f'{output_dir}/profile.txt'
+        with open(txt_fname, 'w') as f:
+            f.write(s.getvalue())
+        return [prof_fname, txt_fname]
+
+
+class _SamplingProfiler:
+    def __init__(self) -> None:
+        self._interval_sec = float(os.environ.get('DENDRO_JOB_PROFILE_INTERVAL_MS', '10')) / 1000
+        self._counts: Dict[str, int] = {}
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, output_dir: str) -> List[str]:
+        self._stop_event.set()
+        self._thread.join()
+        fname = f'{output_dir}/profile.folded.txt'
+        with open(fname, 'w') as f:
+            for stack, count in sorted(self._counts.items(), key=lambda x: -x[1]):
+                f.write(f'{stack} {count}\n')
+        return [fname]
+
+    def _run(self):
+        own_thread_id = threading.get_ident()
+        while not self._stop_event.wait(self._interval_sec):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+                names = []
+                f = frame
+                while f is not None:
+                    code = f.f_code
+                    names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    f = f.f_back
+                # root first, with the thread as the root
+                stack = ';'.join([thread_names.get(thread_id, str(thread_id))] + names[::-1])
+                self._counts[stack] = self._counts.get(stack, 0) + 1
+
+
+def get_job_profile_mode() -> Union[str, None]:
+    x = os.environ.get('DENDRO_JOB_PROFILE', '')
+    if not x or x == '0':
+        return None
+    if x not in ['cprofile', 'sample']:
+        print(f'[dendro] WARNING: unknown DENDRO_JOB_PROFILE: {x} (expected cprofile or sample)')
+        return None
+    return x
+
+
+def start_job_profiler() -> Union[_CProfileProfiler, _SamplingProfiler, None]:
+    mode = get_job_profile_mode()
+    if mode is None:
+        return None
+    print(f'[dendro] Profiling the processor ({mode})')
+    profiler = _CProfileProfiler() if mode == 'cprofile' else _SamplingProfiler()
+    profiler.start()
+    return profiler
@@ -1,10 +1,14 @@
 from typing import List
 import os
 import json
+import time
 from .InputFile import InputFile
 from .OutputFile import OutputFile
 from .AppProcessor import AppProcessor
 from ..common.api_requests import get_job
+from ._timings import timed_span, record_span, write_timings_json
+from ._profiler import start_job_profiler
+from .upload_additional_job_output import upload_additional_job_output
 
 
 # An empty object that we can set attributes on
@@ -51,7 +55,8 @@ def _run_job_child_process(*, job_id: str, job_private_key: str, processors: Lis
     print(f'[dendro] Running job: {job_id}')
 
     # Get a job from the remote dendro API
-    job = get_job(job_id=job_id)
+    with timed_span('get_job'):
+        job = get_job(job_id=job_id)
     if job is None:
         raise Exception(f'Job not found: {job_id}')
 
@@ -69,6 +74,7 @@ def _run_job_child_process(*, job_id: str, job_private_key: str, processors: Lis
 
     # Assemble the context for the processor function
     print('[dendro] Assembling context')
+    timer = time.time()
     context = ContextObject()
     for input in processor._inputs:
         if not input.list:
@@ -129,14 +135,25 @@ def _run_job_child_process(*, job_id: str, job_private_key: str, processors: Lis
         print(f'[dendro] Parameter: {parameter.name} = {parameter_value}')
         context._dendro_set_attribute_where_name_may_have_dots(parameter.name, parameter_value)
 
+    record_span('assemble_context', timer)
+
     print('[dendro] Preparing to run processor')
+    timer = time.time()
     _set_custom_kachery_storage_backend(job_id=job_id, job_private_key=job_private_key)
 
     _add_additional_lindi_url_resolvers(job_id=job_id, job_private_key=job_private_key)
 
+    record_span('prepare', timer)
+
     # Run the processor function
     print('[dendro] Running processor')
-    processor_class.run(context)
+    profiler = start_job_profiler()
+    try:
+        with timed_span('run_processor', processor=f'{app_name}:{processor_name}'):
+            processor_class.run(context)
+    finally:
+        if profiler is not None:
+            _finish_profile(profiler)
 
     # Check that all outputs were set
     print('[dendro] Checking outputs')
@@ -162,6 +179,8 @@ def _run_job_child_process(*, job_id: str, job_private_key: str, processors: Lis
                 output_file_sizes[output.name] = x.size
         with open(output_file_sizes_fname, 'w') as f:
             json.dump(output_file_sizes, f)
+        # the parent process adds the spans of the background uploads
+        write_timings_json('_dendro/timings.json')
     else:
         print(f'WARNING: Cannot write output_file_sizes.json: _dendro directory does not exist in current working directory: {os.getcwd()}')
 
@@ -169,6 +188,18 @@ def _run_job_child_process(*, job_id: str, job_private_key: str, processors: Lis
     print(f'[dendro] Job complete: {job_id}')
 
 
+def _finish_profile(profiler):
+    try:
+        output_dir = '_dendro/profile' if os.path.exists('_dendro') else 'dendro_profile'
+        os.makedirs(output_dir, exist_ok=True)
+        fnames = profiler.stop(output_dir)
+        for fname in fnames:
+            upload_additional_job_output(fname, remote_fname=f'profile/{os.path.basename(fname)}')
+    except Exception as e:
+        # the job does not fail because of the profiler
+        print(f'[dendro] WARNING: Problem saving profile: {e}')
+
+
 def _set_custom_kachery_storage_backend(*, job_id: str, job_private_key: str):
     try:
         import kachery_cloud as kcl
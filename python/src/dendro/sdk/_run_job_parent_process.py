@@ -1,35 +1,56 @@
 import os
 import time
 import json
-from typing import Union, Dict, Any
+from typing import Union, Any, Callable
+import signal
 import subprocess
-from ..internal_job_monitoring.console_output_monitor import do_upload as _upload_final_console_output
+from ..internal_job_monitoring.JobSupervisor import JobSupervisor
+from ..internal_job_monitoring.OutputStager import OutputStager
 import shutil
 from ..common.api_requests import set_job_status
+from ._timings import get_spans, read_timings_json, write_timings_json, summarize_spans, format_summary
+from ._profiler import get_job_profile_mode
+from ._upload_file import upload_file_to_dendro
 
 
 # This function is called internally by the compute resource daemon through the dendro CLI
 # * Sets the job status to running in the database via the API
 # * Runs the job in a separate process by calling the app executable with the appropriate env vars
-# * Launches detached processes to monitor the console output, resource utilization, and job status
+# * Runs a supervisor thread that uploads the console output and resource utilization, and checks whether the job was canceled
+# * Uploads the output files in the background as the job hands them over (see OutputStager.py)
 # * Finally, sets the job status to completed or failed in the database via the API
 
-if os.environ.get('DENDRO_JOB_WORKING_DIR', None) is None:
-    dendro_internal_folder = '_dendro'
-else:
-    dendro_internal_folder = os.environ['DENDRO_JOB_WORKING_DIR'] + '/_dendro'
+def _get_dendro_internal_folder():
+    # determined at run time because this module may be imported before the
+    # environment of the job is set up (see compute_client/TrustedAppPool.py)
+    if os.environ.get('DENDRO_JOB_WORKING_DIR', None) is None:
+        return '_dendro'
+    else:
+        return os.environ['DENDRO_JOB_WORKING_DIR'] + '/_dendro'
 
-def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_executable: str, job_timeout_sec: Union[int, None], compute_client_id: str):
+def _run_job_parent_process(
+    *,
+    job_id: str,
+    job_private_key: str,
+    processor_executable: str,
+    job_timeout_sec: Union[int, None],
+    compute_client_id: str,
+    launch_child: Union[Callable[..., Any], None] = None
+):
+    """launch_child replaces _launch_job_child_process, e.g., to fork from a process that already has the app loaded"""
     _run_job_timer = time.time()
+    dendro_internal_folder = _get_dendro_internal_folder()
 
     if os.path.exists(dendro_internal_folder):
         shutil.rmtree(dendro_internal_folder)
     os.mkdir(dendro_internal_folder)
     console_out_fname = os.path.join(dendro_internal_folder, 'console_output.txt')
-    cancel_out_fname = os.path.join(dendro_internal_folder, 'cancel.txt')
-    console_out_monitor_output_fname = os.path.join(dendro_internal_folder, 'console_output_monitor_output.txt')
-    resource_utilization_monitor_output_fname = os.path.join(dendro_internal_folder, 'resource_utilization_monitor_output.txt')
-    job_status_monitor_output_fname = os.path.join(dendro_internal_folder, 'job_status_monitor_output.txt')
+
+    # make sure that the finally clauses below (and the final uploads of the
+    # supervisor) run if this process is terminated
+    def _handle_sigterm(signum, frame):
+        raise SystemExit(f'Received signal {signum}')
+    signal.signal(signal.SIGTERM, _handle_sigterm)
 
     # set the job status to running by calling the remote dendro API
     _debug_log(f'Running job {job_id}')
@@ -45,38 +66,55 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
 
     proc = None
 
-    with open(console_out_fname, 'w') as console_out_file, open(console_out_monitor_output_fname, 'w') as console_out_monitor_output_file, open(resource_utilization_monitor_output_fname, 'w') as resource_utilization_monitor_output_file, open(job_status_monitor_output_fname, 'w') as job_status_monitor_output_file:
+    supervisor = JobSupervisor(
+        job_id=job_id,
+        job_private_key=job_private_key,
+        console_out_file=os.path.abspath(console_out_fname),
+        process_tree_pid=os.getpid(),
+        control_fifo=os.environ.get('DENDRO_JOB_CONTROL_FIFO', None)
+    )
+
+    # append mode (the folder was just created), so that the warnings that the
+    # supervisor writes are not overwritten by the output of the job
+    with open(console_out_fname, 'a') as console_out_file:
+        def _console_log(msg: str):
+            # so that the user sees the progress of the output uploads
+            try:
+                console_out_file.write(f'[dendro] {msg}\n')
+                console_out_file.flush()
+            except: # noqa
+                pass
+
+        stager = None
+        if os.environ.get('DENDRO_OUTPUT_STAGING', '1') != '0':
+            stager = OutputStager(
+                job_id=job_id,
+                job_private_key=job_private_key,
+                staging_dir=f'{dendro_internal_folder}/output_staging',
+                log=_console_log
+            )
+
+        def _get_abort_reason() -> Union[str, None]:
+            cancel_msg = supervisor.get_cancel_message()
+            if cancel_msg is not None:
+                return f'Job canceled: {cancel_msg}'
+            if job_timeout_sec is not None:
+                elapsed = time.time() - _run_job_timer
+                if elapsed > job_timeout_sec:
+                    return f'Job timed out: {elapsed} > {job_timeout_sec} seconds'
+            return None
+
         succeeded = False # whether we succeeded in running the job without an exception
         error_message = '' # if we fail, this will be set to the exception message
         try:
-            # start the console output monitor
-            cmd = f'dendro internal-job-monitor console_output --parent-pid {os.getpid()}'
-            env = {
-                'JOB_ID': job_id,
-                'JOB_PRIVATE_KEY': job_private_key,
-                'CONSOLE_OUT_FILE': os.path.abspath(console_out_fname)
-            }
-            _launch_detached_process(cmd=cmd, env=env, stdout=console_out_monitor_output_file, stderr=subprocess.STDOUT)
-
-            # start the resource utilization monitor
-            cmd = f'dendro internal-job-monitor resource_utilization --parent-pid {os.getpid()}'
-            env = {
-                'JOB_ID': job_id,
-                'JOB_PRIVATE_KEY': job_private_key
-            }
-            _launch_detached_process(cmd=cmd, env=env, stdout=resource_utilization_monitor_output_file, stderr=subprocess.STDOUT)
-
-            # start the status check monitor
-            cmd = f'dendro internal-job-monitor job_status --parent-pid {os.getpid()}'
-            env = {
-                'JOB_ID': job_id,
-                'JOB_PRIVATE_KEY': job_private_key,
-                'CANCEL_OUT_FILE': cancel_out_fname
-            }
-            _launch_detached_process(cmd=cmd, env=env, stdout=job_status_monitor_output_file, stderr=subprocess.STDOUT)
+            supervisor.start()
+            if stager is not None:
+                # before the child starts, because the staging directory
+                # tells the child to stage its outputs
+                stager.start()
 
             # Launch the job in a separate process
-            proc = _launch_job_child_process(
+            proc = (launch_child or _launch_job_child_process)(
                 job_id=job_id,
                 job_private_key=job_private_key,
                 processor_executable=processor_executable,
@@ -84,11 +122,7 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
             )
 
             while True:
-                try:
-                    retcode = proc.wait(1)
-                    # don't check this now -- wait until after we had a chance to read the last console output
-                except subprocess.TimeoutExpired:
-                    retcode = None # process is still running
+                retcode = proc.poll() # None if the process is still running
 
                 if retcode is not None:
                     if retcode != 0:
@@ -96,10 +130,9 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
                     # job has completed with exit code 0
                     break
 
-                # check if the cancel file has been created
-                if os.path.exists(cancel_out_fname):
-                    with open(cancel_out_fname, 'r') as f:
-                        cancel_msg = f.read()
+                # check if the supervisor found that the job was canceled
+                cancel_msg = supervisor.get_cancel_message()
+                if cancel_msg is not None:
                     _debug_log(f'Job canceled: {cancel_msg}')
                     raise Exception(f'Job canceled: {cancel_msg}')
 
@@ -114,9 +147,24 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
                     last_report_timestamp = time.time()
                     _debug_log('Job still running')
 
-                time.sleep(3)
+                # returns right away if the job is canceled
+                supervisor.wait_for_cancel(timeout=0.5)
+
+            if stager is not None:
+                # The compute client can give the resources of the job to
+                # other jobs while the outputs are uploading
+                _signal_compute_finished()
+                errors = stager.drain(should_abort=_get_abort_reason)
+                if len(errors) > 0:
+                    raise Exception('; '.join(errors))
+            _write_timings(
+                dendro_internal_folder=dendro_internal_folder,
+                job_id=job_id,
+                job_private_key=job_private_key,
+                log=_console_log
+            )
             succeeded = True # No exception
-        except Exception as e: # pylint: disable=broad-except
+        except (Exception, SystemExit) as e: # pylint: disable=broad-except
             _debug_log(f'Error running job: {str(e)}')
             succeeded = False
             error_message = str(e)
@@ -128,46 +176,48 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
                         proc.stdout.close()
                     if proc.stderr:
                         proc.stderr.close()
-                    proc.terminate()
+                    _terminate_job_child_process(proc)
                 except Exception: # pylint: disable=broad-except
                     pass
 
+            if stager is not None:
+                # the uploads that are left, if the job failed
+                stager.stop()
+                shutil.rmtree(f'{dendro_internal_folder}/output_staging', ignore_errors=True)
+
             dendro_job_cleanup_dir = os.environ.get('DENDRO_JOB_CLEANUP_DIR', None)
             if dendro_job_cleanup_dir is not None:
                 _debug_log(f'Cleaning up DENDRO_JOB_CLEANUP_DIR: {dendro_job_cleanup_dir}')
                 try:
                     # delete files in the cleanup dir but do not delete the cleanup dir itself
                     # and also don't delete the internal log folder _dendro
+                    num_deleted = 0
+                    num_bytes_deleted = 0
                     def _delete_files_in_dir(dir: str):
-                        for fname in os.listdir(dir):
-                            fpath = os.path.join(dir, fname)
-                            if os.path.isdir(fpath):
-                                if fname == '_dendro':
+                        nonlocal num_deleted, num_bytes_deleted
+                        for entry in os.scandir(dir):
+                            if entry.is_dir(follow_symlinks=False):
+                                if entry.name == '_dendro':
                                     # don't delete the internal log folder
                                     continue
-                                _delete_files_in_dir(fpath)
+                                _delete_files_in_dir(entry.path)
                             else:
-                                if fname.startswith('_dendro'):
+                                if entry.name.startswith('_dendro'):
                                     # don't delete dendro system files
                                     continue
-                                _debug_log(f'Deleting {fpath}')
-                                os.remove(fpath)
+                                num_bytes_deleted += entry.stat(follow_symlinks=False).st_size
+                                os.remove(entry.path)
+                                num_deleted += 1
                     _delete_files_in_dir(dendro_job_cleanup_dir)
+                    # one line rather than one per file, which can be a lot of output
+                    _debug_log(f'Deleted {num_deleted} files ({num_bytes_deleted / 1024 ** 2:.1f} MB)')
                 except Exception as e:
                     _debug_log(f'WARNING: problem cleaning up DENDRO_JOB_CLEANUP_DIR: {str(e)}')
             else:
                 _debug_log('No DENDRO_JOB_CLEANUP_DIR environment variable set. Not cleaning up.')
 
-    _debug_log('Uploading final console output')
-    # this is needed because the console output monitor may get terminated before it has a chance to upload the final console output
-    ok, errmsg = _upload_final_console_output(
-        job_id=job_id,
-        job_private_key=job_private_key,
-        console_out_file=console_out_fname
-    )
-    if not ok:
-        _debug_log('WARNING: problem uploading final console output')
-        _debug_log(errmsg)
+    _debug_log('Uploading final console output and resource utilization')
+    supervisor.stop()
 
     # get the output file sizes
     # this is important for the case of skipCloudUpload=True
@@ -178,6 +228,10 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
         with open(output_file_sizes_fname, 'r') as f:
             output_file_sizes = json.load(f)
 
+    resource_usage = supervisor.get_resource_usage()
+    if resource_usage is not None:
+        _debug_log(f'Resource usage: {json.dumps(resource_usage)}')
+
     # Set the final job status
     _debug_log('Finalizing job')
     _finalize_job(
@@ -186,7 +240,8 @@ def _run_job_parent_process(*, job_id: str, job_private_key: str, processor_exec
         succeeded=succeeded,
         error_message=error_message,
         output_file_sizes=output_file_sizes,
-        compute_client_id=compute_client_id
+        compute_client_id=compute_client_id,
+        resource_usage=resource_usage
     )
 
     _debug_log('Exiting')
@@ -220,11 +275,74 @@ def _launch_job_child_process(*, job_id: str, job_private_key: str, processor_ex
         env=env,
         stdout=console_out_file,
         stderr=subprocess.STDOUT,
-        cwd=working_dir
+        cwd=working_dir,
+        # in its own process group so that we can terminate the whole tree
+        start_new_session=True
     )
     return proc
 
-def _finalize_job(*, job_id: str, job_private_key: str, succeeded: bool, error_message: str, output_file_sizes: Union[dict, None] = None, compute_client_id: str):
+def _signal_compute_finished():
+    # The compute client watches for this file in the job directory (see
+    # JobManager._watch_job_process)
+    dendro_job_cleanup_dir = os.environ.get('DENDRO_JOB_CLEANUP_DIR', None)
+    if dendro_job_cleanup_dir is None:
+        return
+    try:
+        with open(f'{dendro_job_cleanup_dir}/_dendro_compute_finished.txt', 'w') as f:
+            f.write(f'{time.time()}\n')
+    except Exception as e: # pylint: disable=broad-except
+        _debug_log(f'WARNING: problem writing compute finished marker: {str(e)}')
+
+def _terminate_job_child_process(proc: subprocess.Popen):
+    # Ask the job to exit (SIGTERM) and kill it (SIGKILL) if it doesn't exit
+    # within the grace period
+    if proc.poll() is not None:
+        return
+    grace_period_sec = float(os.environ.get('DENDRO_JOB_TERMINATE_GRACE_SEC', '10'))
+    _debug_log('Terminating job process')
+    _signal_process_group(proc, signal.SIGTERM)
+    try:
+        proc.wait(grace_period_sec)
+    except subprocess.TimeoutExpired:
+        _debug_log(f'Job process did not exit within {grace_period_sec} seconds. Killing it.')
+        _signal_process_group(proc, signal.SIGKILL)
+        proc.wait()
+
+def _signal_process_group(proc: subprocess.Popen, sig: int):
+    try:
+        os.killpg(proc.pid, sig)
+    except ProcessLookupError:
+        pass
+
+def _write_timings(*, dendro_internal_folder: str, job_id: str, job_private_key: str, log: Callable[[str], None]):
+    # adds the spans of the background output uploads (recorded in this
+    # process) to the timings of the job child process
+    timings_fname = f'{dendro_internal_folder}/timings.json'
+    try:
+        spans = read_timings_json(timings_fname) if os.path.exists(timings_fname) else []
+        spans = spans + get_spans()
+        if len(spans) == 0:
+            return
+        write_timings_json(timings_fname, spans=spans)
+        summary = format_summary(summarize_spans(spans))
+        if summary:
+            _debug_log(f'Timings: {summary}')
+            log(f'Timings: {summary}')
+        if get_job_profile_mode() is not None:
+            upload_file_to_dendro(
+                timings_fname,
+                job_id=job_id,
+                job_private_key=job_private_key,
+                upload_type='other',
+                output_name=None,
+                other_name='timings.json'
+            )
+    except Exception as e:
+        # never fail the job because of this
+        _debug_log(f'WARNING: problem writing timings: {str(e)}')
+
+
+def _finalize_job(*, job_id: str, job_private_key: str, succeeded: bool, error_message: str, output_file_sizes: Union[dict, None] = None, compute_client_id: str, resource_usage: Union[dict, None] = None):
     try:
         if succeeded:
             # The job has completed successfully - update the status accordingly
@@ -236,7 +354,8 @@ def _finalize_job(*, job_id: str, job_private_key: str, succeeded: bool, error_m
                 status='completed',
                 # output_file_sizes=output_file_sizes,  # maybe do this in the future
                 compute_client_id=compute_client_id,
-                error=None
+                error=None,
+                resource_usage=resource_usage
             )
         else:
             # The job has failed - update the status accordingly and set the error message
@@ -247,7 +366,8 @@ def _finalize_job(*, job_id: str, job_private_key: str, succeeded: bool, error_m
                 job_private_key=job_private_key,
                 status='failed',
                 compute_client_id=compute_client_id,
-                error=error_message
+                error=error_message,
+                resource_usage=resource_usage
             )
     except Exception as e: # pylint: disable=broad-except
         # This is unfortunate - we completed the job, but somehow failed to update the status in the dendro system - maybe there was a network error (maybe we should retry?)
@@ -258,24 +378,11 @@ class SetJobStatusError(Exception):
     pass
 
 
-def _launch_detached_process(*, cmd: str, env: Dict[str, str], stdout: Any, stderr: Any):
-    _debug_log(f'Launching detached process: {cmd}')
-    subprocess.Popen(
-        cmd.split(' '),
-        env={
-            **os.environ.copy(),
-            **env
-        },
-        stdout=stdout,
-        stderr=stderr,
-        start_new_session=True
-    )
-
 def _debug_log(msg: str):
     timestamp = time.strftime('%Y-%m-%d %H:%M:%S')
     msg2 = f'{timestamp} {msg}'
     print(msg2)
     # write to dendro-job.log
     # this will be written to the working directory, which should be in the job dir
-    with open(f'{dendro_internal_folder}/dendro-job.log', 'a', encoding='utf-8') as f:
+    with open(f'{_get_dendro_internal_folder()}/dendro-job.log', 'a', encoding='utf-8') as f:
         f.write(msg2 + '\n')
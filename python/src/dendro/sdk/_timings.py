@@ -0,0 +1,119 @@
+from typing import Dict, List, Union
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+# Timed spans around the phases of a job (getting the job, assembling the
+# context, running the processor, downloading inputs, uploading outputs,
+# ...). The job child process writes them to _dendro/timings.json (next to
+# output_file_sizes.json) and the job parent process adds the spans of the
+# output uploads that it does in the background (see OutputStager.py) and
+# prints a summary to the console output of the job.
+
+_io_span_names = ['download', 'upload', 'upload_other']
+
+_spans: List[dict] = []
+_spans_lock = threading.Lock()
+
+
+@contextmanager
+def timed_span(name: str, **attributes):
+    """Record the duration of the enclosed block as a span of the job"""
+    start = time.time()
+    error = False
+    try:
+        yield
+    except BaseException:
+        error = True
+        raise
+    finally:
+        record_span(name, start, error=error, **attributes)
+
+
+def record_span(name: str, start: float, *, error: bool = False, **attributes):
+    """Record a span that started at start (from time.time()) and ends now"""
+    span = {
+        'name': name,
+        'start': start,
+        'durationSec': time.time() - start,
+        'thread': threading.current_thread().name,
+        'attributes': attributes,
+        'error': error
+    }
+    with _spans_lock:
+        _spans.append(span)
+
+
+def get_spans() -> List[dict]:
+    with _spans_lock:
+        return list(_spans)
+
+
+def write_timings_json(fname: str, *, spans: Union[List[dict], None] = None):
+    if spans is None:
+        spans = get_spans()
+    spans = sorted(spans, key=lambda s: s['start'])
+    x = {
+        'spans': spans,
+        'summary': summarize_spans(spans)
+    }
+    with open(fname, 'w') as f:
+        json.dump(x, f, indent=2)
+
+
+def read_timings_json(fname: str) -> List[dict]:
+    with open(fname, 'r') as f:
+        return json.load(f)['spans']
+
+
+def summarize_spans(spans: List[dict]) -> dict:
+    """Total time per span name, and how the time of the processor splits into I/O and compute"""
+    totals: Dict[str, dict] = {}
+    for s in spans:
+        t = totals.setdefault(s['name'], {'count': 0, 'totalSec': 0.0})
+        t['count'] += 1
+        t['totalSec'] += s['durationSec']
+    io_intervals = [(s['start'], s['start'] + s['durationSec']) for s in spans if s['name'] in _io_span_names]
+    ret = {
+        'byName': totals,
+        # wall clock time spent in downloads and uploads (overlapping spans
+        # are counted once)
+        'ioSec': _union_length(io_intervals)
+    }
+    run_spans = [s for s in spans if s['name'] == 'run_processor']
+    if len(run_spans) > 0:
+        r = run_spans[0]
+        r_start, r_end = r['start'], r['start'] + r['durationSec']
+        io_during_run = _union_length([(max(a, r_start), min(b, r_end)) for a, b in io_intervals if b > r_start and a < r_end])
+        ret['processorSec'] = r['durationSec']
+        ret['processorIoSec'] = io_during_run
+        ret['processorComputeSec'] = r['durationSec'] - io_during_run
+    return ret
+
+
+def format_summary(summary: dict) -> str:
+    parts = []
+    if 'processorSec' in summary:
+        parts.append(f'processor {summary["processorSec"]:.1f} s ({summary["processorComputeSec"]:.1f} s compute, {summary["processorIoSec"]:.1f} s I/O)')
+    for name in ['download', 'upload', 'upload_other', 'stage_output']:
+        if name in summary['byName']:
+            t = summary['byName'][name]
+            parts.append(f'{name} {t["totalSec"]:.1f} s ({t["count"]}x)')
+    return ', '.join(parts)
+
+
+def _union_length(intervals: List[tuple]) -> float:
+    total = 0.0
+    current_start, current_end = None, None
+    for a, b in sorted(intervals):
+        if current_end is None or a > current_end:
+            if current_end is not None:
+                total += current_end - current_start
+            current_start, current_end = a, b
+        else:
+            current_end = max(current_end, b)
+    if current_end is not None:
+        total += current_end - current_start
+    return total
@@ -0,0 +1,447 @@
+from typing import Dict, List, Union
+import os
+import json
+import time
+import threading
+import mmap
+import base64
+import hashlib
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from ..common.api_requests import get_upload_url, finalize_multipart_upload
+from ..common.http_session import get_http_session, with_retries, is_retryable_error, HttpRequestError
+
+
+# Parts of a multipart upload are uploaded concurrently, each with its own
+# retries. The parts are streamed from disk rather than read into memory, so
+# the memory used by an upload is bounded by the number of connections times
+# the read buffer size, regardless of the size of the parts. The ETags of the
+# completed parts are recorded in a sidecar file next to the local file so
+# that a restarted job can skip the parts that were already uploaded.
+#
+# Request bodies are read through an mmap of the file and handed to the socket
+# as memoryviews, so the data is not copied in Python. Uploads that are slower
+# than a minimum rate (DENDRO_UPLOAD_MIN_RATE_KBPS, measured over windows of
+# DENDRO_UPLOAD_STALL_WINDOW_SEC) are aborted and retried rather than hanging.
+# The throughput is written to _dendro/upload_stats.json in the job working
+# directory so that it ends up in the resource utilization log.
+
+_buffer_size = 1024 * 1024
+
+
+class FileUploadError(Exception):
+    pass
+
+
+class UploadStalledError(FileUploadError):
+    pass
+
+
+@dataclass
+class UploadFilePart:
+    part_number: int
+    offset: int
+    size: int
+    url: str
+
+
+class _UploadStats:
+    """Throughput of the uploads of this process, shared by all connections"""
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._num_active = 0
+        self._bytes_sent = 0
+        self._rate_window_start = (time.time(), 0)
+        self._bytes_per_sec = 0.0
+        self._last_write_timestamp = 0.0
+
+    def start(self):
+        with self._lock:
+            self._num_active += 1
+        self._write(force=True)
+
+    def stop(self):
+        with self._lock:
+            self._num_active -= 1
+        self._write(force=True)
+
+    def add_bytes(self, num_bytes: int):
+        with self._lock:
+            self._bytes_sent += num_bytes
+            t0, b0 = self._rate_window_start
+            elapsed = time.time() - t0
+            if elapsed >= 5:
+                self._bytes_per_sec = (self._bytes_sent - b0) / elapsed
+                self._rate_window_start = (time.time(), self._bytes_sent)
+        self._write(force=False)
+
+    def _write(self, *, force: bool):
+        working_dir = os.environ.get('DENDRO_JOB_WORKING_DIR', None)
+        if working_dir is None or not os.path.isdir(f'{working_dir}/_dendro'):
+            return
+        with self._lock:
+            if not force and time.time() - self._last_write_timestamp < 2:
+                return
+            self._last_write_timestamp = time.time()
+            x = {
+                'timestamp': time.time(),
+                'num_active': self._num_active,
+                'bytes_sent': self._bytes_sent,
+                'bytes_per_sec': self._bytes_per_sec if self._num_active > 0 else 0
+            }
+            fname = f'{working_dir}/_dendro/upload_stats.json'
+            try:
+                with open(fname + '.tmp', 'w') as f:
+                    json.dump(x, f)
+                os.replace(fname + '.tmp', fname)
+            except: # noqa
+                pass
+
+
+_upload_stats = _UploadStats()
+
+
+class _FileSlice:
+    """A read-only file-like view of part of a file, for streaming request bodies
+
+    Optionally computes the MD5 and SHA-1 of the data as it is read.
+    """
+    def __init__(self, file_path: str, offset: int, size: int, *, compute_hashes: bool = False) -> None:
+        self._size = size
+        self._position = 0
+        self._f = open(file_path, 'rb')
+        # mmap can't map an empty region
+        self._mm = mmap.mmap(self._f.fileno(), length=0, access=mmap.ACCESS_READ) if size > 0 else None
+        self._view = memoryview(self._mm)[offset:offset + size] if self._mm is not None else None
+        self._md5 = hashlib.md5() if compute_hashes else None
+        self._sha1 = hashlib.sha1() if compute_hashes else None
+        self._min_rate = float(os.environ.get('DENDRO_UPLOAD_MIN_RATE_KBPS', '10')) * 1000
+        self._stall_window_sec = float(os.environ.get('DENDRO_UPLOAD_STALL_WINDOW_SEC', '60'))
+        self._window_start = (time.time(), 0)
+
+    def __len__(self) -> int:
+        # requests uses this to set the Content-Length header
+        return self._size
+
+    def read(self, n: int = -1):
+        # The size requested by the http library is small (e.g., 16 KB), so we
+        # ignore it and return larger blocks, which the library passes on
+        # to the socket as is
+        if self._view is None or self._position >= self._size:
+            return b''
+        self._check_rate()
+        end = min(self._position + _buffer_size, self._size)
+        data = self._view[self._position:end]
+        if self._md5 is not None and self._sha1 is not None:
+            self._md5.update(data)
+            self._sha1.update(data)
+        _upload_stats.add_bytes(end - self._position)
+        self._position = end
+        return data
+
+    def _check_rate(self):
+        t0, b0 = self._window_start
+        elapsed = time.time() - t0
+        if elapsed >= self._stall_window_sec:
+            rate = (self._position - b0) / elapsed
+            if rate < self._min_rate:
+                raise UploadStalledError(f'Upload stalled: {rate / 1000:.1f} KB/s over the last {elapsed:.0f} seconds')
+            self._window_start = (time.time(), self._position)
+
+    @property
+    def stall_window_sec(self) -> float:
+        return self._stall_window_sec
+
+    def md5_hex(self) -> str:
+        assert self._md5 is not None
+        return self._md5.hexdigest()
+
+    def sha1_hex(self) -> str:
+        assert self._sha1 is not None
+        return self._sha1.hexdigest()
+
+    def close(self):
+        try:
+            if self._view is not None:
+                self._view.release()
+            if self._mm is not None:
+                self._mm.close()
+        except BufferError:
+            # a block that was returned by read() is still referenced (e.g.,
+            # by the traceback of a failed request); the mmap is closed when
+            # it is garbage collected
+            pass
+        self._f.close()
+
+
+def upload_file_parts(
+    local_file_name: str,
+    parts: List[UploadFilePart],
+    *,
+    upload_id: str,
+    num_connections: Union[int, None] = None
+) -> Dict[int, str]:
+    """Upload parts of a file to signed URLs concurrently
+
+    Returns the ETag header of the response for each part number. If a
+    previous attempt with the same upload_id was interrupted, the parts that
+    were already uploaded are skipped. The number of concurrent uploads can be
+    set using the DENDRO_UPLOAD_NUM_CONNECTIONS environment variable.
+    """
+    if num_connections is None:
+        num_connections = int(os.environ.get('DENDRO_UPLOAD_NUM_CONNECTIONS', '4'))
+    progress = _UploadProgress(local_file_name, upload_id=upload_id)
+    etags = progress.get_etags()
+    if len(etags) > 0:
+        print(f'[] Resuming upload: {len(etags)} of {len(parts)} parts already uploaded')
+    remaining_parts = [p for p in parts if p.part_number not in etags]
+    total_size = sum(p.size for p in remaining_parts)
+    num_bytes_uploaded = [0]
+    lock = threading.Lock()
+    timer = time.time()
+
+    def upload_part(part: UploadFilePart):
+        def attempt():
+            body = _FileSlice(local_file_name, part.offset, part.size)
+            try:
+                # the first timeout also applies to sending, so a connection
+                # that makes no progress at all fails
+                resp = get_http_session().put(part.url, data=body, timeout=(body.stall_window_sec, 60 * 5))
+            finally:
+                body.close()
+            if resp.status_code != 200:
+                raise HttpRequestError(f'Error uploading part {part.part_number} ({resp.status_code}) {resp.reason}: {resp.text}', status_code=resp.status_code)
+            return resp.headers['ETag']
+        etag = with_retries(attempt, label=f'uploading part {part.part_number}')
+        with lock:
+            progress.set_etag(part.part_number, etag)
+            num_bytes_uploaded[0] += part.size
+            elapsed = time.time() - timer
+            rate = num_bytes_uploaded[0] / elapsed if elapsed > 0 else 0
+            print(f'[] Uploaded part {part.part_number}/{len(parts)} ({num_bytes_uploaded[0] / 1e6:.1f} of {total_size / 1e6:.1f} MB, {rate / 1e6:.1f} MB/s)')
+
+    _upload_stats.start()
+    try:
+        with ThreadPoolExecutor(max_workers=num_connections) as executor:
+            for _ in executor.map(upload_part, remaining_parts):
+                pass
+    finally:
+        _upload_stats.stop()
+    elapsed = time.time() - timer
+    rate = total_size / elapsed if elapsed > 0 else 0
+    print(f'[] Uploaded {total_size / 1e6:.1f} MB in {elapsed:.1f} seconds ({rate / 1e6:.1f} MB/s)')
+    return progress.get_etags()
+
+
+def upload_file_to_signed_url(local_file_name: str, url: str, *, etag_is_md5: bool = False) -> dict:
+    """Upload a file in a single streamed PUT request
+
+    Returns the size, MD5 and SHA-1 of the uploaded data. The MD5 is sent in
+    the Content-MD5 header so that the server checks the data it received.
+    This takes an extra pass over the file to compute the hashes beforehand,
+    unless etag_is_md5 is set: only when the bucket is known to return the MD5
+    of the data as the ETag (as S3 does for single part uploads without
+    SSE-KMS encryption), the ETag is checked against the MD5 of the data that
+    was sent instead. Other servers may return ETags that look like an MD5
+    but are not.
+    """
+    size = os.path.getsize(local_file_name)
+    timer = time.time()
+    hashes = _compute_file_hashes(local_file_name) if not etag_is_md5 else None
+
+    def attempt():
+        body = _FileSlice(local_file_name, 0, size, compute_hashes=etag_is_md5)
+        headers = {}
+        if hashes is not None:
+            headers['Content-MD5'] = base64.b64encode(bytes.fromhex(hashes['md5'])).decode('ascii')
+        try:
+            # the first timeout also applies to sending, so a connection that
+            # makes no progress at all fails
+            resp = get_http_session().put(url, data=body, headers=headers, timeout=(body.stall_window_sec, 60 * 5))
+        finally:
+            body.close()
+        if resp.status_code != 200:
+            raise HttpRequestError(f'Error uploading file to bucket ({resp.status_code}) {resp.reason}: {resp.text}', status_code=resp.status_code)
+        if hashes is not None:
+            return {'size': size, 'md5': hashes['md5'], 'sha1': hashes['sha1']}
+        md5 = body.md5_hex()
+        etag = resp.headers.get('ETag', '').strip('"')
+        if etag != md5:
+            raise FileUploadError(f'Checksum mismatch after upload: ETag {etag} != MD5 {md5}')
+        return {'size': size, 'md5': md5, 'sha1': body.sha1_hex()}
+
+    def is_retryable(e: Exception) -> bool:
+        # the data was corrupted on the way (Content-MD5 mismatch)
+        return is_retryable_error(e) or (isinstance(e, HttpRequestError) and 'BadDigest' in str(e))
+    _upload_stats.start()
+    try:
+        ret = with_retries(attempt, label='uploading file', is_retryable=is_retryable)
+    except HttpRequestError as e:
+        raise FileUploadError(str(e)) from e
+    finally:
+        _upload_stats.stop()
+    elapsed = time.time() - timer
+    rate = size / elapsed if elapsed > 0 else 0
+    print(f'[] Uploaded {size / 1e6:.1f} MB in {elapsed:.1f} seconds ({rate / 1e6:.1f} MB/s, sha1 {ret["sha1"]})')
+    return ret
+
+
+def _compute_file_hashes(file_path: str) -> dict:
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            data = f.read(_buffer_size)
+            if not data:
+                break
+            md5.update(data)
+            sha1.update(data)
+    return {'md5': md5.hexdigest(), 'sha1': sha1.hexdigest()}
+
+
+def get_resumable_upload_id(local_file_name: str) -> Union[str, None]:
+    """The upload ID of an interrupted multipart upload of this file, if any"""
+    return _UploadProgress.load_upload_id(local_file_name)
+
+
+def clear_upload_progress(local_file_name: str):
+    sidecar_path = _UploadProgress.sidecar_path(local_file_name)
+    if os.path.exists(sidecar_path):
+        os.remove(sidecar_path)
+
+
+def upload_file_to_dendro(
+    local_file_name: str,
+    *,
+    job_id: str,
+    job_private_key: str,
+    upload_type: str,
+    output_name: Union[str, None],
+    other_name: Union[str, None]
+) -> str:
+    """Upload an output or other file of a job and return its download URL"""
+    resumable_upload_id = get_resumable_upload_id(local_file_name)
+    if resumable_upload_id is not None:
+        try:
+            return _upload_file_to_dendro(
+                local_file_name,
+                job_id=job_id,
+                job_private_key=job_private_key,
+                upload_type=upload_type,
+                output_name=output_name,
+                other_name=other_name,
+                upload_id=resumable_upload_id
+            )
+        except HttpRequestError as e:
+            # For example, the multipart upload may have expired. Other
+            # errors (e.g., network) are raised so that the progress is kept.
+            if e.status_code is None or e.status_code < 400 or e.status_code >= 500:
+                raise
+            print(f'[] Unable to resume upload: {e}')
+            clear_upload_progress(local_file_name)
+    return _upload_file_to_dendro(
+        local_file_name,
+        job_id=job_id,
+        job_private_key=job_private_key,
+        upload_type=upload_type,
+        output_name=output_name,
+        other_name=other_name,
+        upload_id=None
+    )
+
+
+def _upload_file_to_dendro(
+    local_file_name: str,
+    *,
+    job_id: str,
+    job_private_key: str,
+    upload_type: str,
+    output_name: Union[str, None],
+    other_name: Union[str, None],
+    upload_id: Union[str, None]
+) -> str:
+    size = os.path.getsize(local_file_name)
+    upload_url, download_url = get_upload_url(
+        upload_type=upload_type,  # type: ignore
+        job_id=job_id,
+        job_private_key=job_private_key,
+        output_name=output_name,
+        other_name=other_name,
+        size=size,
+        upload_id=upload_id
+    )
+    if isinstance(upload_url, str):
+        upload_file_to_signed_url(local_file_name, upload_url)
+    elif isinstance(upload_url, dict):
+        signed_parts = upload_url['parts']
+        upload_id = upload_url['uploadId']
+        assert upload_id is not None
+        part_size = (size + len(signed_parts) - 1) // len(signed_parts)
+        parts: List[UploadFilePart] = []
+        for i, p in enumerate(signed_parts):
+            assert p['partNumber'] == i + 1
+            start = i * part_size
+            end = min((i + 1) * part_size, size)
+            parts.append(UploadFilePart(part_number=p['partNumber'], offset=start, size=end - start, url=p['signedUrl']))
+        print(f'[] Uploading {len(parts)} parts')
+        etags = upload_file_parts(local_file_name, parts, upload_id=upload_id)
+        print('[] Completing multi-part upload')
+        finalize_multipart_upload(
+            upload_id=upload_id,
+            parts=[{'PartNumber': p.part_number, 'ETag': etags[p.part_number]} for p in parts],
+            job_id=job_id,
+            job_private_key=job_private_key,
+            url=download_url,
+            size=size
+        )
+        clear_upload_progress(local_file_name)
+    else:
+        raise FileUploadError(f'Unexpected type for upload_url: {type(upload_url)}')
+    return download_url
+
+
+class _UploadProgress:
+    def __init__(self, local_file_name: str, *, upload_id: str) -> None:
+        self._path = _UploadProgress.sidecar_path(local_file_name)
+        self._upload_id = upload_id
+        st = os.stat(local_file_name)
+        # The ETags are only valid for the same upload of the same file
+        self._file_signature = {'size': st.st_size, 'mtime': st.st_mtime}
+        self._etags: Dict[int, str] = {}
+        if os.path.exists(self._path):
+            try:
+                with open(self._path, 'r') as f:
+                    x = json.load(f)
+                if x.get('uploadId') == upload_id and x.get('file') == self._file_signature:
+                    self._etags = {int(k): v for k, v in x.get('etags', {}).items()}
+            except: # noqa
+                pass
+
+    @staticmethod
+    def sidecar_path(local_file_name: str) -> str:
+        return local_file_name + '.dendro-upload'
+
+    @staticmethod
+    def load_upload_id(local_file_name: str) -> Union[str, None]:
+        path = _UploadProgress.sidecar_path(local_file_name)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as f:
+                return json.load(f).get('uploadId', None)
+        except: # noqa
+            return None
+
+    def get_etags(self) -> Dict[int, str]:
+        return dict(self._etags)
+
+    def set_etag(self, part_number: int, etag: str):
+        self._etags[part_number] = etag
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'uploadId': self._upload_id,
+                'file': self._file_signature,
+                'etags': self._etags
+            }, f)
+        os.replace(tmp_path, self._path)
@@ -1,6 +1,6 @@
 import os
-import requests
-from ..common.api_requests import get_upload_url
+from ._upload_file import upload_file_to_dendro
+from ._timings import timed_span
 
 
 def upload_additional_job_output(
@@ -13,21 +13,15 @@ def upload_additional_job_output(
     job_private_key = os.environ.get('JOB_PRIVATE_KEY', None)
     if job_private_key is None:
         raise Exception('JOB_PRIVATE_KEY environment variable is not set')
-    upload_url, download_url = get_upload_url(
-        upload_type='other',
-        job_id=job_id,
-        job_private_key=job_private_key,
-        output_name=None,
-        other_name=remote_fname,
-        size=os.path.getsize(local_file_name)
-    )
-    assert isinstance(upload_url, str)
-
     print(f'[] Uploading other file {remote_fname}') # it could be a security issue to provide the url in this print statement
-    with open(local_file_name, 'rb') as f:
-        resp_upload = requests.put(upload_url, data=f, timeout=60 * 60 * 24 * 7)
-        if resp_upload.status_code != 200:
-            print(upload_url)
-            raise Exception(f'Error uploading other file to bucket ({resp_upload.status_code}) {resp_upload.reason}: {resp_upload.text}')
+    with timed_span('upload_other', name=remote_fname):
+        download_url = upload_file_to_dendro(
+            local_file_name,
+            job_id=job_id,
+            job_private_key=job_private_key,
+            upload_type='other',
+            output_name=None,
+            other_name=remote_fname
+        )
 
     return download_url
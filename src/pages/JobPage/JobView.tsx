@@ -186,6 +186,28 @@ const LeftPanel: FunctionComponent<LeftPanelProps> = ({
               <pre>{JSON.stringify(job.requiredResources)}</pre>
             </td>
           </tr>
+          {job.resourceUsage && (
+            <tr>
+              <td>Resource usage</td>
+              <td>
+                CPU: {formatTimeSec(job.resourceUsage.cpuSec)}
+                {job.resourceUsage.peakMemoryBytes
+                  ? `; peak memory: ${formatByteCount(job.resourceUsage.peakMemoryBytes)}`
+                  : ""}
+                {job.resourceUsage.readBytes !== undefined &&
+                job.resourceUsage.readBytes !== null
+                  ? `; read: ${formatByteCount(job.resourceUsage.readBytes)}`
+                  : ""}
+                {job.resourceUsage.writtenBytes !== undefined &&
+                job.resourceUsage.writtenBytes !== null
+                  ? `; written: ${formatByteCount(job.resourceUsage.writtenBytes)}`
+                  : ""}
+                {job.resourceUsage.oomKillEvents
+                  ? `; ${job.resourceUsage.oomKillEvents} out-of-memory kill(s)`
+                  : ""}
+              </td>
+            </tr>
+          )}
           <tr>
             <td>Target compute clients</td>
             <td>{(job.targetComputeClientIds || []).join(", ")}</td>
@@ -252,6 +274,15 @@ const ConsoleOutputView: FunctionComponent<ConsoleOutputViewProps> = ({
     // if job changes, refresh text
     refreshText();
   }, [job, refreshText]);
+  // For jobs with a lot of output, the console output is only the tail and
+  // the earlier output is uploaded in segments
+  const earlierSegments = useMemo(
+    () =>
+      (job.otherFileOutputs || [])
+        .filter((o) => o.name.startsWith("console_output/"))
+        .sort((a, b) => a.name.localeCompare(b.name)),
+    [job.otherFileOutputs],
+  );
   return (
     <div style={{ position: "absolute", width, height, overflowY: "auto" }}>
       <h3>Console output</h3>
@@ -262,6 +293,19 @@ const ConsoleOutputView: FunctionComponent<ConsoleOutputViewProps> = ({
       >
         Refresh
       </Hyperlink>
+      {earlierSegments.length > 0 && (
+        <div>
+          Earlier output:&nbsp;
+          {earlierSegments.map((o, i) => (
+            <span key={o.name}>
+              <a href={o.url} target="_blank" rel="noreferrer">
+                {i + 1}
+              </a>
+              &nbsp;
+            </span>
+          ))}
+        </div>
+      )}
       <pre style={{ fontSize: 10 }}>{text}</pre>
     </div>
   );
@@ -26,35 +26,51 @@ type ResourceUtilizationLogLine = {
     available: number;
     percent: number;
     used: number;
-    free: number;
-    active: number;
-    inactive: number;
-    buffers: number;
-    cached: number;
-    shared: number;
-    slab: number;
+    free?: number;
+    active?: number;
+    inactive?: number;
+    buffers?: number;
+    cached?: number;
+    shared?: number;
+    slab?: number;
   };
   disk_io_counters: {
-    read_count: number;
-    write_count: number;
+    read_count?: number;
+    write_count?: number;
     read_bytes: number;
     write_bytes: number;
-    read_time: number;
-    write_time: number;
+    read_time?: number;
+    write_time?: number;
   } | null;
   net_io_counters: {
     bytes_sent: number;
     bytes_recv: number;
-    packets_sent: number;
-    packets_recv: number;
-    errin: number;
-    errout: number;
-    dropin: number;
-    dropout: number;
+    packets_sent?: number;
+    packets_recv?: number;
+    errin?: number;
+    errout?: number;
+    dropin?: number;
+    dropout?: number;
   };
   gpu: {
     loads: number[];
   } | null;
+  upload?: {
+    bytes_sent: number;
+    bytes_per_sec: number;
+  } | null;
+  // resource usage of the job's process tree
+  process_tree?: {
+    num_processes: number;
+    rss: number;
+    cpu_percent: number;
+    cpu_user_sec: number;
+    cpu_system_sec: number;
+    read_bytes: number;
+    write_bytes: number;
+  };
+  // older samples are downsampled (per-minute, then per-hour)
+  resolution_sec?: number;
 };
 
 const useResourceUtilizationLog = (job: DendroJob) => {
@@ -111,6 +127,10 @@ const ResourceUtilizationView: FunctionComponent<
       ? resourceUtilizationLog[0].timestamp
       : 0;
 
+  const hasProcessTree = resourceUtilizationLog.some(
+    (l) => l.process_tree && l.process_tree.num_processes > 0,
+  );
+
   const handleDownloadCsv = useCallback(() => {
     const headerLine =
       "timestamp,cpu_percent,memory_used,memory_total,network_sent,network_received,disk_read,disk_write";
@@ -174,6 +194,18 @@ const ResourceUtilizationView: FunctionComponent<
             })),
             color: "black",
           },
+          ...(hasProcessTree
+            ? [
+                {
+                  label: "Job CPU percent",
+                  data: resourceUtilizationLog.map((l) => ({
+                    x: l.timestamp,
+                    y: l.process_tree?.cpu_percent || 0,
+                  })),
+                  color: "orange",
+                },
+              ]
+            : []),
         ]}
         referenceTime={referenceTime}
         yAxisLabel="CPU percent"
@@ -197,6 +229,18 @@ const ResourceUtilizationView: FunctionComponent<
             })),
             color: "black",
           },
+          ...(hasProcessTree
+            ? [
+                {
+                  label: "Job memory (RSS)",
+                  data: resourceUtilizationLog.map((l) => ({
+                    x: l.timestamp,
+                    y: (l.process_tree?.rss || 0) / 1024 / 1024 / 1024,
+                  })),
+                  color: "orange",
+                },
+              ]
+            : []),
         ]}
         referenceTime={referenceTime}
         yAxisLabel="Memory (GB)"
@@ -268,6 +312,23 @@ const ResourceUtilizationView: FunctionComponent<
           yAxisLabel="Network IO (MB / sec)"
         />
       )}
+      {/* Output uploads */}
+      {resourceUtilizationLog.some((l) => l.upload) && (
+        <LogPlot
+          series={[
+            {
+              label: "Upload rate",
+              data: resourceUtilizationLog.map((l) => ({
+                x: l.timestamp,
+                y: (l.upload?.bytes_per_sec || 0) / 1024 / 1024,
+              })),
+              color: "purple",
+            },
+          ]}
+          referenceTime={referenceTime}
+          yAxisLabel="Upload rate (MB / sec)"
+        />
+      )}
       {/* Disk I/O */}
       {cumulative ? (
         <LogPlot
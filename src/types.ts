@@ -234,6 +234,32 @@ export const isDendroJobRequiredResources = (
   });
 };
 
+// DendroJobResourceUsage
+// measured by the job from its cgroup, or from its process tree if cgroups are not available
+export type DendroJobResourceUsage = {
+  source: "cgroup" | "process_tree";
+  cpuSec: number;
+  peakMemoryBytes?: number | null;
+  readBytes?: number | null;
+  writtenBytes?: number | null;
+  memoryHighEvents?: number | null;
+  oomKillEvents?: number | null;
+};
+
+export const isDendroJobResourceUsage = (
+  x: any,
+): x is DendroJobResourceUsage => {
+  return validateObject(x, {
+    source: isOneOf([isEqualTo("cgroup"), isEqualTo("process_tree")]),
+    cpuSec: isNumber,
+    peakMemoryBytes: optional(isOneOf([isNumber, isNull])),
+    readBytes: optional(isOneOf([isNumber, isNull])),
+    writtenBytes: optional(isOneOf([isNumber, isNull])),
+    memoryHighEvents: optional(isOneOf([isNumber, isNull])),
+    oomKillEvents: optional(isOneOf([isNumber, isNull])),
+  });
+};
+
 // DendroJobSecret
 export type DendroJobSecret = {
   name: string;
@@ -347,6 +373,7 @@ export type DendroJob = {
   computeClientName: string | null;
   computeClientUserId: string | null;
   imageUri: string | null;
+  resourceUsage?: DendroJobResourceUsage | null;
 };
 
 export const isDendroJob = (x: any): x is DendroJob => {
@@ -382,6 +409,7 @@ export const isDendroJob = (x: any): x is DendroJob => {
     computeClientName: isOneOf([isString, isNull]),
     computeClientUserId: isOneOf([isString, isNull]),
     imageUri: isOneOf([isString, isNull]),
+    resourceUsage: optional(isOneOf([isDendroJobResourceUsage, isNull])),
   });
 };
 
@@ -783,6 +811,84 @@ export const isCreateJobResponse = (x: any): x is CreateJobResponse => {
   });
 };
 
+// createJobs
+export type CreateJobsRequestJobOutputRef = {
+  inputName: string;
+  jobIndex: number;
+  outputName: string;
+};
+
+export const isCreateJobsRequestJobOutputRef = (
+  x: any,
+): x is CreateJobsRequestJobOutputRef => {
+  return validateObject(x, {
+    inputName: isString,
+    jobIndex: isNumber,
+    outputName: isString,
+  });
+};
+
+export type CreateJobsRequestJob = {
+  batchId: string;
+  tags: string[];
+  jobDefinition: DendroJobDefinition;
+  requiredResources: DendroJobRequiredResources;
+  targetComputeClientIds?: string[];
+  secrets: DendroJobSecret[];
+  jobDependencies: string[];
+  // inputs whose urls are outputs of other jobs in the same request
+  inputFileJobOutputRefs?: CreateJobsRequestJobOutputRef[];
+};
+
+export const isCreateJobsRequestJob = (x: any): x is CreateJobsRequestJob => {
+  return validateObject(x, {
+    batchId: isString,
+    tags: isArrayOf(isString),
+    jobDefinition: isDendroJobDefinition,
+    requiredResources: isDendroJobRequiredResources,
+    targetComputeClientIds: optional(isArrayOf(isString)),
+    secrets: isArrayOf(isDendroJobSecret),
+    jobDependencies: isArrayOf(isString),
+    inputFileJobOutputRefs: optional(
+      isArrayOf(isCreateJobsRequestJobOutputRef),
+    ),
+  });
+};
+
+export type CreateJobsRequest = {
+  type: "createJobsRequest";
+  serviceName: string;
+  userId: string;
+  jobs: CreateJobsRequestJob[];
+  skipCache?: boolean;
+  rerunFailing?: boolean;
+  deleteFailing?: boolean;
+};
+
+export const isCreateJobsRequest = (x: any): x is CreateJobsRequest => {
+  return validateObject(x, {
+    type: isEqualTo("createJobsRequest"),
+    serviceName: isString,
+    userId: isString,
+    jobs: isArrayOf(isCreateJobsRequestJob),
+    skipCache: optional(isBoolean),
+    rerunFailing: optional(isBoolean),
+    deleteFailing: optional(isBoolean),
+  });
+};
+
+export type CreateJobsResponse = {
+  type: "createJobsResponse";
+  jobs: DendroJob[];
+};
+
+export const isCreateJobsResponse = (x: any): x is CreateJobsResponse => {
+  return validateObject(x, {
+    type: isEqualTo("createJobsResponse"),
+    jobs: isArrayOf(isDendroJob),
+  });
+};
+
 // findJobByDefinition
 export type FindJobByDefinitionRequest = {
   type: "findJobByDefinitionRequest";
@@ -925,6 +1031,37 @@ export const isGetRunnableJobsForComputeClientResponse = (
   });
 };
 
+// computeClientHeartbeat
+export type ComputeClientHeartbeatRequest = {
+  type: "computeClientHeartbeatRequest";
+  computeClientId: string;
+  runningJobIds: string[]; // the jobs that have a running process on the compute client
+};
+
+export const isComputeClientHeartbeatRequest = (
+  x: any,
+): x is ComputeClientHeartbeatRequest => {
+  return validateObject(x, {
+    type: isEqualTo("computeClientHeartbeatRequest"),
+    computeClientId: isString,
+    runningJobIds: isArrayOf(isString),
+  });
+};
+
+export type ComputeClientHeartbeatResponse = {
+  type: "computeClientHeartbeatResponse";
+  canceledJobIds: string[]; // the running jobs that should be stopped
+};
+
+export const isComputeClientHeartbeatResponse = (
+  x: any,
+): x is ComputeClientHeartbeatResponse => {
+  return validateObject(x, {
+    type: isEqualTo("computeClientHeartbeatResponse"),
+    canceledJobIds: isArrayOf(isString),
+  });
+};
+
 // getRunnableJob
 export type GetRunnableJobRequest = {
   type: "getRunnableJobRequest";
@@ -1011,6 +1148,7 @@ export type SetJobStatusRequest = {
   computeClientId: string;
   status: DendroJobStatus;
   error?: string;
+  resourceUsage?: DendroJobResourceUsage;
 };
 
 export const isSetJobStatusRequest = (x: any): x is SetJobStatusRequest => {
@@ -1020,6 +1158,7 @@ export const isSetJobStatusRequest = (x: any): x is SetJobStatusRequest => {
     computeClientId: isString,
     status: isDendroJobStatus,
     error: optional(isString),
+    resourceUsage: optional(isDendroJobResourceUsage),
   });
 };
 
@@ -1041,6 +1180,7 @@ export type GetSignedUploadUrlRequest = {
   outputName?: string;
   otherName?: string;
   size: number;
+  uploadId?: string; // to resume an existing multipart upload
 };
 
 export const isGetSignedUploadUrlRequest = (
@@ -1057,6 +1197,7 @@ export const isGetSignedUploadUrlRequest = (
     outputName: optional(isString),
     otherName: optional(isString),
     size: isNumber,
+    uploadId: optional(isString),
     fallbackFileBaseName: optional(isString), // historic -- to remove
   });
 };